@@ -184,7 +184,8 @@ def create_index(
     index_store_dir: Optional[str] = None,
 ):
     """
-    Create a workspace for the given SWE-bench instance.
+    Create a workspace for the given SWE-bench instance. The index is only searched, so it's memory-mapped and shared
+    with other workers that load the same index.
     """
     if not index_store_dir:
         index_store_dir = os.getenv("INDEX_STORE_DIR", "/tmp/index_store")
@@ -193,6 +194,6 @@ def create_index(
         repository = create_repository(instance)
 
     code_index = CodeIndex.from_index_name(
-        instance["instance_id"], index_store_dir=index_store_dir, file_repo=repository
+        instance["instance_id"], index_store_dir=index_store_dir, file_repo=repository, mmap=True, shared=True
     )
     return code_index
@@ -1,18 +1,42 @@
+import threading
+
 from moatless.codeblocks.codeblocks import CodeBlock, CodeBlockType
+from moatless.codeblocks.parser.bulk import iter_parse_many, parse_many
+from moatless.codeblocks.parser.cache import ModuleCache, get_default_module_cache
 from moatless.codeblocks.parser.create import create_parser
 from moatless.codeblocks.parser.java import JavaParser
 from moatless.codeblocks.parser.parser import CodeParser
 from moatless.codeblocks.parser.python import PythonParser
 
+_parsers_by_language: dict[str, CodeParser] = {}
+_parsers_lock = threading.Lock()
+
 
 def supports_codeblocks(path: str):
     return path.endswith(".py")
 
 
+def get_parser_by_language(language: str) -> CodeParser:
+    """
+    Returns a shared parser with default settings for the language. Parsers are thread safe and are only created
+    once per language to avoid compiling the queries and loading the tokenizer on each call.
+
+    Parsed modules are cached on disk if MOATLESS_PARSE_CACHE_DIR is set, see ModuleCache.
+    """
+    parser = _parsers_by_language.get(language)
+    if parser:
+        return parser
+
+    with _parsers_lock:
+        if language not in _parsers_by_language:
+            _parsers_by_language[language] = create_parser(language, module_cache=get_default_module_cache())
+        return _parsers_by_language[language]
+
+
 def get_parser_by_path(file_path: str) -> CodeParser | None:
     if file_path.endswith(".py"):
-        return PythonParser()
+        return get_parser_by_language("python")
     elif file_path.endswith(".java"):
-        return JavaParser()
+        return get_parser_by_language("java")
     else:
         return None
@@ -1,5 +1,5 @@
 import re
-from dataclasses import dataclass, field
+from dataclasses import InitVar, dataclass, field
 from enum import Enum
 from typing import Dict, List, Optional, Set
 
@@ -261,7 +261,23 @@ class BlockSpan:
     index: int = 0
     parent_block_path: Optional[BlockPath] = None
     is_partial: bool = False
-    tokens: int = 0
+    tokens: InitVar[Optional[int]] = 0  # Replaced by the tokens property below
+
+    # None if the tokens haven't been counted yet, see Module.resolve_tokens()
+    _tokens: Optional[int] = field(default=None, init=False)
+
+    def __post_init__(self, tokens: Optional[int]):
+        self._tokens = tokens
+
+    def _get_tokens(self) -> int:
+        if self._tokens is None and self.initiating_block:
+            module = self.initiating_block.module
+            if module is not None:
+                module.resolve_tokens()
+        return self._tokens or 0
+
+    def _set_tokens(self, tokens: Optional[int]):
+        self._tokens = tokens
 
     @property
     def block_type(self):
@@ -282,10 +298,27 @@ class ValidationError:
     error: str
 
 
+class ModuleSource:
+    """
+    The bytes a module was parsed from, shared by its blocks. Blocks keep the byte range of their content instead of
+    a decoded copy, and decode it from a memoryview slice when it's read.
+    """
+
+    __slots__ = ("data", "encoding", "_view")
+
+    def __init__(self, data: bytes, encoding: str = "utf8"):
+        self.data = data
+        self.encoding = encoding
+        self._view = memoryview(data)
+
+    def decode(self, start_byte: int, end_byte: int) -> str:
+        return str(self._view[start_byte:end_byte], self.encoding)
+
+
 @dataclass(eq=False, repr=False, slots=True)
 class CodeBlock:
     type: CodeBlockType
-    content: str
+    content: InitVar[Optional[str]]  # Replaced by the content property below, None to decode it from the source
     identifier: Optional[str] = None
     parameters: List["Parameter"] = field(default_factory=list)
     relationships: List["Relationship"] = field(default_factory=list)
@@ -298,27 +331,101 @@ class CodeBlock:
     pre_code: str = ""
     pre_lines: int = 0
     indentation: str = ""
-    tokens: int = 0
+    tokens: InitVar[Optional[int]] = 0  # Replaced by the tokens property below, None to count tokens lazily
     children: List["CodeBlock"] = field(default_factory=list)
     validation_errors: List[str] = field(default_factory=list)
     parent: Optional["CodeBlock"] = None
     previous: Optional["CodeBlock"] = None
     next: Optional["CodeBlock"] = None
 
+    _content: Optional[str] = field(default=None, init=False)
     _content_lines: Optional[List[str]] = field(default=None, init=False)
 
-    def __post_init__(self):
+    # Set by the parser, the content is then decoded from the byte range in the source each time it's read
+    _source: Optional[ModuleSource] = field(default=None, init=False)
+    _start_byte: int = field(default=0, init=False)
+    _end_byte: int = field(default=0, init=False)
+
+    _tokens: Optional[int] = field(default=None, init=False)
+    _sum_tokens: Optional[int] = field(default=None, init=False)
+
+    # Cached by full_path() and path_string(), cleared when the block or a parent is moved to another parent
+    _full_path: Optional[tuple[str, ...]] = field(default=None, init=False)
+    _path_string: Optional[str] = field(default=None, init=False)
+
+    def __post_init__(self, content: Optional[str], tokens: Optional[int]):
+        self._content = content
         self._content_lines = None
+        self._source = None
+        self._start_byte = 0
+        self._end_byte = 0
+        self._tokens = tokens
+        self._sum_tokens = None
+        self._full_path = None
+        self._path_string = None
 
         if self.children:
             for child in self.children:
                 child.parent = self
+                child._invalidate_path()
 
         if self.pre_code and not self.indentation and not self.pre_lines:
             pre_code_lines = self.pre_code.split("\n")
             self.pre_lines = len(pre_code_lines) - 1
             self.indentation = pre_code_lines[-1] if self.pre_lines > 0 else self.pre_code
 
+    def _get_tokens(self) -> int:
+        if self._tokens is None:
+            # Count the tokens of all blocks in the module that haven't been counted yet in one batch
+            module = self.module
+            if module is not None:
+                module.resolve_tokens()
+
+            if self._tokens is None:
+                from llama_index.core import get_tokenizer
+
+                self._tokens = len(get_tokenizer()(self.content))
+
+        return self._tokens
+
+    def _set_tokens(self, tokens: Optional[int]):
+        self._tokens = tokens
+        self._invalidate_sum_tokens()
+
+    def _get_content(self) -> str:
+        if self._source is not None:
+            return self._source.decode(self._start_byte, self._end_byte)
+        return self._content
+
+    def _set_content(self, content: str):
+        self._content = content
+        self._content_lines = None
+        self._source = None
+
+    def _invalidate_path(self):
+        # A cached path implies cached paths on all parents, so children of a block without a cached path can be skipped
+        if self._full_path is None:
+            return
+
+        self._full_path = None
+        self._path_string = None
+        for child in self.children:
+            child._invalidate_path()
+
+    def _children_changed(self):
+        self._invalidate_sum_tokens()
+
+        module = self.module
+        if module is not None:
+            module._invalidate_indexes()
+
+    def _invalidate_sum_tokens(self):
+        # A cached sum implies cached sums on all children, so ancestors without a cached sum can be skipped
+        block = self
+        while block is not None and block._sum_tokens is not None:
+            block._sum_tokens = None
+            block = block.parent
+
     @property
     def content_lines(self):
         if self._content_lines is None:
@@ -343,6 +450,8 @@ class CodeBlock:
 
         self.children.insert(index, child)
         child.parent = self
+        child._invalidate_path()
+        self._children_changed()
 
     def insert_children(self, index: int, children: list["CodeBlock"]):
         for child in children:
@@ -351,8 +460,15 @@ class CodeBlock:
 
     def append_child(self, child: "CodeBlock"):
         self.children.append(child)
-        self.span_ids.update(child.span_ids)
+        if not child.span_ids <= self.span_ids:
+            # span_ids may be a frozenset shared with other blocks in the same span
+            if isinstance(self.span_ids, set):
+                self.span_ids.update(child.span_ids)
+            else:
+                self.span_ids = set(self.span_ids) | child.span_ids
         child.parent = self
+        child._invalidate_path()
+        self._children_changed()
 
     def append_children(self, children: list["CodeBlock"]):
         for child in children:
@@ -362,6 +478,8 @@ class CodeBlock:
         self.children = self.children[:start_index] + children + self.children[end_index:]
         for child in children:
             child.parent = self
+            child._invalidate_path()
+        self._children_changed()
 
     def replace_child(self, index: int, child: "CodeBlock"):
         # TODO: Do a proper update of everything when replacing child blocks
@@ -371,9 +489,12 @@ class CodeBlock:
 
         self.children[index] = child
         child.parent = self
+        child._invalidate_path()
+        self._children_changed()
 
     def remove_child(self, index: int):
         del self.children[index]
+        self._children_changed()
 
     def sync_indentation(self, original_block: "CodeBlock", updated_block: "CodeBlock"):
         original_indentation_length = len(original_block.indentation) + len(self.indentation)
@@ -406,9 +527,9 @@ class CodeBlock:
         return self._to_string()
 
     def sum_tokens(self):
-        tokens = self.tokens
-        tokens += sum([child.sum_tokens() for child in self.children])
-        return tokens
+        if self._sum_tokens is None:
+            self._sum_tokens = self.tokens + sum([child.sum_tokens() for child in self.children])
+        return self._sum_tokens
 
     def get_all_child_blocks(self) -> list["CodeBlock"]:
         blocks = []
@@ -604,18 +725,18 @@ class CodeBlock:
         span_marker: SpanMarker = SpanMarker.COMMENT,
         show_line_numbers: bool = False,
     ) -> str:
-        contents = ""
+        contents = []
 
         if show_span_id:
-            contents += "\n\n"
+            contents.append("\n\n")
             if span_marker == SpanMarker.COMMENT:
                 span_comment = self.create_comment(f"span_id: {self.belongs_to_span.span_id}")
-                contents += f"{self.indentation}{span_comment}"
+                contents.append(f"{self.indentation}{span_comment}")
             elif span_marker == SpanMarker.TAG:
-                contents += f"\n<span id='{self.belongs_to_span.span_id}'>"
+                contents.append(f"\n<span id='{self.belongs_to_span.span_id}'>")
 
             if not self.pre_lines:
-                contents += "\n"
+                contents.append("\n")
 
         def print_line(line_number: int):
             if not show_line_numbers:
@@ -633,20 +754,24 @@ class CodeBlock:
             and self.parent.type == CodeBlockType.MODULE
             and self.parent.children[0] == self
         ):
-            contents += print_line(self.start_line)
-
-        if self.pre_lines:
-            for i in range(self.pre_lines):
-                contents += "\n"
-                contents += print_line(self.start_line - self.pre_lines + i + 1)
-
-        contents += self.indentation + self.content_lines[0]
-        for i, line in enumerate(self.content_lines[1:]):
-            contents += "\n"
-            contents += print_line(self.start_line + i + 1)
-            contents += line
+            contents.append(print_line(self.start_line))
+
+        for i in range(self.pre_lines):
+            contents.append("\n")
+            contents.append(print_line(self.start_line - self.pre_lines + i + 1))
+
+        content_lines = self.content_lines
+        contents.append(self.indentation)
+        if show_line_numbers:
+            contents.append(content_lines[0])
+            for i, line in enumerate(content_lines[1:]):
+                contents.append("\n")
+                contents.append(print_line(self.start_line + i + 1))
+                contents.append(line)
+        else:
+            contents.append("\n".join(content_lines))
 
-        return contents
+        return "".join(contents)
 
     def to_prompt(
         self,
@@ -831,17 +956,20 @@ class CodeBlock:
             return "<module>"
 
     def path_string(self):
-        return ".".join(self.full_path())
+        if self._path_string is None:
+            self._path_string = ".".join(self._get_full_path())
+        return self._path_string
 
     def full_path(self):
-        path = []
-        if self.parent:
-            path.extend(self.parent.full_path())
-
-        if self.identifier:
-            path.append(self.identifier)
+        return list(self._get_full_path())
 
-        return path
+    def _get_full_path(self) -> tuple[str, ...]:
+        if self._full_path is None:
+            path = self.parent._get_full_path() if self.parent else ()
+            if self.identifier:
+                path += (self.identifier,)
+            self._full_path = path
+        return self._full_path
 
     @property
     def module(self) -> "Module":  # noqa: F821
@@ -1244,3 +1372,9 @@ class CodeBlock:
             return False
 
         return any(child.has_content(query, span_id) for child in self.children)
+
+
+# The tokens properties are set after the dataclasses are created so the tokens init argument keeps its default
+BlockSpan.tokens = property(BlockSpan._get_tokens, BlockSpan._set_tokens)
+CodeBlock.tokens = property(CodeBlock._get_tokens, CodeBlock._set_tokens)
+CodeBlock.content = property(CodeBlock._get_content, CodeBlock._set_content)
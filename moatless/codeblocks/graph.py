@@ -0,0 +1,104 @@
+from array import array
+from collections.abc import Iterable
+from typing import Optional
+
+from moatless.codeblocks.codeblocks import CodeBlock
+
+
+class ModuleGraph:
+    """
+    Relationships between the blocks in a module. Nodes are the paths of the blocks and the paths they reference,
+    numbered in the order they are added, and edges are stored as adjacency arrays of node numbers.
+    """
+
+    def __init__(
+        self,
+        node_paths: list[str],
+        node_blocks: list[Optional[CodeBlock]],
+        edges: Iterable[tuple[int, int]],
+    ):
+        self._node_paths = node_paths
+        self._node_blocks = node_blocks
+        self._node_ids = {path: i for i, path in enumerate(node_paths)}
+
+        edges = sorted(set(edges))
+        self._successor_offsets, self._successors = self._adjacency(len(node_paths), edges)
+        self._predecessor_offsets, self._predecessors = self._adjacency(
+            len(node_paths), sorted((target, source) for source, target in edges)
+        )
+
+    @classmethod
+    def build(
+        cls, blocks: Iterable[CodeBlock], relationship_paths: Iterable[tuple[CodeBlock, list[str]]]
+    ) -> "ModuleGraph":
+        """
+        Build the graph from the blocks in the module and the referenced paths of each block. If several blocks have
+        the same path the node refers to the last one.
+        """
+        node_ids = {}
+        node_paths = []
+        node_blocks = []
+
+        def node_id(path: str) -> int:
+            i = node_ids.get(path)
+            if i is None:
+                i = node_ids[path] = len(node_paths)
+                node_paths.append(path)
+                node_blocks.append(None)
+            return i
+
+        for block in blocks:
+            node_blocks[node_id(block.path_string())] = block
+
+        edges = [(node_id(block.path_string()), node_id(".".join(path))) for block, path in relationship_paths]
+        return cls(node_paths, node_blocks, edges)
+
+    @staticmethod
+    def _adjacency(node_count: int, edges: list[tuple[int, int]]) -> tuple[array, array]:
+        offsets = array("I", [0] * (node_count + 1))
+        for source, _ in edges:
+            offsets[source + 1] += 1
+        for i in range(node_count):
+            offsets[i + 1] += offsets[i]
+        return offsets, array("I", (target for _, target in edges))
+
+    def nodes(self) -> list[str]:
+        return list(self._node_paths)
+
+    def edges(self) -> list[tuple[str, str]]:
+        return [
+            (self._node_paths[source], self._node_paths[self._successors[i]])
+            for source in range(len(self._node_paths))
+            for i in range(self._successor_offsets[source], self._successor_offsets[source + 1])
+        ]
+
+    def successors(self, path: str) -> list[str]:
+        return [self._node_paths[i] for i in self._neighbours(path, self._successor_offsets, self._successors)]
+
+    def predecessors(self, path: str) -> list[str]:
+        return [self._node_paths[i] for i in self._neighbours(path, self._predecessor_offsets, self._predecessors)]
+
+    def block(self, path: str) -> Optional[CodeBlock]:
+        i = self._node_ids.get(path)
+        return self._node_blocks[i] if i is not None else None
+
+    def related_blocks(self, path: str) -> list[CodeBlock]:
+        """
+        Returns the blocks the block with the path refers to, followed by the blocks that refer to it.
+        """
+        related = []
+        for neighbours in (
+            self._neighbours(path, self._successor_offsets, self._successors),
+            self._neighbours(path, self._predecessor_offsets, self._predecessors),
+        ):
+            for i in neighbours:
+                block = self._node_blocks[i]
+                if block is not None:
+                    related.append(block)
+        return related
+
+    def _neighbours(self, path: str, offsets: array, targets: array) -> array:
+        i = self._node_ids.get(path)
+        if i is None:
+            return targets[0:0]
+        return targets[offsets[i] : offsets[i + 1]]
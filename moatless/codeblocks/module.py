@@ -1,14 +1,148 @@
+import gc
 import logging
-from dataclasses import field, dataclass
+import marshal
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable
+from dataclasses import field, dataclass, fields
 from typing import Optional, Dict
 
-from networkx import DiGraph
+from tree_sitter import Tree
 
 from moatless.codeblocks import CodeBlock, CodeBlockType
-from moatless.codeblocks.codeblocks import BlockSpan, SpanType
+from moatless.codeblocks.codeblocks import (
+    BlockSpan,
+    ModuleSource,
+    Parameter,
+    ReferenceScope,
+    Relationship,
+    RelationshipType,
+    SpanType,
+    ValidationError,
+)
+from moatless.codeblocks.graph import ModuleGraph
 
 logger = logging.getLogger(__name__)
 
+# Fields that reference other blocks or spans and are stored as indexes in the flat module state, or are derived
+_BLOCK_REFERENCE_FIELDS = [
+    "children",
+    "parent",
+    "previous",
+    "next",
+    "belongs_to_span",
+    "_content",
+    "_content_lines",
+    "_source",
+    "_start_byte",
+    "_end_byte",
+    "_sum_tokens",
+    "_full_path",
+    "_path_string",
+]
+_BLOCK_VALUE_FIELDS = [f.name for f in fields(CodeBlock) if f.name not in _BLOCK_REFERENCE_FIELDS]
+_SPAN_VALUE_FIELDS = [f.name for f in fields(BlockSpan) if f.name != "initiating_block"]
+
+# Header of the format written by Module.to_bytes(): magic, format version, flags and the marshal version
+_BINARY_HEADER = struct.Struct("<4sBBB")
+_BINARY_MAGIC = b"MLMD"
+_BINARY_FORMAT_VERSION = 1
+_BINARY_FLAG_ZLIB = 1
+
+
+def _is_sorted(values: list[int]) -> bool:
+    return all(a <= b for a, b in zip(values, values[1:]))
+
+
+@dataclass(slots=True)
+class _ModuleIndexes:
+    """
+    Lookup tables for a module, built on first use and dropped when the block tree changes.
+    """
+
+    blocks_by_span_id: dict[str, list[CodeBlock]]
+    blocks_by_identifier: dict[Optional[str], list[CodeBlock]]
+
+    # The block found by find_by_path() for each path
+    blocks_by_path: dict[tuple[str, ...], CodeBlock]
+
+    # Child blocks in tree order with the running max of the line they are found from by find_first_by_start_line()
+    ordered_blocks: list[CodeBlock]
+    first_line_max: list[int]
+
+    # Start and end lines of the children of each block by id, or None if the children aren't ordered by line
+    child_lines: dict[int, Optional[tuple[list[int], list[int]]]]
+
+    @classmethod
+    def build(cls, module: "Module") -> "_ModuleIndexes":
+        blocks_by_span_id = {}
+        blocks_by_identifier = {}
+        blocks_by_path = {(): module}
+        block_paths = {id(module): ()}
+        ordered_blocks = []
+        first_line_max = []
+        child_lines = {}
+
+        if module.belongs_to_span:
+            blocks_by_span_id[module.belongs_to_span.span_id] = [module]
+
+        stack = [(child, None) for child in reversed(module.children)]
+        running_max = None
+        while stack:
+            block, ancestor_end_line = stack.pop()
+
+            if block.belongs_to_span:
+                blocks_by_span_id.setdefault(block.belongs_to_span.span_id, []).append(block)
+            blocks_by_identifier.setdefault(block.identifier, []).append(block)
+
+            # Paths are only resolved through the first child with each identifier
+            parent_path = block_paths.get(id(block.parent))
+            if parent_path is not None and block.identifier is not None:
+                path = parent_path + (block.identifier,)
+                if path not in blocks_by_path:
+                    blocks_by_path[path] = block
+                    block_paths[id(block)] = path
+
+            # A block is found by start line if it starts on or after the line, or if it's a leaf that ends on or
+            # after it. Blocks in a parent that ends before the line are never reached.
+            if block.children:
+                first_line = block.start_line
+            else:
+                first_line = max(block.start_line, block.end_line)
+            if ancestor_end_line is not None:
+                first_line = min(first_line, ancestor_end_line)
+
+            running_max = first_line if running_max is None else max(running_max, first_line)
+            ordered_blocks.append(block)
+            first_line_max.append(running_max)
+
+            if block.children:
+                child_ancestor_end_line = (
+                    block.end_line if ancestor_end_line is None else min(ancestor_end_line, block.end_line)
+                )
+                stack.extend((child, child_ancestor_end_line) for child in reversed(block.children))
+
+        for block in [module] + ordered_blocks:
+            if block.children:
+                start_lines = [child.start_line for child in block.children]
+                end_lines = [child.end_line for child in block.children]
+                if _is_sorted(start_lines) and _is_sorted(end_lines):
+                    child_lines[id(block)] = (start_lines, end_lines)
+                else:
+                    child_lines[id(block)] = None
+
+        return cls(
+            blocks_by_span_id=blocks_by_span_id,
+            blocks_by_identifier=blocks_by_identifier,
+            blocks_by_path=blocks_by_path,
+            ordered_blocks=ordered_blocks,
+            first_line_max=first_line_max,
+            child_lines=child_lines,
+        )
+
 
 @dataclass
 class Module(CodeBlock):
@@ -17,9 +151,33 @@ class Module(CodeBlock):
     spans_by_id: Dict[str, BlockSpan] = field(default_factory=dict)
     language: Optional[str] = None
     code_block: CodeBlock = field(default_factory=lambda: CodeBlock(content="", type=CodeBlockType.MODULE))
-    _graph: DiGraph = field(default_factory=DiGraph, init=False)  # TODO: Move to central CodeGraph
 
-    def __post_init__(self):
+    # Paths referenced by each block, set to None by the parser if the code graph is disabled
+    _relationship_paths: Optional[list[tuple[CodeBlock, list[str]]]] = field(
+        default_factory=list, init=False, repr=False
+    )
+    _graph: Optional[ModuleGraph] = field(default=None, init=False, repr=False)  # Built on first use
+    _tree: Optional[Tree] = field(default=None, init=False, repr=False)  # Kept for incremental parsing
+
+    # Counts tokens for a list of contents, set by the parser when block tokens are counted lazily
+    _token_counter: Optional[Callable[[list[str]], list[int]]] = field(default=None, init=False, repr=False)
+
+    _indexes: Optional[_ModuleIndexes] = field(default=None, init=False, repr=False)
+
+    # Bumped each time blocks are added, removed or replaced, prompts rendered from the module are cached per version
+    _version: int = field(default=0, init=False, repr=False)
+
+    # Set by the parser while blocks are added, lookups walk the tree instead of rebuilding the indexes for each change
+    _parsing: bool = field(default=False, init=False, repr=False)
+
+    # Functions with unparsed bodies by path string, set by the parser on outline parses. Lookups of spans, paths and
+    # lines within them parse the bodies with the expander first.
+    _outline_blocks: Optional[dict[str, CodeBlock]] = field(default=None, init=False, repr=False)
+    _expander: Optional[Callable[["Module", list[CodeBlock]], None]] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self, tokens: Optional[int]):
+        self._tokens = tokens
+
         if not self.code_block.type == CodeBlockType.MODULE:
             self.code_block.type = CodeBlockType.MODULE
 
@@ -31,20 +189,452 @@ class Module(CodeBlock):
     def module(self) -> "Module":  # noqa: F821
         return self
 
+    def __reduce__(self):
+        # Blocks link to each other through parent, previous and next, pickling them as they are would recurse
+        # through the whole module. Pickle the flat binary format instead.
+        return _module_from_bytes, (self.to_bytes(),)
+
+    def _to_state(self) -> dict:
+        """
+        Returns the module as flat lists of blocks, spans and graph nodes where references are stored as indexes.
+        """
+        # The content isn't part of the state, so outlined blocks can't be expanded later
+        self.expand()
+        self.resolve_tokens()
+
+        blocks = [self] + self.get_all_child_blocks()
+        block_indexes = {id(block): i for i, block in enumerate(blocks)}
+
+        spans = list(self.spans_by_id.values())
+        span_indexes = {id(span): i for i, span in enumerate(spans)}
+        for block in blocks:
+            if block.belongs_to_span and id(block.belongs_to_span) not in span_indexes:
+                span_indexes[id(block.belongs_to_span)] = len(spans)
+                spans.append(block.belongs_to_span)
+
+        def block_index(block: CodeBlock | None) -> int | None:
+            return block_indexes.get(id(block)) if block is not None else None
+
+        # Contents in the source of the module are stored as byte ranges
+        source = self._source
+
+        def block_content(block: CodeBlock) -> str | tuple[int, int]:
+            if source is not None and block._source is source and block is not self:
+                return block._start_byte, block._end_byte
+            return block.content
+
+        block_rows = [
+            (
+                tuple(getattr(block, name) for name in _BLOCK_VALUE_FIELDS),
+                block_index(block.parent),
+                block_index(block.previous),
+                block_index(block.next),
+                span_indexes[id(block.belongs_to_span)] if block.belongs_to_span else None,
+                block_content(block),
+            )
+            for block in blocks
+        ]
+
+        span_rows = [
+            (tuple(getattr(span, name) for name in _SPAN_VALUE_FIELDS), block_index(span.initiating_block))
+            for span in spans
+        ]
+
+        graph = None
+        if self._relationship_paths is not None:
+            graph = [
+                (block_indexes[id(block)], list(path))
+                for block, path in self._relationship_paths
+                if id(block) in block_indexes
+            ]
+
+        return {
+            "file_path": self.file_path,
+            "content": self.content,
+            "language": self.language,
+            "source": (source.data, source.encoding) if source is not None else None,
+            "blocks": block_rows,
+            "spans": span_rows,
+            "span_ids": list(self.spans_by_id.keys()),
+            "graph": graph,
+        }
+
+    @classmethod
+    def _from_state(cls, state: dict) -> "Module":
+        spans = []
+        for values, _ in state["spans"]:
+            span = BlockSpan.__new__(BlockSpan)
+            for name, value in zip(_SPAN_VALUE_FIELDS, values):
+                setattr(span, name, value)
+            spans.append(span)
+
+        source = ModuleSource(*state["source"]) if state["source"] is not None else None
+
+        blocks = []
+        for i, (values, _, _, _, span_index, content) in enumerate(state["blocks"]):
+            if i == 0:
+                block = cls.__new__(cls)
+                block.code_block = CodeBlock(content="", type=CodeBlockType.MODULE)
+            else:
+                block = CodeBlock.__new__(CodeBlock)
+
+            if content.__class__ is tuple:
+                block._content = None
+                block._source = source
+                block._start_byte, block._end_byte = content
+            else:
+                block._content = content
+                block._source = source if i == 0 else None
+                block._start_byte = 0
+                block._end_byte = 0
+            for name, value in zip(_BLOCK_VALUE_FIELDS, values):
+                setattr(block, name, value)
+
+            block.children = []
+            block._content_lines = None
+            block._sum_tokens = None
+            block._full_path = None
+            block._path_string = None
+            block.belongs_to_span = spans[span_index] if span_index is not None else None
+            blocks.append(block)
+
+        for block, (_, parent_index, previous_index, next_index, _, _) in zip(blocks, state["blocks"]):
+            block.parent = blocks[parent_index] if parent_index is not None else None
+            block.previous = blocks[previous_index] if previous_index is not None else None
+            block.next = blocks[next_index] if next_index is not None else None
+            if block.parent is not None:
+                block.parent.children.append(block)
+
+        for span, (_, block_index) in zip(spans, state["spans"]):
+            span.initiating_block = blocks[block_index] if block_index is not None else None
+
+        module = blocks[0]
+        module.file_path = state["file_path"]
+        module.content = state["content"]
+        module.language = state["language"]
+        module.spans_by_id = dict(zip(state["span_ids"], spans))
+        module._tree = None
+        module._token_counter = None
+        module._indexes = None
+        module._parsing = False
+        module._outline_blocks = None
+        module._expander = None
+
+        if state["graph"] is not None:
+            module._relationship_paths = [(blocks[block_index], path) for block_index, path in state["graph"]]
+        else:
+            module._relationship_paths = None
+        module._graph = None
+
+        return module
+
+    def to_bytes(self, compress: bool = False) -> bytes:
+        """
+        Serialize the module to a compact binary format that can be loaded with Module.from_bytes().
+
+        The blocks and spans are stored as columns of plain values, with the source of the module stored once and
+        block contents as byte ranges in it. Set compress to compress the columns with zlib.
+        """
+        payload = marshal.dumps(_encode_state(self._to_state()))
+        flags = 0
+        if compress:
+            payload = zlib.compress(payload)
+            flags |= _BINARY_FLAG_ZLIB
+        return _BINARY_HEADER.pack(_BINARY_MAGIC, _BINARY_FORMAT_VERSION, flags, marshal.version) + payload
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Module":
+        """
+        Load a module serialized with Module.to_bytes().
+        """
+        if len(data) < _BINARY_HEADER.size:
+            raise ValueError("Data is too short to be a serialized module")
+
+        magic, format_version, flags, marshal_version = _BINARY_HEADER.unpack_from(data)
+        if magic != _BINARY_MAGIC:
+            raise ValueError("Data is not a serialized module")
+        if format_version != _BINARY_FORMAT_VERSION or marshal_version > marshal.version:
+            raise ValueError(f"Unsupported module format version {format_version} (marshal version {marshal_version})")
+
+        payload = memoryview(data)[_BINARY_HEADER.size :]
+        if flags & _BINARY_FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+
+        # The blocks are only linked to each other when all are created. Collecting garbage while they're created
+        # would scan them over and over without finding any cycles to free.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return cls._from_state(_decode_state(marshal.loads(payload)))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    @property
+    def is_outline(self) -> bool:
+        """
+        True if the module has functions with bodies that haven't been parsed yet.
+        """
+        return bool(self._outline_blocks)
+
+    def expand(self, blocks: Optional[list[CodeBlock]] = None):
+        """
+        Parse the bodies of functions left unparsed by an outline parse, all of them if no blocks are given.
+        """
+        if not self._outline_blocks or self._parsing:
+            return
+
+        if blocks is None:
+            blocks = list(self._outline_blocks.values())
+        else:
+            blocks = [block for block in blocks if self._outline_blocks.get(block.path_string()) is block]
+
+        if blocks and self._expander:
+            self._expander(self, blocks)
+
+    def _replace_with(self, module: "Module"):
+        """
+        Take over the blocks and spans of another parse of the same file, so references to this module stay valid.
+        """
+        version = self._version
+        for f in fields(Module):
+            setattr(self, f.name, getattr(module, f.name))
+        self._version = version + 1
+
+        for child in self.children:
+            child.parent = self
+        if self.next is not None:
+            self.next.previous = self
+        for span in self.spans_by_id.values():
+            if span.initiating_block is module:
+                span.initiating_block = self
+        if self._relationship_paths is not None:
+            self._relationship_paths = [
+                (self if block is module else block, path) for block, path in self._relationship_paths
+            ]
+
+    def _expand_path(self, path: list[str] | tuple[str, ...]):
+        if self._outline_blocks and not self._parsing:
+            blocks = [self._outline_blocks.get(".".join(path[:i])) for i in range(1, len(path) + 1)]
+            self.expand([block for block in blocks if block])
+
+    def _expand_lines(self, start_line: int, end_line: Optional[int] = None):
+        if self._outline_blocks and not self._parsing:
+            if end_line is None:
+                end_line = start_line
+            self.expand(
+                [
+                    block
+                    for block in self._outline_blocks.values()
+                    if block.start_line <= end_line and block.end_line >= start_line
+                ]
+            )
+
+    def expand_spans(self, span_ids: Iterable[str]):
+        """
+        Parse the bodies of the outlined functions the spans are in.
+        """
+        if self._outline_blocks:
+            for span_id in span_ids:
+                # Spans in the body of a function are named after the path of the function
+                self._expand_path(span_id.split(":", 1)[0].split("."))
+
     def find_span_by_id(self, span_id: str) -> BlockSpan | None:
+        if self._outline_blocks:
+            self.expand_spans([span_id])
         return self.spans_by_id.get(span_id)
 
+    def _get_indexes(self) -> _ModuleIndexes | None:
+        if self._parsing:
+            return None
+
+        if self._indexes is None:
+            self._indexes = _ModuleIndexes.build(self)
+        return self._indexes
+
+    def _invalidate_indexes(self):
+        self._indexes = None
+        self._graph = None
+        self._version += 1
+
+    def _get_graph(self) -> ModuleGraph | None:
+        if self._relationship_paths is None:
+            return None
+
+        if self._graph is None:
+            # The module and blocks without identifiers, like the trailing space block, are not part of the graph
+            blocks = [block for block in self.get_all_child_blocks() if block.identifier is not None]
+            self._graph = ModuleGraph.build(blocks, self._relationship_paths)
+        return self._graph
+
+    def find_by_path(self, path: list[str]) -> Optional[CodeBlock]:
+        if path:
+            self._expand_path(path)
+
+        indexes = self._get_indexes()
+        if indexes is None or path is None:
+            return super().find_by_path(path)
+
+        return indexes.blocks_by_path.get(tuple(path))
+
+    def find_blocks_by_span_id(self, span_id: str) -> list[CodeBlock]:
+        indexes = self._get_indexes()
+        if indexes is None:
+            return super().find_blocks_by_span_id(span_id)
+
+        return list(indexes.blocks_by_span_id.get(span_id, []))
+
+    def find_first_by_span_id(self, span_id: str) -> Optional[CodeBlock]:
+        indexes = self._get_indexes()
+        if indexes is None:
+            return super().find_first_by_span_id(span_id)
+
+        blocks = indexes.blocks_by_span_id.get(span_id)
+        return blocks[0] if blocks else None
+
+    def find_blocks_with_identifier(self, identifier: str) -> list[CodeBlock]:
+        indexes = self._get_indexes()
+        if indexes is None:
+            return super().find_blocks_with_identifier(identifier)
+
+        return list(indexes.blocks_by_identifier.get(identifier, []))
+
+    def find_first_by_start_line(self, start_line: int) -> Optional[CodeBlock]:
+        self._expand_lines(start_line)
+        indexes = self._get_indexes()
+        if indexes is None:
+            return super().find_first_by_start_line(start_line)
+
+        i = bisect_left(indexes.first_line_max, start_line)
+        if i < len(indexes.ordered_blocks):
+            return indexes.ordered_blocks[i]
+        return None
+
+    def find_last_by_end_line(self, end_line: int, tokens: Optional[int] = None) -> Optional[CodeBlock]:
+        self._expand_lines(end_line)
+        indexes = self._get_indexes()
+        if indexes is None or tokens:
+            return super().find_last_by_end_line(end_line, tokens=tokens)
+
+        return self._find_last_by_end_line(indexes, self, end_line)
+
+    def _find_last_by_end_line(self, indexes: _ModuleIndexes, block: CodeBlock, end_line: int) -> Optional[CodeBlock]:
+        if not block.children:
+            return None
+
+        child_lines = indexes.child_lines.get(id(block))
+        if child_lines is None:
+            return CodeBlock.find_last_by_end_line(block, end_line)
+
+        start_lines, end_lines = child_lines
+
+        # Children starting after the line, and children before it ending on or before the line, are never searched
+        last_index = bisect_right(start_lines, end_line)
+        for child in block.children[bisect_right(end_lines, end_line) : last_index]:
+            found = self._find_last_by_end_line(indexes, child, end_line)
+            if found:
+                return found
+
+        if last_index < len(block.children) and last_index > 0:
+            return block.children[last_index - 1]
+
+        return None
+
+    def find_blocks_by_line_numbers(
+        self,
+        start_line: int,
+        end_line: int | None = None,
+        include_parents: bool = False,
+    ) -> list[CodeBlock]:
+        self._expand_lines(start_line, end_line if end_line is not None else self.end_line)
+        return super().find_blocks_by_line_numbers(start_line, end_line, include_parents=include_parents)
+
+    def find_spans_by_line_numbers(self, start_line: int, end_line: int | None = None) -> list[BlockSpan]:
+        self._expand_lines(start_line, end_line)
+        indexes = self._get_indexes()
+        if indexes is None:
+            return super().find_spans_by_line_numbers(start_line, end_line)
+
+        if end_line is None:
+            end_line = start_line
+
+        return self._find_spans_by_line_numbers(indexes, self, start_line, end_line)
+
+    def _find_spans_by_line_numbers(
+        self, indexes: _ModuleIndexes, block: CodeBlock, start_line: int, end_line: int
+    ) -> list[BlockSpan]:
+        child_lines = indexes.child_lines.get(id(block))
+        if child_lines is not None:
+            first_index = bisect_left(child_lines[1], start_line)
+        else:
+            first_index = 0
+
+        spans = []
+        for child in block.children[first_index:]:
+            if child.end_line < start_line:
+                continue
+
+            if child.start_line > end_line:
+                if not spans:
+                    last_block = self._find_last_by_end_line(indexes, block, end_line)
+                    if last_block:
+                        spans.append(last_block.belongs_to_span)
+                return spans
+
+            if child.belongs_to_span and (
+                not child.children
+                or child.children[0].start_line > end_line
+                or (child.start_line >= start_line and child.end_line <= end_line)
+                or child.start_line == start_line
+                or child.end_line == end_line
+            ):
+                spans.append(child.belongs_to_span)
+
+            for span in self._find_spans_by_line_numbers(indexes, child, start_line, end_line):
+                if span not in spans:
+                    spans.append(span)
+
+        return spans
+
+    def resolve_tokens(self):
+        """
+        Count the tokens of all blocks that haven't been counted yet in one batch and sum them up on their spans.
+        """
+        blocks = [self] + self.get_all_child_blocks()
+        lazy_blocks = [block for block in blocks if block._tokens is None]
+        lazy_spans = {id(span): span for span in self.spans_by_id.values() if span._tokens is None}
+        if not lazy_blocks and not lazy_spans:
+            return
+
+        if lazy_blocks:
+            if self._token_counter:
+                token_counts = self._token_counter([block.content for block in lazy_blocks])
+            else:
+                from llama_index.core import get_tokenizer
+
+                tokenizer = get_tokenizer()
+                token_counts = [len(tokenizer(block.content)) for block in lazy_blocks]
+
+            for block, tokens in zip(lazy_blocks, token_counts):
+                block.tokens = tokens
+
+        for span in lazy_spans.values():
+            span.tokens = 0
+
+        for block in blocks:
+            if block.belongs_to_span is not None and id(block.belongs_to_span) in lazy_spans:
+                block.belongs_to_span.tokens += block.tokens
+
     def sum_tokens(self, span_ids: set[str] | None = None):
-        tokens = self.tokens
         if span_ids:
+            tokens = self.tokens
             for span_id in span_ids:
                 span = self.spans_by_id.get(span_id)
                 if span:
                     tokens += span.tokens
             return tokens
 
-        tokens += sum([child.sum_tokens() for child in self.children])
-        return tokens
+        return super().sum_tokens()
 
     def show_spans(
         self,
@@ -104,23 +694,13 @@ class Module(CodeBlock):
     def find_related_span_ids(self, span_id: Optional[str] = None) -> set[str]:
         related_span_ids = set()
 
+        graph = self._get_graph()
         blocks = self.find_blocks_by_span_id(span_id)
         for block in blocks:
-            # Find successors (outgoing relationships)
-            successors = list(self._graph.successors(block.path_string()))
-            for succ in successors:
-                node_data = self._graph.nodes[succ]
-                if "block" in node_data:
-                    span = node_data["block"].belongs_to_span
-                    related_span_ids.add(span.span_id)
-
-            # Find predecessors (incoming relationships)
-            predecessors = list(self._graph.predecessors(block.path_string()))
-            for pred in predecessors:
-                node_data = self._graph.nodes[pred]
-                if "block" in node_data:
-                    span = node_data["block"].belongs_to_span
-                    related_span_ids.add(span.span_id)
+            # Find blocks in outgoing and incoming relationships
+            if graph is not None:
+                for related_block in graph.related_blocks(block.path_string()):
+                    related_span_ids.add(related_block.belongs_to_span.span_id)
 
             # Always add parent class initation span
             if block.parent and block.parent.type == CodeBlockType.CLASS:
@@ -135,3 +715,215 @@ class Module(CodeBlock):
                 related_span_ids.add(span.span_id)
 
         return related_span_ids
+
+
+def _module_from_bytes(data: bytes) -> Module:
+    return Module.from_bytes(data)
+
+
+def _pack_ints(values: list[Optional[int]]) -> tuple[str, bytes]:
+    """
+    Pack integers in little endian with the smallest array type code that fits them, None is stored as -1.
+    """
+    values = [-1 if value is None else value for value in values]
+    low, high = min(values, default=0), max(values, default=0)
+    for typecode in "bhiq":
+        bits = array(typecode).itemsize * 8 - 1
+        if -(1 << bits) <= low and high < (1 << bits):
+            break
+
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return typecode, column.tobytes()
+
+
+def _unpack_ints(packed: tuple[str, bytes], optional: bool = False) -> list[Optional[int]]:
+    typecode, data = packed
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+
+    values = column.tolist()
+    if optional:
+        return [None if value == -1 else value for value in values]
+    return values
+
+
+def _pack_table(values: list, by_identity: bool = False) -> tuple[list, tuple[str, bytes]]:
+    """
+    Returns the distinct values and their index for each value. Mutable values are compared by identity so values
+    shared between blocks are still shared when loaded.
+    """
+    table = []
+    indexes = {}
+    column = []
+    for value in values:
+        key = id(value) if by_identity else value
+        index = indexes.get(key)
+        if index is None:
+            index = indexes[key] = len(table)
+            table.append(value)
+        column.append(index)
+    return table, _pack_ints(column)
+
+
+def _unpack_table(packed: tuple[list, tuple[str, bytes]]) -> list:
+    table, column = packed
+    return [table[index] for index in _unpack_ints(column)]
+
+
+def _encode_state(state: dict) -> dict:
+    """
+    Returns the module state as columns of values supported by marshal. Integers are packed in arrays, repeated values
+    are stored once in tables and lists that are mostly empty are stored by block index.
+    """
+    block_rows = state["blocks"]
+    blocks = {name: [row[0][i] for row in block_rows] for i, name in enumerate(_BLOCK_VALUE_FIELDS)}
+
+    encoded_blocks = {
+        "type": _pack_table([block_type.name for block_type in blocks["type"]]),
+        "identifier": _pack_table(blocks["identifier"]),
+        "pre_code": _pack_table(blocks["pre_code"]),
+        "indentation": _pack_table(blocks["indentation"]),
+        "properties": _pack_table(blocks["properties"], by_identity=True),
+        "span_ids": _pack_table(blocks["span_ids"], by_identity=True),
+        "has_error": _pack_ints(blocks["has_error"]),
+        "start_line": _pack_ints(blocks["start_line"]),
+        "end_line": _pack_ints(blocks["end_line"]),
+        "pre_lines": _pack_ints(blocks["pre_lines"]),
+        "_tokens": _pack_ints(blocks["_tokens"]),
+        "relationships": {
+            i: [
+                (rel.scope.value, rel.external_path, rel.resolved_path, rel.path, rel.type.value, rel.identifier)
+                for rel in relationships
+            ]
+            for i, relationships in enumerate(blocks["relationships"])
+            if relationships
+        },
+        "parameters": {
+            i: [(param.identifier, param.type) for param in params]
+            for i, params in enumerate(blocks["parameters"])
+            if params
+        },
+        "validation_errors": {
+            i: [(error.error,) if isinstance(error, ValidationError) else error for error in errors]
+            for i, errors in enumerate(blocks["validation_errors"])
+            if errors
+        },
+        "parent": _pack_ints([row[1] for row in block_rows]),
+        "span": _pack_ints([row[4] for row in block_rows]),
+        "content_start": _pack_ints([row[5][0] if row[5].__class__ is tuple else -1 for row in block_rows]),
+        "content_end": _pack_ints([row[5][1] if row[5].__class__ is tuple else -1 for row in block_rows]),
+        "content": {i: row[5] for i, row in enumerate(block_rows) if row[5].__class__ is str},
+    }
+
+    # Blocks are linked in the order they're listed in unless the module was changed after it was parsed
+    previous = [row[2] for row in block_rows]
+    next = [row[3] for row in block_rows]
+    if previous != [None] + list(range(len(block_rows) - 1)) or next != list(range(1, len(block_rows))) + [None]:
+        encoded_blocks["previous"] = _pack_ints(previous)
+        encoded_blocks["next"] = _pack_ints(next)
+
+    span_rows = state["spans"]
+    spans = {name: [row[0][i] for row in span_rows] for i, name in enumerate(_SPAN_VALUE_FIELDS)}
+    spans["span_type"] = [span_type.value for span_type in spans["span_type"]]
+    spans["initiating_block"] = [row[1] for row in span_rows]
+
+    return {
+        "file_path": state["file_path"],
+        "content": state["content"],
+        "language": state["language"],
+        "source": state["source"],
+        "block_count": len(block_rows),
+        "blocks": encoded_blocks,
+        "spans": spans,
+        "span_ids": state["span_ids"],
+        "graph": state["graph"],
+    }
+
+
+def _decode_state(encoded: dict) -> dict:
+    count = encoded["block_count"]
+    encoded_blocks = encoded["blocks"]
+
+    block_types = {name: CodeBlockType[name] for name in encoded_blocks["type"][0]}
+    relationships = encoded_blocks["relationships"]
+    parameters = encoded_blocks["parameters"]
+    validation_errors = encoded_blocks["validation_errors"]
+    blocks = {
+        "type": [block_types[name] for name in _unpack_table(encoded_blocks["type"])],
+        "identifier": _unpack_table(encoded_blocks["identifier"]),
+        "pre_code": _unpack_table(encoded_blocks["pre_code"]),
+        "indentation": _unpack_table(encoded_blocks["indentation"]),
+        "properties": _unpack_table(encoded_blocks["properties"]),
+        "span_ids": _unpack_table(encoded_blocks["span_ids"]),
+        "has_error": [bool(value) for value in _unpack_ints(encoded_blocks["has_error"])],
+        "start_line": _unpack_ints(encoded_blocks["start_line"]),
+        "end_line": _unpack_ints(encoded_blocks["end_line"]),
+        "pre_lines": _unpack_ints(encoded_blocks["pre_lines"]),
+        "_tokens": _unpack_ints(encoded_blocks["_tokens"], optional=True),
+        "relationships": [
+            [
+                Relationship(
+                    scope=ReferenceScope(scope),
+                    external_path=external_path,
+                    resolved_path=resolved_path,
+                    path=path,
+                    type=RelationshipType(relationship_type),
+                    identifier=identifier,
+                )
+                for scope, external_path, resolved_path, path, relationship_type, identifier in relationships[i]
+            ]
+            if i in relationships
+            else []
+            for i in range(count)
+        ],
+        "parameters": [
+            [Parameter(identifier=identifier, type=param_type) for identifier, param_type in parameters[i]]
+            if i in parameters
+            else []
+            for i in range(count)
+        ],
+        "validation_errors": [
+            [ValidationError(error=error[0]) if isinstance(error, tuple) else error for error in validation_errors[i]]
+            if i in validation_errors
+            else []
+            for i in range(count)
+        ],
+    }
+
+    if "previous" in encoded_blocks:
+        previous = _unpack_ints(encoded_blocks["previous"], optional=True)
+        next = _unpack_ints(encoded_blocks["next"], optional=True)
+    else:
+        previous = [None] + list(range(count - 1))
+        next = list(range(1, count)) + [None]
+
+    contents = encoded_blocks["content"]
+    content_ranges = zip(_unpack_ints(encoded_blocks["content_start"]), _unpack_ints(encoded_blocks["content_end"]))
+    block_contents = [contents[i] if i in contents else content_range for i, content_range in enumerate(content_ranges)]
+
+    spans = encoded["spans"]
+    spans["span_type"] = [SpanType(span_type) for span_type in spans["span_type"]]
+
+    return {
+        "file_path": encoded["file_path"],
+        "content": encoded["content"],
+        "language": encoded["language"],
+        "source": encoded["source"],
+        "blocks": list(
+            zip(
+                zip(*(blocks[name] for name in _BLOCK_VALUE_FIELDS)),
+                _unpack_ints(encoded_blocks["parent"], optional=True),
+                previous,
+                next,
+                _unpack_ints(encoded_blocks["span"], optional=True),
+                block_contents,
+            )
+        ),
+        "spans": list(zip(zip(*(spans[name] for name in _SPAN_VALUE_FIELDS)), spans["initiating_block"])),
+        "span_ids": encoded["span_ids"],
+        "graph": encoded["graph"],
+    }
@@ -0,0 +1,114 @@
+import logging
+import os
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from moatless.codeblocks.module import Module
+from moatless.codeblocks.parser.cache import get_default_module_cache
+from moatless.codeblocks.parser.create import create_parser, create_parser_by_ext
+from moatless.codeblocks.parser.parser import CodeParser
+
+logger = logging.getLogger(__name__)
+
+# Parsers created in the current (worker) process, keyed by language or file extension and parser settings
+_parsers: dict[tuple, CodeParser] = {}
+
+
+def _get_parser(file_path: str, language: Optional[str], parser_kwargs: tuple) -> CodeParser:
+    key = (language or os.path.splitext(file_path)[1], parser_kwargs)
+    if key not in _parsers:
+        kwargs = dict(parser_kwargs)
+        kwargs.setdefault("module_cache", get_default_module_cache())
+        if language:
+            _parsers[key] = create_parser(language, **kwargs)
+        else:
+            _parsers[key] = create_parser_by_ext(key[0], **kwargs)
+    return _parsers[key]
+
+
+def _parse_file(
+    file_path: str,
+    content: Optional[str],
+    language: Optional[str],
+    parser_kwargs: tuple,
+) -> tuple[str, Module | None]:
+    try:
+        if content is None:
+            with open(file_path) as f:
+                content = f.read()
+
+        parser = _get_parser(file_path, language, parser_kwargs)
+        return file_path, parser.parse(content, file_path=file_path)
+    except Exception:
+        logger.exception(f"Failed to parse {file_path}")
+        return file_path, None
+
+
+def _parse_file_args(args: tuple) -> tuple[str, Module | None]:
+    return _parse_file(*args)
+
+
+def iter_parse_many(
+    file_paths: list[str],
+    workers: Optional[int] = None,
+    contents: Optional[list[str]] = None,
+    language: Optional[str] = None,
+    chunksize: int = 4,
+    **parser_kwargs,
+) -> Iterator[tuple[str, Module | None]]:
+    """
+    Parse files in a process pool and yield (file_path, module) tuples in the same order as file_paths.
+
+    Args:
+        file_paths: Paths to the files to parse, the files are read in the worker processes if contents isn't set.
+        workers: Number of worker processes, defaults to the number of CPUs. Files are parsed in the current
+            process if set to 1 or less.
+        contents: Optional file contents in the same order as file_paths.
+        language: Parse all files as this language instead of deriving the language from the file extension.
+        chunksize: Number of files to send to a worker process at a time.
+        parser_kwargs: Settings passed to the parser in each worker, the values must be picklable. Parsed
+            modules are cached on disk if MOATLESS_PARSE_CACHE_DIR is set.
+
+    The module is None for files that couldn't be parsed.
+    """
+    if contents is not None and len(contents) != len(file_paths):
+        raise ValueError("contents must have the same length as file_paths")
+
+    parser_kwargs_key = tuple(sorted(parser_kwargs.items()))
+    tasks = [
+        (file_path, contents[i] if contents is not None else None, language, parser_kwargs_key)
+        for i, file_path in enumerate(file_paths)
+    ]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _parse_file_args(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+        yield from executor.map(_parse_file_args, tasks, chunksize=chunksize)
+
+
+def parse_many(
+    file_paths: list[str],
+    workers: Optional[int] = None,
+    contents: Optional[list[str]] = None,
+    language: Optional[str] = None,
+    **parser_kwargs,
+) -> dict[str, Module | None]:
+    """
+    Parse files in a process pool and return the parsed modules by file path. See iter_parse_many().
+    """
+    return dict(
+        iter_parse_many(
+            file_paths,
+            workers=workers,
+            contents=contents,
+            language=language,
+            **parser_kwargs,
+        )
+    )
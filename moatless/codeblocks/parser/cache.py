@@ -0,0 +1,154 @@
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from filelock import FileLock
+
+from moatless.codeblocks.module import Module
+
+logger = logging.getLogger(__name__)
+
+# Bump when the parser output or the serialized module changes in a way not covered by the parser settings
+CACHE_FORMAT_VERSION = 4
+
+DEFAULT_MAX_SIZE = 2 * 1024**3
+
+
+class ModuleCache:
+    """
+    On-disk cache of parsed modules keyed by a hash of the content and the parser settings, stored in the compressed
+    format of Module.to_bytes().
+
+    Entries are written to a temporary file and renamed into place so several processes can share the same cache
+    directory. The cache is kept under max_size bytes by evicting the least recently used entries, where reading an
+    entry updates its modification time.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = FileLock(os.path.join(cache_dir, ".lock"))
+        self._size_estimate: Optional[int] = None
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.module")
+
+    def get(self, key: str) -> Module | None:
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                module = Module.from_bytes(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning(f"Failed to read cached module {path}, will remove it.", exc_info=True)
+            self._remove(path)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return module
+
+    def put(self, key: str, module: Module):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = module.to_bytes(compress=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            self._remove(tmp_path)
+            raise
+
+        if self._size_estimate is None:
+            self._size_estimate = self._current_size()
+        else:
+            self._size_estimate += len(data)
+
+        if self._size_estimate > self.max_size:
+            self.evict()
+
+    def evict(self, target_size: Optional[int] = None):
+        """
+        Remove the least recently used entries until the cache is below target_size, defaults to 90% of max_size.
+        """
+        if target_size is None:
+            target_size = int(self.max_size * 0.9)
+
+        with self._lock:
+            entries = []
+            for path in self._entry_paths():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            size = sum(entry[1] for entry in entries)
+            removed = 0
+            for _, entry_size, path in sorted(entries):
+                if size <= target_size:
+                    break
+                self._remove(path)
+                size -= entry_size
+                removed += 1
+
+            if removed:
+                logger.info(f"Evicted {removed} modules from parse cache {self.cache_dir}, size is now {size} bytes")
+
+            self._size_estimate = size
+
+    def clear(self):
+        self.evict(target_size=0)
+
+    def _entry_paths(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                # Pickled entries were written by earlier versions
+                if file_name.endswith((".module", ".pkl")):
+                    yield os.path.join(root, file_name)
+
+    def _current_size(self) -> int:
+        size = 0
+        for path in self._entry_paths():
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+        return size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_default_cache: Optional[ModuleCache] = None
+
+
+def get_default_module_cache() -> ModuleCache | None:
+    """
+    Returns the module cache configured with the MOATLESS_PARSE_CACHE_DIR environment variable, if set. The max
+    size in bytes can be set with MOATLESS_PARSE_CACHE_MAX_SIZE.
+    """
+    global _default_cache
+
+    cache_dir = os.getenv("MOATLESS_PARSE_CACHE_DIR")
+    if not cache_dir:
+        return None
+
+    if _default_cache is None or _default_cache.cache_dir != cache_dir:
+        max_size = int(os.getenv("MOATLESS_PARSE_CACHE_MAX_SIZE", DEFAULT_MAX_SIZE))
+        _default_cache = ModuleCache(cache_dir, max_size=max_size)
+
+    return _default_cache
@@ -10,3 +10,4 @@ class JavaParser(CodeParser):
         self.queries = []
         self.queries.extend(self._build_queries("java.scm"))
         self.gpt_queries = []
+        self._init_dispatch_tables()
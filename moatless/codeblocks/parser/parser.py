@@ -1,18 +1,22 @@
+import hashlib
 import logging
 import re
+import sys
+import threading
 from collections.abc import Callable
 from dataclasses import dataclass, field
+from functools import partial
 from importlib import resources
 from typing import Optional
 
-import networkx as nx
-from tree_sitter import Language, Node, Parser
+from tree_sitter import Language, Node, Parser, Query, Tree
 
 from moatless.codeblocks.codeblocks import (
     BlockSpan,
     CodeBlock,
     CodeBlockType,
     CodeBlockTypeGroup,
+    ModuleSource,
     Parameter,
     ReferenceScope,
     Relationship,
@@ -20,12 +24,19 @@ from moatless.codeblocks.codeblocks import (
     SpanType,
 )
 from moatless.codeblocks.module import Module
+from moatless.codeblocks.parser.cache import CACHE_FORMAT_VERSION, ModuleCache
 from moatless.codeblocks.parser.comment import get_comment_symbol
 
 commented_out_keywords = ["rest of the code", "existing code", "other code"]
 child_block_types = ["ERROR", "block"]
 module_types = ["program", "module"]
 
+# Files with at least this many lines are parsed as an outline when opened as a CodeFile or ContextFile
+OUTLINE_MIN_LINES = 5000
+
+# Blocks with bodies that are left unparsed in an outline parse
+OUTLINE_BLOCK_TYPES = [CodeBlockType.FUNCTION, CodeBlockType.CONSTRUCTOR, CodeBlockType.TEST_CASE]
+
 logger = logging.getLogger(__name__)
 
 
@@ -41,6 +52,182 @@ class NodeMatch:
     query: str = None
 
 
+class CaptureIndex:
+    """
+    Captures from running a set of queries once over the whole tree, indexed by query label and match root node.
+
+    All queries in a set are compiled into one combined query, so the tree is walked once per set instead of once
+    per query and visited node.
+    """
+
+    def __init__(self, root_node: Node, combined_queries: list[tuple[Query, list[str]]]):
+        self._matches: dict[tuple[str, int, int, str], list[tuple[Node, dict]]] = {}
+
+        for query, pattern_labels in combined_queries:
+            for pattern_index, captures in query.matches(root_node):
+                label = pattern_labels[pattern_index]
+                for root in captures.get("root", []):
+                    self._matches.setdefault(self._key(label, root), []).append((root, captures))
+
+    @staticmethod
+    def _key(label: str, node: Node) -> tuple[str, int, int, str]:
+        return label, node.start_byte, node.end_byte, node.type
+
+    def find_root_match(self, node: Node, label: str) -> dict | None:
+        # Different nodes may share the same key, e.g. an ERROR node wrapping a single node of the same type
+        for root, captures in self._matches.get(self._key(label, node), []):
+            if root == node:
+                return captures
+
+        return None
+
+
+@dataclass
+class ParseContext:
+    """
+    State for a single call to CodeParser.parse(), kept off the parser so that one parser can be shared between threads.
+    """
+
+    spans_by_id: dict[str, BlockSpan] = field(default_factory=dict)
+    comments_with_no_span: list[CodeBlock] = field(default_factory=list)
+    span_counter: dict[str, int] = field(default_factory=dict)
+    previous_block: CodeBlock | None = None
+    relationship_paths: list[tuple[CodeBlock, list[str]]] | None = None  # Paths referenced by each block
+    capture_index: CaptureIndex | None = None
+    source: ModuleSource | None = None  # Block contents are decoded from the source when they're read
+
+    # Leave the bodies of functions unparsed and collect the function blocks in outline_blocks
+    outline: bool = False
+    outline_blocks: list[CodeBlock] = field(default_factory=list)
+
+    # Blocks in the same span share one frozen set of span ids until children with other spans are added
+    span_id_sets: dict[str, frozenset[str]] = field(default_factory=dict)
+
+    # Number of children and identifiers by block type of each parent block, updated with the children added since
+    # the last lookup
+    child_identifiers: dict[int, tuple[int, dict[CodeBlockType, tuple[int, set[str]]]]] = field(default_factory=dict)
+
+    def span_id_set(self, span_id: str) -> frozenset[str]:
+        span_id_set = self.span_id_sets.get(span_id)
+        if span_id_set is None:
+            span_id_set = self.span_id_sets[span_id] = frozenset([span_id])
+        return span_id_set
+
+    def unique_identifier(self, parent_block: CodeBlock, block_type: CodeBlockType, identifier: str) -> str:
+        """
+        Returns the identifier suffixed with the number of children with the same type in the parent block if another
+        child of that type already has the identifier.
+        """
+        scanned, identifiers_by_type = self.child_identifiers.get(id(parent_block), (0, {}))
+        if scanned > len(parent_block.children):
+            scanned, identifiers_by_type = 0, {}
+
+        for child in parent_block.children[scanned:]:
+            count, identifiers = identifiers_by_type.get(child.type, (0, set()))
+            identifiers.add(child.identifier)
+            identifiers_by_type[child.type] = (count + 1, identifiers)
+
+        self.child_identifiers[id(parent_block)] = (len(parent_block.children), identifiers_by_type)
+
+        count, identifiers = identifiers_by_type.get(block_type, (0, None))
+        if identifiers and identifier in identifiers:
+            return f"{identifier}_{count}"
+        return identifier
+
+
+def _find_changed_range(old: bytes, new: bytes) -> tuple[int, int, int]:
+    """
+    Returns the start byte and the old and new end bytes of the range that differs between old and new.
+    """
+    max_length = min(len(old), len(new))
+
+    # Binary search on slices to compare in C instead of byte by byte
+    low, high = 0, max_length
+    while low < high:
+        mid = (low + high + 1) // 2
+        if old[:mid] == new[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    prefix = low
+
+    low, high = 0, max_length - prefix
+    while low < high:
+        mid = (low + high + 1) // 2
+        if old[len(old) - mid :] == new[len(new) - mid :]:
+            low = mid
+        else:
+            high = mid - 1
+    suffix = low
+
+    return prefix, len(old) - suffix, len(new) - suffix
+
+
+def _point_at(content: bytes, byte: int) -> tuple[int, int]:
+    row = content.count(b"\n", 0, byte)
+    return row, byte - (content.rfind(b"\n", 0, byte) + 1)
+
+
+def _spans_within(
+    blocks: list[CodeBlock], root_block: CodeBlock, external_paths: list[tuple[BlockSpan, list[str]]] | None = None
+) -> list[BlockSpan] | None:
+    """
+    Returns the spans of the blocks if they are initiated by and only contain blocks in root_block, otherwise None.
+
+    If external_paths is given, spans may also contain blocks outside of root_block, like comments that are added to
+    the span of the next or last block, and the span and path of each such block is added to the list.
+    """
+    root_path = root_block.full_path()
+    block_ids = {id(block) for block in blocks}
+
+    spans = []
+    span_ids = set()
+    for block in blocks:
+        span = block.belongs_to_span
+        if not span:
+            return None
+        if id(span) in span_ids:
+            continue
+        if id(span.initiating_block) not in block_ids:
+            return None
+        for block_path in span.block_paths:
+            if block_path[: len(root_path)] != root_path:
+                if external_paths is None:
+                    return None
+                external_paths.append((span, block_path))
+        span_ids.add(id(span))
+        spans.append(span)
+
+    return spans
+
+
+def _find_block_node(root_node: Node, block: CodeBlock) -> Node | None:
+    """
+    Returns the node in the tree the block was created from.
+    """
+    column = len(block.pre_code) - block.pre_code.rfind("\n") - 1
+    point = (block.start_line - 1, column)
+    node = root_node.descendant_for_point_range(point, point)
+    node_type = block.properties.get("tree_sitter_type")
+    while node is not None and node.start_point[0] == block.start_line - 1:
+        if node.type == node_type and node.end_point[0] == block.end_line - 1:
+            return node
+        node = node.parent
+    return None
+
+
+def _last_code_line(node: Node) -> int:
+    """
+    Returns the line of the last token in the node that isn't in a comment.
+    """
+    while node.children:
+        children = [child for child in node.children if "comment" not in child.type]
+        if not children:
+            break
+        node = children[-1]
+    return node.end_point[0] + 1
+
+
 def _find_type(node: Node, type: str):
     for i, child in enumerate(node.children):
         if child.type == type:
@@ -81,6 +268,9 @@ class CodeParser:
         index_callback: Callable[[CodeBlock], None] | None = None,
         tokenizer: Callable[[str], list] | None = None,
         apply_gpt_tweaks: bool = False,
+        single_pass_captures: bool = True,  # Run each query once over the whole tree instead of once per node
+        module_cache: Optional[ModuleCache] = None,
+        lazy_tokens: bool = False,  # Count block tokens in one batch when they are first read instead of on parse
         debug: bool = False,
     ):
         try:
@@ -91,21 +281,30 @@ class CodeParser:
             logger.warning(f"Could not get parser for language {language}.")
             raise e
         self.apply_gpt_tweaks = apply_gpt_tweaks
+        self.single_pass_captures = single_pass_captures
         self.index_callback = index_callback
+        self.module_cache = module_cache
+        self.lazy_tokens = lazy_tokens
         self.debug = debug
         self.encoding = encoding
         self.gpt_queries = []
         self.queries = []
 
-        # TODO: How to handle these in a thread safe way?
-        self.spans_by_id = {}
-        self.comments_with_no_span = []
-        self._span_counter = {}
-        self._previous_block = None
+        # Queries grouped by the node type of their root pattern, see _build_dispatch_table()
+        self._queries_by_type = {}
+        self._wildcard_queries = []
+        self._gpt_queries_by_type = {}
+        self._gpt_wildcard_queries = []
+
+        # Query source by label, used to compile the combined queries run by CaptureIndex
+        self._query_sources = {}
+        self._combined_queries = []
+
+        # Per parse state is kept in a ParseContext, the tree-sitter parser and queries are shared and guarded by a lock
+        self._tree_sitter_lock = threading.Lock()
 
         # TODO: Move this to CodeGraph
         self._enable_code_graph = enable_code_graph
-        self._graph = None
 
         from llama_index.core import get_tokenizer
 
@@ -113,11 +312,34 @@ class CodeParser:
         self._max_tokens_in_span = max_tokens_in_span
         self._min_tokens_for_docs_span = min_tokens_for_docs_span
         self._min_lines_to_parse_block = min_lines_to_parse_block
+        self._settings_fingerprint = None
+        self._properties_cache: dict[tuple[Optional[str], str], dict] = {}
 
     @property
     def language(self):
         pass
 
+    def cache_key(self, content_bytes: bytes) -> str:
+        """
+        Returns the key of the parsed module in the module cache, a hash of the content and the parser settings.
+        """
+        if self._settings_fingerprint is None:
+            settings = [
+                CACHE_FORMAT_VERSION,
+                self.language,
+                self.encoding,
+                self._max_tokens_in_span,
+                self._min_tokens_for_docs_span,
+                self._min_lines_to_parse_block,
+                self._enable_code_graph,
+                self.apply_gpt_tweaks,
+                repr(self.tokenizer),
+                sorted(self._query_sources.items()),
+            ]
+            self._settings_fingerprint = hashlib.sha256(repr(settings).encode()).digest()
+
+        return hashlib.sha256(self._settings_fingerprint + content_bytes).hexdigest()
+
     def _extract_node_type(self, query: str):
         pattern = r"\(\s*(\w+)"
         match = re.search(pattern, query)
@@ -133,18 +355,69 @@ class CodeParser:
             for i, query in enumerate(query_list):
                 try:
                     node_type = self._extract_node_type(query)
+                    label = f"{query_file}:{i+1}"
                     parsed_queries.append(
                         (
-                            f"{query_file}:{i+1}",
+                            label,
                             node_type,
                             self.tree_language.query(query),
                         )
                     )
+                    self._query_sources[label] = query
                 except Exception as e:
                     logging.error(f"Could not parse query {query}:{i+1}")
                     raise e
             return parsed_queries
 
+    def _build_dispatch_table(self, queries: list[tuple]) -> tuple[dict[str, list[tuple]], list[tuple]]:
+        """
+        Group queries by the node type of their root pattern so that each node only runs the queries that can match it.
+
+        Wildcard queries (`_` or without a node type) are kept in a fallback bucket and are also merged into each
+        node type bucket, preserving the order from the query file as the first matching query wins.
+        """
+        wildcard_queries = [query for query in queries if not query[1] or query[1] == "_"]
+
+        queries_by_type = {}
+        for query in queries:
+            node_type = query[1]
+            if node_type and node_type != "_" and node_type not in queries_by_type:
+                queries_by_type[node_type] = [
+                    candidate for candidate in queries if candidate[1] in (node_type, "_", None)
+                ]
+
+        return queries_by_type, wildcard_queries
+
+    def _build_combined_query(self, queries: list[tuple]) -> tuple[Query, list[str]]:
+        """
+        Compile all queries into one query and return it with the label of the original query for each pattern.
+        """
+        separator = "\n\n"
+        source = ""
+        query_offsets = []
+        for label, _, _ in queries:
+            if source:
+                source += separator
+            query_offsets.append((len(source.encode(self.encoding)), label))
+            source += self._query_sources[label]
+
+        combined_query = self.tree_language.query(source)
+
+        pattern_labels = []
+        for pattern_index in range(combined_query.pattern_count):
+            start_byte = combined_query.start_byte_for_pattern(pattern_index)
+            pattern_labels.append([label for offset, label in query_offsets if offset <= start_byte][-1])
+
+        return combined_query, pattern_labels
+
+    def _init_dispatch_tables(self):
+        self._queries_by_type, self._wildcard_queries = self._build_dispatch_table(self.queries)
+        self._gpt_queries_by_type, self._gpt_wildcard_queries = self._build_dispatch_table(self.gpt_queries)
+
+        self._combined_queries = [
+            self._build_combined_query(queries) for queries in [self.gpt_queries, self.queries] if queries
+        ]
+
     def parse_code(
         self,
         content_bytes: bytes,
@@ -154,15 +427,22 @@ class CodeParser:
         file_path: Optional[str] = None,
         parent_block: CodeBlock | None = None,
         current_span: BlockSpan | None = None,
+        context: ParseContext | None = None,
     ) -> tuple[CodeBlock, Node, BlockSpan]:
-        node_match = self.find_in_tree(node)
+        if context is None:
+            context = ParseContext(relationship_paths=[] if self._enable_code_graph else None)
+        if context.source is None:
+            context.source = ModuleSource(content_bytes, self.encoding)
+
+        node_match = self.find_in_tree(node, context=context)
 
         if not parent_block and node.children:
             node_match.first_child = node.children[0]
         elif node.type == "ERROR":
             node_match.block_type = CodeBlockType.ERROR
 
-        pre_code = content_bytes[start_byte : node.start_byte].decode(self.encoding)
+        # Mostly whitespace that is repeated over many blocks
+        pre_code = sys.intern(context.source.decode(start_byte, node.start_byte))
         end_line = node.end_point[0]
 
         # Skip parsing of non structure blocks if they have less lines than min_lines_to_parse_implementation
@@ -175,22 +455,30 @@ class CodeParser:
         ):
             node_match.first_child = None
 
+        # The body of a function in an outline parse is kept in the content of the function block
+        outlined = bool(
+            context.outline
+            and parent_block
+            and node_match.first_child
+            and node_match.block_type in OUTLINE_BLOCK_TYPES
+        )
+        if outlined:
+            node_match.first_child = None
+
         if node_match.first_child:
             end_byte = self.get_previous(node_match.first_child, node)
         else:
             end_byte = node.end_byte
 
-        code = content_bytes[node.start_byte : end_byte].decode(self.encoding)
-
         if node_match.identifier_node:
-            identifier = content_bytes[
-                node_match.identifier_node.start_byte : node_match.identifier_node.end_byte
-            ].decode(self.encoding)
+            identifier = sys.intern(
+                context.source.decode(node_match.identifier_node.start_byte, node_match.identifier_node.end_byte)
+            )
         else:
             identifier = None
 
         if self._enable_code_graph:
-            relationships = self.create_references(code, content_bytes, identifier, node_match)
+            relationships = self.create_references(content_bytes, identifier, node_match)
             parameters = self.create_parameters(content_bytes, node_match, relationships)
         else:
             relationships = []
@@ -201,81 +489,92 @@ class CodeParser:
                 type=node_match.block_type,
                 identifier=identifier,
                 parent=parent_block,
-                previous=self._previous_block,
+                previous=context.previous_block,
                 parameters=parameters,
                 relationships=relationships,
-                span_ids=set(),
+                span_ids=frozenset(),
                 start_line=node.start_point[0] + 1,
                 end_line=end_line + 1,
                 pre_code=pre_code,
-                content=code,
-                tokens=self._count_tokens(code),
+                content=None,
+                tokens=None,
                 children=[],
-                properties={
-                    "query": node_match.query,
-                    "tree_sitter_type": node.type,
-                },
+                properties=self._block_properties(node_match.query, node.type),
             )
+            code_block._source = context.source
+            code_block._start_byte = node.start_byte
+            code_block._end_byte = end_byte
+            if not self.lazy_tokens or parent_block.type == CodeBlockType.MODULE:
+                code_block._tokens = self._count_tokens(code_block.content)
+
+            context.previous_block.next = code_block
+            context.previous_block = code_block
 
-            self._previous_block.next = code_block
-            self._previous_block = code_block
+            if outlined:
+                context.outline_blocks.append(code_block)
 
             self.pre_process(code_block, node_match)
 
             if code_block.identifier:
                 identifier = code_block.identifier
             else:
-                if code_block.content:
-                    identifier = code_block.content.split("\n")[0].strip()[0:25]
-                    identifier = re.sub(r"\W+", "_", identifier)
+                if end_byte > node.start_byte:
+                    first_line_end = content_bytes.find(b"\n", node.start_byte, end_byte)
+                    identifier = context.source.decode(
+                        node.start_byte, end_byte if first_line_end == -1 else first_line_end
+                    )
+                    identifier = re.sub(r"\W+", "_", identifier.strip()[0:25])
 
                 if not identifier:
                     identifier = str(code_block.type).lower()
 
             # Set a unique identifier on each code block
-            # TODO: Just count occurrences of the identifier
-            existing_identifiers = [b.identifier for b in parent_block.children if b.type == code_block.type]
-            if identifier in existing_identifiers:
-                code_block.identifier = f"{identifier}_{len(existing_identifiers)}"
-
-            else:
-                code_block.identifier = identifier
+            code_block.identifier = context.unique_identifier(parent_block, code_block.type, identifier)
 
             if (
                 code_block.type == CodeBlockType.COMMENT
                 and current_span
                 and current_span.span_type != SpanType.DOCUMENTATION
-                and len(current_span.block_paths) > 1
+                and (
+                    len(current_span.block_paths) > 1
+                    # An outlined function would have its body in the span in a full parse
+                    or (context.outline_blocks and context.outline_blocks[-1].belongs_to_span is current_span)
+                )
             ):
                 # TODO: Find a more robust way to connect comments to the right span
-                self.comments_with_no_span.append(code_block)
+                context.comments_with_no_span.append(code_block)
             else:
-                new_span = self._create_new_span(current_span=current_span, block=code_block)
+                new_span = self._create_new_span(current_span=current_span, block=code_block, context=context)
                 if new_span:
+                    # Only tokens in spans on module level are used to split spans, the others can be counted lazily
+                    if self.lazy_tokens and new_span.parent_block_path:
+                        new_span.tokens = None
+
                     current_span = new_span
-                    self.spans_by_id[current_span.span_id] = current_span
-                    code_block.span_ids.add(current_span.span_id)
+                    context.spans_by_id[current_span.span_id] = current_span
                 else:
                     current_span.end_line = code_block.end_line
 
-                for comment_block in self.comments_with_no_span:
+                for comment_block in context.comments_with_no_span:
                     comment_block.belongs_to_span = current_span
                     current_span.block_paths.append(comment_block.full_path())
-                    current_span.tokens += comment_block.tokens
+                    self._add_span_tokens(current_span, comment_block)
 
                 current_span.block_paths.append(code_block.full_path())
-                current_span.tokens += code_block.tokens
+                self._add_span_tokens(current_span, code_block)
+
+                # The span would end with the last block in the body in a full parse, trailing comments are not included
+                if outlined:
+                    current_span.end_line = _last_code_line(node)
 
                 code_block.belongs_to_span = current_span
-                code_block.span_ids.add(current_span.span_id)
+                code_block.span_ids = context.span_id_set(current_span.span_id)
 
-                self.comments_with_no_span = []
+                context.comments_with_no_span = []
 
             if self._enable_code_graph:
-                self._graph.add_node(code_block.path_string(), block=code_block)
-
-                for relationship in relationships:
-                    self._graph.add_edge(code_block.path_string(), ".".join(relationship.path))
+                # The paths are recorded before post processing resolves references on self and super()
+                context.relationship_paths.extend((code_block, relationship.path) for relationship in relationships)
 
         else:
             current_span = None
@@ -294,22 +593,25 @@ class CodeParser:
                     "tree_sitter_type": node.type,
                 },
             )
-            self._previous_block = code_block
+            code_block._parsing = True
+            code_block._source = context.source
+            context.previous_block = code_block
 
         next_node = node_match.first_child
 
-        self.debug_log(
-            f"""Created code block
-    content: {code_block.content[:50]} 
-    block_type: {code_block.type} 
-    node_type: {node.type}
-    next_node: {next_node.type if next_node else "none"}
-    first_child: {node_match.first_child}
-    last_child: {node_match.last_child}
-    start_byte: {start_byte}
-    node.start_byte: {node.start_byte}
-    node.end_byte: {node.end_byte}"""
-        )
+        if self.debug:
+            self.debug_log(
+                f"""Created code block
+        content: {code_block.content[:50]} 
+        block_type: {code_block.type} 
+        node_type: {node.type}
+        next_node: {next_node.type if next_node else "none"}
+        first_child: {node_match.first_child}
+        last_child: {node_match.last_child}
+        start_byte: {start_byte}
+        node.start_byte: {node.start_byte}
+        node.end_byte: {node.end_byte}"""
+            )
 
         index = 0
 
@@ -320,7 +622,8 @@ class CodeParser:
                 next_node = next_node.children[0]
                 code_block.type = CodeBlockType.ERROR
 
-            self.debug_log(f"next  [{level}]: -> {next_node.type} - {next_node.start_byte}")
+            if self.debug:
+                self.debug_log(f"next  [{level}]: -> {next_node.type} - {next_node.start_byte}")
 
             child_block, child_last_node, child_span = self.parse_code(
                 content_bytes,
@@ -329,6 +632,7 @@ class CodeParser:
                 level=level + 1,
                 parent_block=code_block,
                 current_span=current_span,
+                context=context,
             )
 
             if not current_span or child_span.span_id != current_span.span_id:
@@ -339,19 +643,21 @@ class CodeParser:
             index += 1
 
             if child_last_node:
-                self.debug_log(f"next  [{level}]: child_last_node -> {child_last_node}")
+                if self.debug:
+                    self.debug_log(f"next  [{level}]: child_last_node -> {child_last_node}")
                 next_node = child_last_node
 
             end_byte = next_node.end_byte
 
-            self.debug_log(
-                f"""next  [{level}]
-    last_child -> {node_match.last_child}
-    next_node -> {next_node}
-    next_node.next_sibling -> {next_node.next_sibling}
-    end_byte -> {end_byte}
-"""
-            )
+            if self.debug:
+                self.debug_log(
+                    f"""next  [{level}]
+        last_child -> {node_match.last_child}
+        next_node -> {next_node}
+        next_node.next_sibling -> {next_node.next_sibling}
+        end_byte -> {end_byte}
+    """
+                )
             if next_node == node_match.last_child:
                 break
             elif next_node.next_sibling:
@@ -360,15 +666,16 @@ class CodeParser:
                 next_parent_node = self.get_parent_next(next_node, node_match.check_child or node)
                 next_node = None if next_parent_node == next_node else next_parent_node
 
-        self.debug_log(f"end   [{level}]: {code_block.content}")
+        if self.debug:
+            self.debug_log(f"end   [{level}]: {code_block.content}")
 
-        for comment_block in self.comments_with_no_span:
+        for comment_block in context.comments_with_no_span:
             comment_block.belongs_to_span = current_span
-            comment_block.span_ids.add(current_span.span_id)
+            comment_block.span_ids = comment_block.span_ids | context.span_id_set(current_span.span_id)
             current_span.block_paths.append(comment_block.full_path())
-            current_span.tokens += comment_block.tokens
+            self._add_span_tokens(current_span, comment_block)
 
-        self.comments_with_no_span = []
+        context.comments_with_no_span = []
 
         self.post_process(code_block)
 
@@ -395,50 +702,50 @@ class CodeParser:
             keyword in comment.lower() for keyword in commented_out_keywords
         )
 
-    def find_in_tree(self, node: Node) -> NodeMatch | None:
+    def find_in_tree(self, node: Node, context: ParseContext | None = None) -> NodeMatch | None:
         if self.apply_gpt_tweaks:
-            match = self.find_match_with_gpt_tweaks(node)
+            match = self.find_match_with_gpt_tweaks(node, context=context)
             if match:
-                self.debug_log(f"find_in_tree() GPT match: {match.block_type} on {node}")
+                if self.debug:
+                    self.debug_log(f"find_in_tree() GPT match: {match.block_type} on {node}")
                 return match
 
         if not node.parent and node.children:
             return NodeMatch(block_type=CodeBlockType.MODULE, first_child=node.children[0])
 
-        match = self.find_match(node)
+        match = self.find_match(node, context=context)
         if match:
-            self.debug_log(f"find_in_tree() Found match on node type {node.type} with block type {match.block_type}")
+            if self.debug:
+                self.debug_log(f"find_in_tree() Found match on node type {node.type} with block type {match.block_type}")
             return match
         else:
-            self.debug_log(
-                f"find_in_tree() Found no match on node type {node.type} set block type {CodeBlockType.CODE}"
-            )
+            if self.debug:
+                self.debug_log(
+                    f"find_in_tree() Found no match on node type {node.type} set block type {CodeBlockType.CODE}"
+                )
             return NodeMatch(block_type=CodeBlockType.CODE)
 
-    def find_match_with_gpt_tweaks(self, node: Node) -> NodeMatch | None:
-        for label, node_type, query in self.gpt_queries:
-            if node_type and node.type != node_type and node_type != "_":
-                continue
-            match = self._find_match(node, query, label, capture_from_parent=True)
+    def find_match_with_gpt_tweaks(self, node: Node, context: ParseContext | None = None) -> NodeMatch | None:
+        for label, node_type, query in self._gpt_queries_by_type.get(node.type, self._gpt_wildcard_queries):
+            match = self._find_match(node, query, label, capture_from_parent=True, context=context)
             if match:
-                self.debug_log(f"find_match_with_gpt_tweaks() Found match on node {node.type} with query {label}")
+                if self.debug:
+                    self.debug_log(f"find_match_with_gpt_tweaks() Found match on node {node.type} with query {label}")
                 if not match.query:
                     match.query = label
                 return match
 
         return None
 
-    def find_match(self, node: Node) -> NodeMatch | None:
-        self.debug_log(f"find_match() node type {node.type}")
+    def find_match(self, node: Node, context: ParseContext | None = None) -> NodeMatch | None:
+        if self.debug:
+            self.debug_log(f"find_match() node type {node.type}")
 
-        queries = 0
-        for label, node_type, query in self.queries:
-            if node_type and node.type != node_type and node_type != "_":
-                continue
-            match = self._find_match(node, query, label)
-            queries += 1
+        for label, node_type, query in self._queries_by_type.get(node.type, self._wildcard_queries):
+            match = self._find_match(node, query, label, context=context)
             if match:
-                self.debug_log(f"find_match() Found match on node {node.type} with query {label}")
+                if self.debug:
+                    self.debug_log(f"find_match() Found match on node {node.type} with query {label}")
                 if not match.query:
                     match.query = label
                 return match
@@ -453,54 +760,72 @@ class CodeParser:
                         return match
         return None
 
-    def _find_match(self, node: Node, query, label: str, capture_from_parent: bool = False) -> NodeMatch | None:
-        if capture_from_parent:
-            matches = query.matches(node.parent)
+    def _find_match(
+        self,
+        node: Node,
+        query,
+        label: str,
+        capture_from_parent: bool = False,
+        context: ParseContext | None = None,
+    ) -> NodeMatch | None:
+        if context and context.capture_index:
+            captures = context.capture_index.find_root_match(node, label)
         else:
-            matches = query.matches(node)
+            with self._tree_sitter_lock:
+                if capture_from_parent:
+                    matches = query.matches(node.parent)
+                else:
+                    matches = query.matches(node)
 
-        node_match = NodeMatch()
+            if not matches:
+                return None
 
-        if not matches:
-            return None
+            captures = self._find_root_node(node, matches)
 
-        captures = self._find_root_node(node, matches)
         if not captures:
             return None
 
+        node_match = NodeMatch()
+
         root_node = captures["root"]
         for tag, found_nodes in captures.items():
             found_node = found_nodes[0]
-            self.debug_log(f"[{label}] Found tag {tag} on node {found_node}")
+            if self.debug:
+                self.debug_log(f"[{label}] Found tag {tag} on node {found_node}")
 
             if tag == "root" and root_node and node == found_node:
-                self.debug_log(f"[{label}] Root node {found_node}")
+                if self.debug:
+                    self.debug_log(f"[{label}] Root node {found_node}")
                 root_node = found_node
 
             if tag == "no_children" and found_node.children:
                 return None
 
             if tag == "check_child":
-                self.debug_log(f"[{label}] Check child {found_node}")
-                node_match = self.find_match(found_node)
+                if self.debug:
+                    self.debug_log(f"[{label}] Check child {found_node}")
+                node_match = self.find_match(found_node, context=context)
                 if node_match:
                     node_match.check_child = found_node
                 return node_match
 
             if tag == "parse_child":
-                self.debug_log(f"[{label}] Parse child {found_node}")
+                if self.debug:
+                    self.debug_log(f"[{label}] Parse child {found_node}")
 
-                child_match = self.find_match(found_node)
+                child_match = self.find_match(found_node, context=context)
                 if child_match:
                     if child_match.relationships:
-                        self.debug_log(
-                            f"[{label}] Found {len(child_match.relationships)} references on child {found_node}"
-                        )
+                        if self.debug:
+                            self.debug_log(
+                                f"[{label}] Found {len(child_match.relationships)} references on child {found_node}"
+                            )
                         node_match.relationships = child_match.relationships
                     if child_match.parameters:
-                        self.debug_log(
-                            f"[{label}] Found {len(child_match.parameters)} parameters on child {found_node}"
-                        )
+                        if self.debug:
+                            self.debug_log(
+                                f"[{label}] Found {len(child_match.parameters)} parameters on child {found_node}"
+                            )
                         node_match.parameters.extend(child_match.parameters)
                     if child_match.first_child:
                         node_match.first_child = child_match.first_child
@@ -528,12 +853,13 @@ class CodeParser:
                 node_match.block_type = CodeBlockType.from_string(tag)
 
         if node_match.block_type:
-            self.debug_log(f"[{label}] Return match with type {node_match.block_type} for node {node}")
+            if self.debug:
+                self.debug_log(f"[{label}] Return match with type {node_match.block_type} for node {node}")
             return node_match
 
         return None
 
-    def create_references(self, code, content_bytes, identifier, node_match):
+    def create_references(self, content_bytes, identifier, node_match):
         references = []
         if node_match.block_type == CodeBlockType.IMPORT and node_match.relationships:
             module_nodes = [ref for ref in node_match.relationships if ref[1] == "reference.module"]
@@ -582,7 +908,7 @@ class CodeParser:
 
                 if not reference_id_path:
                     logger.warning(
-                        f"Empty reference_id_path ({reference_id_path}) for code `{code}` in reference node {reference} with value {reference_id}"
+                        f"Empty reference_id_path ({reference_id_path}) in reference node {reference} with value {reference_id}"
                     )
                     continue
 
@@ -653,10 +979,12 @@ class CodeParser:
             return node.start_byte
 
     def get_parent_next(self, node: Node, orig_node: Node):
-        self.debug_log(f"get_parent_next: {node.type} - {orig_node.type}")
+        if self.debug:
+            self.debug_log(f"get_parent_next: {node.type} - {orig_node.type}")
         if node != orig_node:
             if node.next_sibling:
-                self.debug_log(f"get_parent_next: node.next_sibling -> {node.next_sibling}")
+                if self.debug:
+                    self.debug_log(f"get_parent_next: node.next_sibling -> {node.next_sibling}")
                 return node.next_sibling
             else:
                 return self.get_parent_next(node.parent, orig_node)
@@ -669,36 +997,380 @@ class CodeParser:
             return any(self.has_error(child) for child in node.children)
         return False
 
-    def parse(self, content, file_path: Optional[str] = None) -> Module:
+    def parse(self, content, file_path: Optional[str] = None, keep_tree: bool = False, outline: bool = False) -> Module:
+        """
+        Parse the content to a module. Set keep_tree to keep the tree-sitter tree on the module, which is needed to
+        parse changes incrementally with reparse() but takes about as much memory as the code blocks.
+
+        Set outline to only parse classes and function signatures. The body of each function is kept as the content
+        of the function block, and is parsed when a span, path or line within it is looked up on the module.
+        """
+        content_in_bytes = self._to_bytes(content)
+
+        # The index callback must be called for each block, and cached modules don't have a tree or the content to
+        # expand outlined blocks
+        use_cache = self.module_cache is not None and not self.index_callback and not keep_tree and not outline
+        if use_cache:
+            cache_key = self.cache_key(content_in_bytes)
+            module = self.module_cache.get(cache_key)
+            if module:
+                module.file_path = file_path
+                return module
+
+        module = self._parse_module(content_in_bytes, file_path=file_path, outline=outline)
+        if not keep_tree:
+            module._tree = None
+
+        if use_cache:
+            try:
+                self.module_cache.put(cache_key, module)
+            except Exception:
+                logger.warning(f"Failed to write parsed module {file_path} to cache.", exc_info=True)
+
+        return module
+
+    def reparse(self, module: Module, old_content, content, file_path: Optional[str] = None) -> Module:
+        """
+        Parse the new content of a module that was parsed from old_content.
+
+        The tree-sitter tree kept on the module is edited with the changed byte range and parsed incrementally. If the
+        change is within a class or function, only the code blocks of the innermost such structure are rebuilt and
+        spliced into the existing module, which is then returned. Blocks and span ids outside of it are kept as they
+        are. Otherwise a new module is parsed from the incrementally parsed tree.
+
+        The previous module should not be used after calling this method.
+        """
+        old_bytes = self._to_bytes(old_content)
+        content_in_bytes = self._to_bytes(content)
+        if file_path is None:
+            file_path = module.file_path
+
+        outline = module._outline_blocks is not None
+        if module._tree is None or self.index_callback:
+            return self.parse(content_in_bytes, file_path=file_path, keep_tree=True, outline=outline)
+
+        if old_bytes == content_in_bytes:
+            module.file_path = file_path
+            return module
+
+        start_byte, old_end_byte, new_end_byte = _find_changed_range(old_bytes, content_in_bytes)
+
+        old_tree = module._tree
+        candidates = []
+        if not old_tree.root_node.has_error:
+            candidates = self._find_changed_structures(module, old_tree.root_node, start_byte, old_end_byte)
+
+        module._tree = None
+        old_tree.edit(
+            start_byte=start_byte,
+            old_end_byte=old_end_byte,
+            new_end_byte=new_end_byte,
+            start_point=_point_at(old_bytes, start_byte),
+            old_end_point=_point_at(old_bytes, old_end_byte),
+            new_end_point=_point_at(content_in_bytes, new_end_byte),
+        )
+
+        with self._tree_sitter_lock:
+            tree = self.tree_parser.parse(content_in_bytes, old_tree)
+
+        if candidates and not tree.root_node.has_error:
+            source = ModuleSource(content_in_bytes, self.encoding)
+            line_delta = content_in_bytes.count(b"\n") - old_bytes.count(b"\n")
+            for block, old_node in reversed(candidates):
+                if self._rebuild_structure(
+                    module, block, tree, source, old_node, new_end_byte - old_end_byte, line_delta
+                ):
+                    module.file_path = file_path
+                    module._tree = tree
+                    if outline:
+                        module._expander = partial(self._expand_outline, content_in_bytes)
+                    return module
+
+        return self._parse_module(content_in_bytes, file_path=file_path, tree=tree, outline=outline)
+
+    def _to_bytes(self, content) -> bytes:
         if isinstance(content, str):
-            content_in_bytes = bytes(content, self.encoding)
+            return bytes(content, self.encoding)
         elif isinstance(content, bytes):
-            content_in_bytes = content
+            return content
         else:
             raise ValueError("Content must be either a string or bytes")
 
-        # TODO: make thread safe?
-        self.spans_by_id = {}
-        self._span_counter = {}
+    def _parse_module(
+        self,
+        content_in_bytes: bytes,
+        file_path: Optional[str] = None,
+        tree: Tree | None = None,
+        outline: bool = False,
+    ) -> Module:
+        with self._tree_sitter_lock:
+            if tree is None:
+                tree = self.tree_parser.parse(content_in_bytes)
+            root_node = tree.walk().node
+
+            # Running the queries over the whole tree would also match the nodes in unparsed function bodies
+            if self.single_pass_captures and not outline:
+                capture_index = CaptureIndex(root_node, self._combined_queries)
+            else:
+                capture_index = None
 
         # TODO: Should me moved to a central CodeGraph
-        if self._enable_code_graph:
-            self._graph = nx.DiGraph()
-
-        tree = self.tree_parser.parse(content_in_bytes)
-        root_node = tree.walk().node
+        context = ParseContext(
+            relationship_paths=[] if self._enable_code_graph else None,
+            capture_index=capture_index,
+            outline=outline,
+        )
 
-        module, _, _ = self.parse_code(content_in_bytes, root_node, file_path=file_path)
-        module.spans_by_id = self.spans_by_id
+        module, _, _ = self.parse_code(content_in_bytes, root_node, file_path=file_path, context=context)
+        module._parsing = False
+        module.spans_by_id = context.spans_by_id
         module.file_path = file_path
         module.language = self.language
-        module._graph = self._graph
+        module._relationship_paths = context.relationship_paths
+        module._tree = tree
+        if self.lazy_tokens:
+            module._token_counter = self._count_tokens_batch
+        if outline:
+            module._outline_blocks = {block.path_string(): block for block in context.outline_blocks}
+            module._expander = partial(self._expand_outline, content_in_bytes)
         return module
 
+    def _expand_outline(self, content_bytes: bytes, module: Module, blocks: list[CodeBlock]):
+        """
+        Parse the bodies of outlined function blocks and splice them into the module. If a function can't be rebuilt on
+        its own, for example if it shares a span with the blocks before it, the whole module is parsed again.
+        """
+        # The tree is kept on the module once parsed, as functions are usually expanded one at a time
+        if module._tree is None:
+            with self._tree_sitter_lock:
+                module._tree = self.tree_parser.parse(content_bytes)
+        tree = module._tree
+
+        for block in blocks:
+            if module._outline_blocks.get(block.path_string()) is not block:
+                continue
+
+            node = _find_block_node(tree.root_node, block)
+            if node is None or not self._rebuild_structure(
+                module, block, tree, module._source, (node.start_byte, node.end_byte, node.type), 0, 0
+            ):
+                logger.debug(f"Could not expand {block.path_string()} in {module.file_path}, parse the full module.")
+                module._replace_with(self._parse_module(content_bytes, file_path=module.file_path, tree=tree))
+
+                # Changes are still parsed as an outline, see reparse()
+                module._outline_blocks = {}
+                return
+
+    def _find_changed_structures(
+        self, module: Module, root_node: Node, start_byte: int, end_byte: int
+    ) -> list[tuple[CodeBlock, tuple[int, int, int]]]:
+        """
+        Returns the class and function blocks containing the byte range, from the outermost to the innermost, with the
+        start byte, end byte and type of their nodes in the tree.
+        """
+        structures = []
+        parent_block = module
+        node = root_node
+        while True:
+            node = next(
+                (child for child in node.children if child.start_byte <= start_byte and end_byte <= child.end_byte),
+                None,
+            )
+            if not node:
+                return structures
+
+            block = next(
+                (
+                    child
+                    for child in parent_block.children
+                    if child.start_line == node.start_point[0] + 1
+                    and child.end_line == node.end_point[0] + 1
+                    and child.properties.get("tree_sitter_type") == node.type
+                ),
+                None,
+            )
+            if block:
+                if block.type.group == CodeBlockTypeGroup.STRUCTURE:
+                    structures.append((block, (node.start_byte, node.end_byte, node.type)))
+                parent_block = block
+
+    def _rebuild_structure(
+        self,
+        module: Module,
+        old_block: CodeBlock,
+        tree: Tree,
+        source: ModuleSource,
+        old_node: tuple[int, int, str],
+        byte_delta: int,
+        line_delta: int,
+    ) -> bool:
+        """
+        Rebuild a class or function block from the new tree and splice it into the module.
+
+        Returns False without changing the module if the change can't be isolated to the block, for example if it
+        changed the identifier of the block or the block shares a span with blocks outside of it.
+        """
+        old_start_byte, old_end_byte, node_type = old_node
+        parent_block = old_block.parent
+
+        node = tree.root_node.descendant_for_byte_range(old_start_byte, old_end_byte + byte_delta)
+        while node and node.type != node_type and node.parent:
+            node = node.parent
+        if (
+            not node
+            or node.type != node_type
+            or node.start_byte != old_start_byte
+            or node.end_byte != old_end_byte + byte_delta
+        ):
+            return False
+
+        old_blocks = [old_block] + old_block.get_all_child_blocks()
+        external_paths = []
+        old_spans = _spans_within(old_blocks, old_block, external_paths)
+        if old_spans is None:
+            return False
+
+        # Comments before or after the block that were added to its spans are added to the new spans with the same id
+        external_comments = []
+        if external_paths:
+            blocks_by_path = module._get_indexes().blocks_by_path
+            for span, path in external_paths:
+                comment_block = blocks_by_path.get(tuple(path))
+                if comment_block is None or comment_block.type.group != CodeBlockTypeGroup.COMMENT:
+                    return False
+                external_comments.append((span.span_id, comment_block))
+
+        with self._tree_sitter_lock:
+            capture_index = CaptureIndex(node, self._combined_queries) if self.single_pass_captures else None
+
+        # Functions are parsed in full when they are rebuilt, and classes are parsed as an outline in outline modules
+        context = ParseContext(
+            relationship_paths=[] if self._enable_code_graph else None,
+            capture_index=capture_index,
+            source=source,
+            previous_block=old_block.previous,
+            outline=module._outline_blocks is not None and old_block.type not in OUTLINE_BLOCK_TYPES,
+        )
+
+        # Build the block as in a full parse, where only the preceding siblings have been added to the parent
+        index = parent_block.children.index(old_block)
+        children = parent_block.children
+        parent_block.children = children[:index]
+        module._parsing = True
+        try:
+            new_block, last_node, _ = self.parse_code(
+                source.data,
+                node,
+                start_byte=old_start_byte - len(old_block.pre_code.encode(self.encoding)),
+                level=len(old_block.full_path()),
+                parent_block=parent_block,
+                current_span=old_block.previous.belongs_to_span if old_block.previous else None,
+                context=context,
+            )
+        finally:
+            parent_block.children = children
+            module._parsing = False
+
+        new_blocks = [new_block] + new_block.get_all_child_blocks()
+        if (
+            new_block.identifier != old_block.identifier
+            or new_block.type != old_block.type
+            or (last_node or node).end_byte != node.end_byte
+            or context.comments_with_no_span
+            or _spans_within(new_blocks, new_block) is None
+            or any(span_id not in context.spans_by_id for span_id, _ in external_comments)
+        ):
+            if old_block.previous:
+                old_block.previous.next = old_block
+            return False
+
+        # Validation errors on the block itself are set by post processing of the parent
+        new_block.validation_errors = old_block.validation_errors
+
+        last_old_block = old_blocks[-1]
+        last_new_block = new_blocks[-1]
+        last_new_block.next = last_old_block.next
+        if last_old_block.next:
+            last_old_block.next.previous = last_new_block
+
+        parent_block.children[index] = new_block
+
+        old_end_line = old_block.end_line
+        old_span_ids = {span.span_id for span in old_spans}
+        ancestor = new_block
+        while ancestor.parent:
+            sibling_index = ancestor.parent.children.index(ancestor)
+            ancestor = ancestor.parent
+            ancestor.span_ids = (ancestor.span_ids - old_span_ids) | new_block.span_ids
+            ancestor.end_line += line_delta
+
+            if line_delta:
+                for sibling in ancestor.children[sibling_index + 1 :]:
+                    for block in [sibling] + sibling.get_all_child_blocks():
+                        block.start_line += line_delta
+                        block.end_line += line_delta
+
+        # The contents of the other blocks are the same in the new source, at shifted offsets after the block
+        if module._source is not source:
+            old_source = module._source
+            for block in [module] + module.get_all_child_blocks():
+                if block._source is old_source:
+                    block._source = source
+                    if block._start_byte >= old_end_byte:
+                        block._start_byte += byte_delta
+                        block._end_byte += byte_delta
+
+        spans_by_id = {}
+        for span_id, span in module.spans_by_id.items():
+            if span_id in old_span_ids:
+                if span_id == old_block.belongs_to_span.span_id:
+                    spans_by_id.update(context.spans_by_id)
+                continue
+            if span.start_line > old_end_line:
+                span.start_line += line_delta
+            if span.end_line > old_end_line:
+                span.end_line += line_delta
+            spans_by_id[span_id] = span
+        module.spans_by_id = spans_by_id
+
+        # The comments are in the order of the old block paths, leading comments are kept before the block
+        leading_comments = {}
+        for span_id, comment_block in external_comments:
+            span = context.spans_by_id[span_id]
+            if comment_block.start_line < new_block.start_line:
+                index = leading_comments.get(span_id, 0)
+                span.block_paths.insert(index, comment_block.full_path())
+                leading_comments[span_id] = index + 1
+            else:
+                span.block_paths.append(comment_block.full_path())
+            comment_block.belongs_to_span = span
+            self._add_span_tokens(span, comment_block)
+
+        if module._relationship_paths is not None:
+            # Relationships are only added to after parsing, blocks without any have no recorded paths
+            if any(block.relationships for block in old_blocks):
+                old_block_ids = {id(block) for block in old_blocks}
+                module._relationship_paths = [
+                    (block, path) for block, path in module._relationship_paths if id(block) not in old_block_ids
+                ]
+            module._relationship_paths.extend(context.relationship_paths)
+
+        if module._outline_blocks is not None:
+            for block in old_blocks:
+                if module._outline_blocks.get(block.path_string()) is block:
+                    del module._outline_blocks[block.path_string()]
+            module._outline_blocks.update((block.path_string(), block) for block in context.outline_blocks)
+
+        parent_block._children_changed()
+
+        return True
+
     def get_content(self, node: Node, content_bytes: bytes) -> str:
         return content_bytes[node.start_byte : node.end_byte].decode(self.encoding)
 
-    def _create_new_span(self, current_span: BlockSpan | None, block: CodeBlock) -> BlockSpan | None:
+    def _create_new_span(
+        self, current_span: BlockSpan | None, block: CodeBlock, context: ParseContext
+    ) -> BlockSpan | None:
         # Set documentation phase on comments in the start of structure blocks if more than min_tokens_for_docs_span
         # TODO: This is isn't valid in other languages, try to set block type to docstring?
         block_types_with_document_span = [CodeBlockType.MODULE]  # TODO: Make this configurable
@@ -710,7 +1382,7 @@ class CodeParser:
             or block.parent.type == CodeBlockType.MODULE
         ):
             span_type = SpanType.INITATION
-            span_id = self._create_span_id(block, label="imports")
+            span_id = self._create_span_id(block, context, label="imports")
 
         elif block.type == CodeBlockType.COMMENT and (
             not current_span
@@ -718,7 +1390,7 @@ class CodeParser:
             and (current_span.span_type != SpanType.IMPLEMENTATION or current_span.index == 0)
         ):
             span_type = SpanType.DOCUMENTATION
-            span_id = self._create_span_id(block, label="docstring")
+            span_id = self._create_span_id(block, context, label="docstring")
 
         # Set initation phase when block is a class or constructor, and until first function:
         elif block.type in [CodeBlockType.CLASS, CodeBlockType.CONSTRUCTOR] or (
@@ -729,11 +1401,11 @@ class CodeParser:
             and block.type not in [CodeBlockType.FUNCTION]
         ):
             span_type = SpanType.INITATION
-            span_id = self._create_span_id(block)
+            span_id = self._create_span_id(block, context)
 
         else:
             span_type = SpanType.IMPLEMENTATION
-            span_id = self._create_span_id(block)
+            span_id = self._create_span_id(block, context)
 
         # if no curent_span exists, expected to be on Module level
         if not current_span:
@@ -817,8 +1489,8 @@ class CodeParser:
         # Create new span if the current is too large and the parent block is a structure block
         split_on_block_type = [CodeBlockType.MODULE]  # Only split on Module level
         if (
-            current_span.tokens + block.sum_tokens() > self._max_tokens_in_span
-            and block.parent.type in split_on_block_type
+            block.parent.type in split_on_block_type
+            and current_span.tokens + block.sum_tokens() > self._max_tokens_in_span
         ):
             current_span.is_partial = True
 
@@ -835,7 +1507,7 @@ class CodeParser:
 
         return None
 
-    def _create_span_id(self, block: CodeBlock, label: Optional[str] = None):
+    def _create_span_id(self, block: CodeBlock, context: ParseContext, label: Optional[str] = None):
         if block.type.group == CodeBlockTypeGroup.STRUCTURE:
             structure_block = block
         else:
@@ -852,19 +1524,49 @@ class CodeParser:
         elif not span_id:
             span_id = "impl"
 
-        if span_id in self._span_counter:
-            self._span_counter[span_id] += 1
-            span_id += f":{self._span_counter[span_id]}"
+        if span_id in context.span_counter:
+            context.span_counter[span_id] += 1
+            span_id += f":{context.span_counter[span_id]}"
         else:
-            self._span_counter[span_id] = 1
+            context.span_counter[span_id] = 1
 
         return span_id
 
-    def _count_tokens(self, content: str):
+    def _block_properties(self, query: Optional[str], tree_sitter_type: str) -> dict:
+        # The properties are shared by all blocks created from the same query and node type to save memory
+        key = (query, tree_sitter_type)
+        properties = self._properties_cache.get(key)
+        if properties is None:
+            properties = self._properties_cache.setdefault(
+                key, {"query": query, "tree_sitter_type": tree_sitter_type}
+            )
+        return properties
+
+    def _count_tokens(self, content: str) -> int:
         if not self.tokenizer:
             return 0
         return len(self.tokenizer(content))
 
+    def _count_tokens_batch(self, contents: list[str]) -> list[int]:
+        if not self.tokenizer:
+            return [0] * len(contents)
+
+        # Many blocks share the same content, like "pass" or "return". tiktoken's encode_batch() isn't used as it
+        # submits each content to a thread pool, which is several times slower than encoding block sized contents.
+        tokens_by_content = {}
+        for content in contents:
+            if content not in tokens_by_content:
+                tokens_by_content[content] = len(self.tokenizer(content))
+        return [tokens_by_content[content] for content in contents]
+
+    def _add_span_tokens(self, span: BlockSpan, block: CodeBlock):
+        # Lazy spans get their tokens summed up when they are first read, see Module.resolve_tokens()
+        if span._tokens is None:
+            return
+        if block._tokens is None:
+            block.tokens = self._count_tokens(block.content)
+        span.tokens += block.tokens
+
     def debug_log(self, message: str):
         if self.debug:
             logger.debug(message)
@@ -35,6 +35,8 @@ class PythonParser(CodeParser):
         if self.apply_gpt_tweaks:
             self.gpt_queries.extend(self._build_queries("python_gpt.scm"))
 
+        self._init_dispatch_tables()
+
     @property
     def language(self):
         return "python"
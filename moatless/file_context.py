@@ -18,6 +18,7 @@ from moatless.codeblocks.codeblocks import (
     SpanType,
 )
 from moatless.codeblocks.module import Module
+from moatless.codeblocks.parser.parser import OUTLINE_MIN_LINES
 from moatless.repository import FileRepository
 from moatless.repository.repository import Repository
 from moatless.runtime.runtime import RuntimeEnvironment, TestResult
@@ -46,6 +47,24 @@ class CurrentPromptSpan:
     tokens: int = 0
 
 
+class RenderedPrompt:
+    """
+    A rendered prompt or prompt fragment, the tokens are counted the first time they're needed.
+    """
+
+    __slots__ = ("text", "_tokens")
+
+    def __init__(self, text: str, tokens: Optional[int] = None):
+        self.text = text
+        self._tokens = tokens
+
+    @property
+    def tokens(self) -> int:
+        if self._tokens is None:
+            self._tokens = count_tokens(self.text)
+        return self._tokens
+
+
 class ContextFile(BaseModel):
     """
     Represents the context of a file, managing patches that reflect changes over time.
@@ -77,10 +96,20 @@ class ContextFile(BaseModel):
     _cached_content: Optional[str] = PrivateAttr(None)
     _cached_module: Optional[Module] = PrivateAttr(None)
 
+    # Module and content before the last change, used to parse the new content incrementally
+    _previous_module: Optional[Module] = PrivateAttr(None)
+    _previous_content: Optional[str] = PrivateAttr(None)
+
     _repo: Repository = PrivateAttr()
 
     _cache_valid: bool = PrivateAttr(False)
 
+    # Rendered prompts by span set and render flags, and rendered blocks by block identity and render flags. Only valid
+    # for the module version they were rendered from, see _get_prompt_cache().
+    _prompt_cache: Dict[tuple, RenderedPrompt] = PrivateAttr(default_factory=dict)
+    _prompt_cache_module: Optional[Module] = PrivateAttr(None)
+    _prompt_cache_version: Optional[int] = PrivateAttr(None)
+
     _is_new: bool = PrivateAttr(False)
 
     def __init__(
@@ -154,7 +183,15 @@ class ContextFile(BaseModel):
 
         parser = get_parser_by_path(self.file_path)
         if parser:
-            self._cached_module = parser.parse(self.content)
+            if self._previous_module is not None:
+                self._cached_module = parser.reparse(self._previous_module, self._previous_content, self.content)
+            else:
+                # Function bodies in large files are parsed when spans in them are viewed or edited
+                outline = self.content.count("\n") >= OUTLINE_MIN_LINES
+                self._cached_module = parser.parse(self.content, keep_tree=True, outline=outline)
+
+        self._previous_module = None
+        self._previous_content = None
 
         return self._cached_module
 
@@ -222,8 +259,7 @@ class ContextFile(BaseModel):
                     new_span_ids.update(span_ids)
 
         # Invalidate cached content
-        self._cached_content = None
-        self._cached_module = None
+        self._invalidate_module()
 
         return new_span_ids
 
@@ -386,33 +422,126 @@ class ContextFile(BaseModel):
         only_signatures: bool = False,
         max_tokens: Optional[int] = None,
     ):
-        if self.module:
-            if not self.show_all_spans and self.span_ids is not None and len(self.span_ids) == 0:
-                logger.warning(f"No span ids provided for {self.file_path}, return empty")
-                return ""
-
-            code = self._to_prompt(
-                code_block=self.module,
-                show_span_id=show_span_ids,
-                show_line_numbers=show_line_numbers,
-                outcomment_code_comment=outcomment_code_comment,
-                show_outcommented_code=show_outcommented_code,
-                exclude_comments=exclude_comments,
-                show_all_spans=show_all_spans or self.show_all_spans,
-                only_signatures=only_signatures,
-                max_tokens=max_tokens,
-            )
-        else:
-            code = self._to_prompt_with_line_spans(show_span_id=show_span_ids)
-
-        result = f"{self.file_path}\n```\n{code}\n```\n"
+        prompt = self.render_prompt(
+            show_span_ids=show_span_ids,
+            show_line_numbers=show_line_numbers,
+            exclude_comments=exclude_comments,
+            show_outcommented_code=show_outcommented_code,
+            outcomment_code_comment=outcomment_code_comment,
+            show_all_spans=show_all_spans,
+            only_signatures=only_signatures,
+            max_tokens=max_tokens,
+        )
 
         # Check if result exceeds max_tokens
-        if max_tokens and count_tokens(result) > max_tokens:
+        if max_tokens and prompt.tokens > max_tokens:
             logger.warning(f"Content for {self.file_path} exceeded max_tokens ({max_tokens})")
             return ""
 
-        return result
+        return prompt.text
+
+    def render_prompt(
+        self,
+        show_span_ids=False,
+        show_line_numbers=False,
+        exclude_comments=False,
+        show_outcommented_code=False,
+        outcomment_code_comment: str = "...",
+        show_all_spans: bool = False,
+        only_signatures: bool = False,
+        max_tokens: Optional[int] = None,
+    ) -> RenderedPrompt:
+        """
+        Renders the file like to_prompt() but returns the prompt with its token count. Prompts are cached until the
+        content or the spans of the file change, so the tokens of each rendering are only counted once.
+        """
+        module = self.module
+        if module:
+            if not self.show_all_spans and self.span_ids is not None and len(self.span_ids) == 0:
+                logger.warning(f"No span ids provided for {self.file_path}, return empty")
+                return RenderedPrompt("", 0)
+
+            # Expanding outlined functions changes the module, so this is done before the cache is looked up
+            module.expand_spans(self.span_ids)
+
+        prompt_cache = self._get_prompt_cache()
+        key = (
+            tuple((span.span_id, span.start_line, span.end_line, span.tokens) for span in self.spans),
+            self.show_all_spans,
+            show_span_ids,
+            show_line_numbers,
+            exclude_comments,
+            show_outcommented_code,
+            outcomment_code_comment,
+            show_all_spans,
+            only_signatures,
+            max_tokens,
+        )
+
+        prompt = prompt_cache.get(key)
+        if prompt is None:
+            if module:
+                code, _ = self._to_prompt(
+                    code_block=module,
+                    show_span_id=show_span_ids,
+                    show_line_numbers=show_line_numbers,
+                    outcomment_code_comment=outcomment_code_comment,
+                    show_outcommented_code=show_outcommented_code,
+                    exclude_comments=exclude_comments,
+                    show_all_spans=show_all_spans or self.show_all_spans,
+                    only_signatures=only_signatures,
+                    max_tokens=max_tokens,
+                )
+            else:
+                code = self._to_prompt_with_line_spans(show_span_id=show_span_ids)
+
+            prompt = RenderedPrompt(f"{self.file_path}\n```\n{code}\n```\n")
+            prompt_cache[key] = prompt
+
+        return prompt
+
+    def _get_prompt_cache(self) -> Dict[tuple, RenderedPrompt]:
+        module = self._cached_module
+        version = module._version if module is not None else None
+        if module is not self._prompt_cache_module or version != self._prompt_cache_version:
+            self._prompt_cache = {}
+            self._prompt_cache_module = module
+            self._prompt_cache_version = version
+        return self._prompt_cache
+
+    def _render_block(
+        self,
+        block: CodeBlock,
+        show_span_id: bool = False,
+        show_line_numbers: bool = False,
+        span_marker: SpanMarker = SpanMarker.COMMENT,
+    ) -> RenderedPrompt:
+        prompt_cache = self._get_prompt_cache()
+        key = (id(block), show_span_id, show_line_numbers, span_marker)
+        prompt = prompt_cache.get(key)
+        if prompt is None:
+            prompt = RenderedPrompt(
+                block._to_prompt_string(
+                    show_span_id=show_span_id,
+                    show_line_numbers=show_line_numbers,
+                    span_marker=span_marker,
+                )
+            )
+            prompt_cache[key] = prompt
+        return prompt
+
+    def _render_outcommented_block(
+        self, block: CodeBlock, outcomment_code_comment: str, show_line_numbers: bool = False
+    ) -> RenderedPrompt:
+        prompt_cache = self._get_prompt_cache()
+        key = (id(block), outcomment_code_comment, show_line_numbers)
+        prompt = prompt_cache.get(key)
+        if prompt is None:
+            outcommented_block = block.create_commented_out_block(outcomment_code_comment)
+            outcommented_block.start_line = block.start_line
+            prompt = RenderedPrompt(outcommented_block._to_prompt_string(show_line_numbers=show_line_numbers))
+            prompt_cache[key] = prompt
+        return prompt
 
     def _find_span(self, codeblock: CodeBlock) -> Optional[ContextSpan]:
         if not codeblock.belongs_to_span:
@@ -467,15 +596,18 @@ class ContextFile(BaseModel):
         only_signatures: bool = False,
         max_tokens: Optional[int] = None,
         current_tokens: int = 0,
-    ):
+    ) -> Tuple[str, int]:
+        """
+        Returns the prompt for the children of the block, and the tokens counted so far when max_tokens is set.
+        """
         if current_span is None:
             current_span = CurrentPromptSpan()
 
-        contents = ""
+        contents = []
         if not code_block.children:
-            return contents
+            return "", current_tokens
 
-        outcommented_block = None
+        outcommented_child = None
         for _i, child in enumerate(code_block.children):
             if exclude_comments and child.type.group == CodeBlockTypeGroup.COMMENT:
                 continue
@@ -528,23 +660,26 @@ class ContextFile(BaseModel):
                 show_child = False
 
             if show_child:
-                if outcommented_block:
-                    block_content = outcommented_block._to_prompt_string(
-                        show_line_numbers=show_line_numbers,
+                if outcommented_child:
+                    block_prompt = self._render_outcommented_block(
+                        outcommented_child, outcomment_code_comment, show_line_numbers=show_line_numbers
                     )
-                    contents += block_content
-                    current_tokens += count_tokens(block_content)
-                    outcommented_block = None
+                    contents.append(block_prompt.text)
+                    if max_tokens:
+                        current_tokens += block_prompt.tokens
+                    outcommented_child = None
 
-                block_content = child._to_prompt_string(
+                block_prompt = self._render_block(
+                    child,
                     show_span_id=show_new_span_id,
                     show_line_numbers=show_line_numbers,
                     span_marker=SpanMarker.TAG,
                 )
-                contents += block_content
-                current_tokens += count_tokens(block_content)
+                contents.append(block_prompt.text)
+                if max_tokens:
+                    current_tokens += block_prompt.tokens
 
-                child_content = self._to_prompt(
+                child_content, current_tokens = self._to_prompt(
                     code_block=child,
                     exclude_comments=exclude_comments,
                     show_outcommented_code=show_outcommented_code,
@@ -557,12 +692,11 @@ class ContextFile(BaseModel):
                     max_tokens=max_tokens,
                     current_tokens=current_tokens,
                 )
-                contents += child_content
-                current_tokens += count_tokens(child_content)
+                contents.append(child_content)
 
             elif (
                 show_outcommented_code
-                and not outcommented_block
+                and not outcommented_child
                 and child.type
                 not in [
                     CodeBlockType.COMMENT,
@@ -570,22 +704,31 @@ class ContextFile(BaseModel):
                     CodeBlockType.SPACE,
                 ]
             ):
-                outcommented_block = child.create_commented_out_block(outcomment_code_comment)
-                outcommented_block.start_line = child.start_line
+                outcommented_child = child
 
-        if show_outcommented_code and outcommented_block:
-            block_content = outcommented_block._to_prompt_string(
-                show_line_numbers=show_line_numbers,
+        if show_outcommented_code and outcommented_child:
+            block_prompt = self._render_outcommented_block(
+                outcommented_child, outcomment_code_comment, show_line_numbers=show_line_numbers
             )
-            contents += block_content
-            current_tokens += count_tokens(block_content)
+            contents.append(block_prompt.text)
+            if max_tokens:
+                current_tokens += block_prompt.tokens
 
-        return contents
+        return "".join(contents), current_tokens
+
+    def _invalidate_module(self):
+        # Keep the parsed module so that the new content can be parsed incrementally
+        if self._cached_module is not None and self._cached_content is not None:
+            self._previous_module = self._cached_module
+            self._previous_content = self._cached_content
 
-    def set_patch(self, patch: str):
-        self.patch = patch
         self._cached_content = None
         self._cached_module = None
+        self._prompt_cache = {}
+
+    def set_patch(self, patch: str):
+        self.patch = patch
+        self._invalidate_module()
         self.was_edited = True
 
     def context_size(self):
@@ -1094,14 +1237,15 @@ class FileContext(BaseModel):
 
     def context_size(self):
         if self._repo:
-            content = self.create_prompt(
+            # Counted per file on the cached file prompts, the separators between the files aren't included
+            prompts = self._render_file_prompts(
                 show_span_ids=False,
                 show_line_numbers=True,
                 show_outcommented_code=True,
                 outcomment_code_comment="...",
                 only_signatures=False,
             )
-            return count_tokens(content)
+            return sum(prompt.tokens for prompt in prompts)
 
         # TODO: This doesnt give accure results. Will count tokens in the generated prompt instead
         # sum(file.context_size() for file in self._files.values())
@@ -1134,12 +1278,35 @@ class FileContext(BaseModel):
         only_signatures: bool = False,
         max_tokens: Optional[int] = None,
     ):
-        file_contexts = []
+        prompts = self._render_file_prompts(
+            show_span_ids=show_span_ids,
+            show_line_numbers=show_line_numbers,
+            exclude_comments=exclude_comments,
+            show_outcommented_code=show_outcommented_code,
+            outcomment_code_comment=outcomment_code_comment,
+            files=files,
+            only_signatures=only_signatures,
+            max_tokens=max_tokens,
+        )
+        return "\n\n".join(prompt.text for prompt in prompts)
+
+    def _render_file_prompts(
+        self,
+        show_span_ids=False,
+        show_line_numbers=False,
+        exclude_comments=False,
+        show_outcommented_code=False,
+        outcomment_code_comment: str = "...",
+        files: set | None = None,
+        only_signatures: bool = False,
+        max_tokens: Optional[int] = None,
+    ) -> List[RenderedPrompt]:
+        prompts = []
         current_tokens = 0
 
         for context_file in self.get_context_files():
             if not files or context_file.file_path in files:
-                content = context_file.to_prompt(
+                prompt = context_file.render_prompt(
                     show_span_ids,
                     show_line_numbers,
                     exclude_comments,
@@ -1150,16 +1317,19 @@ class FileContext(BaseModel):
                 )
 
                 if max_tokens:
-                    content_tokens = count_tokens(content)
-                    if current_tokens + content_tokens > max_tokens:
+                    if prompt.tokens > max_tokens:
+                        logger.warning(f"Content for {context_file.file_path} exceeded max_tokens ({max_tokens})")
+                        continue
+
+                    if current_tokens + prompt.tokens > max_tokens:
                         logger.warning(f"Skipping {context_file.file_path} as it would exceed max_tokens")
                         break
-                    current_tokens += content_tokens
+                    current_tokens += prompt.tokens
 
-                if content:  # Only add non-empty content
-                    file_contexts.append(content)
+                if prompt.text:  # Only add non-empty content
+                    prompts.append(prompt)
 
-        return "\n\n".join(file_contexts)
+        return prompts
 
     def clone(self):
         dump = self.model_dump(exclude={"files": {"__all__": {"was_edited", "was_viewed"}}})
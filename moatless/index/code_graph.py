@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+from moatless.codeblocks import CodeBlock, CodeBlockType
+from moatless.codeblocks.codeblocks import CodeBlockTypeGroup
+from moatless.codeblocks.module import Module
+
+logger = logging.getLogger(__name__)
+
+CODE_GRAPH_FILE = "code_graph.json"
+
+# Max number of re-exports to follow when resolving a path
+_MAX_IMPORT_DEPTH = 5
+
+
+def module_name_from_path(file_path: str) -> str:
+    """
+    Returns the dotted module name of a file, e.g. moatless.index for moatless/index/__init__.py.
+    """
+    name = os.path.splitext(file_path)[0].replace(os.sep, "/").strip("/").replace("/", ".")
+    if name.endswith(".__init__"):
+        name = name[: -len(".__init__")]
+    return name
+
+
+@dataclass
+class FileSymbols:
+    """
+    The symbols defined in a file, the names it imports and the paths referenced from each span. Referenced paths are
+    qualified with the imports and definitions in the file, so they can be resolved without parsing the file again.
+    """
+
+    module_name: str
+    definitions: dict[tuple[str, ...], str] = field(default_factory=dict)  # Block path -> span id
+    imports: dict[str, tuple[str, ...]] = field(default_factory=dict)  # Imported name -> qualified path
+    references: list[tuple[str, tuple[str, ...]]] = field(default_factory=list)  # (Span id, qualified path)
+
+    @classmethod
+    def from_module(cls, module: Module) -> "FileSymbols":
+        symbols = cls(module_name=module_name_from_path(module.file_path))
+        if os.path.basename(module.file_path) == "__init__.py":
+            package = symbols.module_name
+        else:
+            package = symbols.module_name.rpartition(".")[0]
+
+        blocks = module.get_all_child_blocks()
+
+        for block in blocks:
+            if block.type == CodeBlockType.IMPORT:
+                for relationship in block.relationships:
+                    if relationship.path and relationship.external_path:
+                        imported_module = _resolve_relative_import(package, relationship.external_path[0])
+                        symbols.imports[relationship.path[-1]] = tuple(imported_module.split(".")) + tuple(
+                            relationship.path
+                        )
+            elif block.belongs_to_span and _is_definition(block):
+                symbols.definitions.setdefault(tuple(block.full_path()), block.belongs_to_span.span_id)
+
+        seen = set()
+        for block in blocks:
+            if block.type == CodeBlockType.IMPORT or not block.belongs_to_span:
+                continue
+
+            for relationship in block.relationships:
+                path = symbols.qualify(relationship.path)
+                if path:
+                    reference = (block.belongs_to_span.span_id, path)
+                    if reference not in seen:
+                        seen.add(reference)
+                        symbols.references.append(reference)
+
+        return symbols
+
+    def qualify(self, path: list[str]) -> tuple[str, ...] | None:
+        # Calls like Foo(1).bar are referenced as Foo.bar
+        path = tuple(name.split("(", 1)[0] for name in path)
+        if not path or not all(path):
+            return None
+
+        if path[0] in self.imports:
+            return self.imports[path[0]] + path[1:]
+
+        if path[:1] in self.definitions:
+            return tuple(self.module_name.split(".")) + path
+
+        # Local variables, builtins or modules that are not imported with from ... import
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            "module_name": self.module_name,
+            "definitions": [[list(path), span_id] for path, span_id in self.definitions.items()],
+            "imports": {name: list(path) for name, path in self.imports.items()},
+            "references": [[span_id, list(path)] for span_id, path in self.references],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FileSymbols":
+        return cls(
+            module_name=data["module_name"],
+            definitions={tuple(path): span_id for path, span_id in data["definitions"]},
+            imports={name: tuple(path) for name, path in data["imports"].items()},
+            references=[(span_id, tuple(path)) for span_id, path in data["references"]],
+        )
+
+
+def _resolve_relative_import(package: str, imported_module: str) -> str:
+    if not imported_module.startswith("."):
+        return imported_module
+
+    level = len(imported_module) - len(imported_module.lstrip("."))
+    parts = package.split(".") if package else []
+    parts = parts[: len(parts) - level + 1]
+    name = imported_module[level:]
+    return ".".join(parts + ([name] if name else []))
+
+
+def _is_definition(block: CodeBlock) -> bool:
+    if block.type.group == CodeBlockTypeGroup.STRUCTURE:
+        return True
+
+    return block.type == CodeBlockType.ASSIGNMENT and block.parent.type in [CodeBlockType.MODULE, CodeBlockType.CLASS]
+
+
+class CodeGraph:
+    """
+    Repository wide graph of references between spans in different files.
+
+    The symbols of each file are updated separately when a file is parsed. References are resolved to the span of the
+    referenced definition, following imports and re-exports in other files, the first time the graph is queried after
+    a change. Only the files that depend on a changed file are resolved again.
+    """
+
+    def __init__(self, files: Optional[dict[str, FileSymbols]] = None):
+        self._files: dict[str, FileSymbols] = {}
+        self._files_by_module: dict[str, str] = {}
+
+        # Resolved references as (span id, target file path, target span id) for each file
+        self._outgoing: dict[str, list[tuple[str, str, str]]] = {}
+        self._incoming: dict[tuple[str, str], set[tuple[str, str]]] = {}
+
+        # Files that were looked up when resolving the references of each file
+        self._dependencies: dict[str, set[str]] = {}
+        self._dependents: dict[str, set[str]] = {}
+
+        self._stale_files: set[str] = set()
+        self._resolve_all = False
+
+        for file_path, symbols in (files or {}).items():
+            self._set_file(file_path, symbols)
+
+    @property
+    def file_paths(self) -> list[str]:
+        return list(self._files.keys())
+
+    def update_module(self, module: Module):
+        """
+        Add or replace the symbols of the file the module was parsed from.
+        """
+        if not module.file_path:
+            raise ValueError("Can't add a module without a file path to the code graph.")
+
+        self.update_file(module.file_path, FileSymbols.from_module(module))
+
+    def update_file(self, file_path: str, symbols: FileSymbols):
+        existing = self._files.get(file_path)
+        if existing and existing.module_name == symbols.module_name:
+            self._stale_files.update(self._dependents.get(file_path, set()))
+            self._stale_files.add(file_path)
+            self._files[file_path] = symbols
+        else:
+            if existing:
+                self.remove_file(file_path)
+            self._set_file(file_path, symbols)
+
+    def remove_file(self, file_path: str):
+        symbols = self._files.pop(file_path, None)
+        if not symbols:
+            return
+
+        if self._files_by_module.get(symbols.module_name) == file_path:
+            del self._files_by_module[symbols.module_name]
+
+        self._remove_edges(file_path)
+        self._stale_files.discard(file_path)
+
+        # References to the removed module may resolve to another module, resolve all files again
+        self._resolve_all = True
+
+    def _set_file(self, file_path: str, symbols: FileSymbols):
+        self._files[file_path] = symbols
+        self._files_by_module[symbols.module_name] = file_path
+
+        # References in any file may resolve to a new module
+        self._resolve_all = True
+
+    def resolve(self, file_path: str, path: list[str]) -> tuple[str, str] | None:
+        """
+        Returns the file path and span id of the definition a path referenced in the file refers to.
+        """
+        symbols = self._files.get(file_path)
+        if not symbols:
+            return None
+
+        qualified_path = symbols.qualify(path)
+        if not qualified_path:
+            return None
+
+        return self._resolve(qualified_path, set())
+
+    def find_references(self, file_path: str, span_id: str) -> list[tuple[str, str]]:
+        """
+        Returns the spans in other files that are referenced from the span.
+        """
+        self._resolve_stale_files()
+        targets = []
+        for source_span_id, target_file_path, target_span_id in self._outgoing.get(file_path, []):
+            if source_span_id == span_id and (target_file_path, target_span_id) not in targets:
+                targets.append((target_file_path, target_span_id))
+        return targets
+
+    def find_referrers(self, file_path: str, span_id: str) -> list[tuple[str, str]]:
+        """
+        Returns the spans in other files that reference the span.
+        """
+        self._resolve_stale_files()
+        return sorted(self._incoming.get((file_path, span_id), set()))
+
+    def find_related_spans(self, file_path: str, span_id: str) -> list[tuple[str, str]]:
+        related = self.find_references(file_path, span_id)
+        for referrer in self.find_referrers(file_path, span_id):
+            if referrer not in related:
+                related.append(referrer)
+        return related
+
+    def _resolve(self, path: tuple[str, ...], consulted: set[str], depth: int = 0) -> tuple[str, str] | None:
+        for i in range(len(path) - 1, 0, -1):
+            file_path = self._files_by_module.get(".".join(path[:i]))
+            if file_path:
+                break
+        else:
+            return None
+
+        consulted.add(file_path)
+        symbols = self._files[file_path]
+        name_path = path[i:]
+
+        for j in range(len(name_path), 0, -1):
+            span_id = symbols.definitions.get(name_path[:j])
+            if span_id:
+                return file_path, span_id
+
+        imported_path = symbols.imports.get(name_path[0])
+        if imported_path and depth < _MAX_IMPORT_DEPTH:
+            return self._resolve(imported_path + name_path[1:], consulted, depth + 1)
+
+        return None
+
+    def _resolve_stale_files(self):
+        if self._resolve_all:
+            self._stale_files = set(self._files.keys())
+            self._resolve_all = False
+
+        if not self._stale_files:
+            return
+
+        logger.debug(f"Resolving references in {len(self._stale_files)} files")
+        for file_path in self._stale_files:
+            self._remove_edges(file_path)
+
+            consulted = set()
+            outgoing = []
+            for span_id, path in self._files[file_path].references:
+                target = self._resolve(path, consulted)
+                if target and target[0] != file_path:
+                    outgoing.append((span_id, *target))
+                    self._incoming.setdefault(target, set()).add((file_path, span_id))
+
+            self._outgoing[file_path] = outgoing
+            self._dependencies[file_path] = consulted
+            for dependency in consulted:
+                self._dependents.setdefault(dependency, set()).add(file_path)
+
+        self._stale_files = set()
+
+    def _remove_edges(self, file_path: str):
+        for span_id, target_file_path, target_span_id in self._outgoing.pop(file_path, []):
+            referrers = self._incoming.get((target_file_path, target_span_id))
+            if referrers:
+                referrers.discard((file_path, span_id))
+                if not referrers:
+                    del self._incoming[(target_file_path, target_span_id)]
+
+        for dependency in self._dependencies.pop(file_path, set()):
+            dependents = self._dependents.get(dependency)
+            if dependents:
+                dependents.discard(file_path)
+
+    def persist(self, persist_dir: str):
+        with open(os.path.join(persist_dir, CODE_GRAPH_FILE), "w") as f:
+            json.dump({file_path: symbols.to_dict() for file_path, symbols in self._files.items()}, f)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> Optional["CodeGraph"]:
+        path = os.path.join(persist_dir, CODE_GRAPH_FILE)
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(files={file_path: FileSymbols.from_dict(symbols) for file_path, symbols in data.items()})
@@ -3,13 +3,17 @@ import logging
 import mimetypes
 import os
 import shutil
+import subprocess
 import tempfile
+import threading
+import weakref
 from typing import Optional, TYPE_CHECKING
 
 import requests
 from rapidfuzz import fuzz
 
 from moatless.codeblocks import CodeBlock, CodeBlockType
+from moatless.index.code_graph import CodeGraph
 from moatless.index.settings import IndexSettings
 from moatless.index.types import (
     CodeSnippet,
@@ -27,6 +31,8 @@ if TYPE_CHECKING:
     from llama_index.core.ingestion import DocstoreStrategy, IngestionPipeline
     from llama_index.core.storage.docstore import SimpleDocumentStore
 
+    from moatless.index.embedding_cache import EmbeddingCache, EmbeddingCacheStats
+
 logger = logging.getLogger(__name__)
 
 # Add constant for persist filename outside TYPE_CHECKING
@@ -41,10 +47,9 @@ def default_vector_store(settings: IndexSettings):
             "faiss needs to be installed to set up a default index for CodeIndex. Run 'pip install faiss-cpu'"
         ) from e
 
-    faiss_index = faiss.IndexIDMap(faiss.IndexFlatL2(settings.dimensions))
     from moatless.index.simple_faiss import SimpleFaissVectorStore
 
-    return SimpleFaissVectorStore(faiss_index)
+    return SimpleFaissVectorStore.from_defaults(d=settings.dimensions, index_settings=settings)
 
 
 class CodeIndex:
@@ -57,10 +62,12 @@ class CodeIndex:
         embed_model: "BaseEmbedding | None" = None,
         blocks_by_class_name: Optional[dict] = None,
         blocks_by_function_name: Optional[dict] = None,
+        code_graph: CodeGraph | None = None,
         settings: IndexSettings | None = None,
         max_results: int = 25,
         max_hits_without_exact_match: int = 100,
         max_exact_results: int = 5,
+        embedding_cache: "EmbeddingCache | None" = None,
     ):
         self._index_name = index_name
         self._settings = settings or IndexSettings()
@@ -70,14 +77,20 @@ class CodeIndex:
         self.max_exact_results = max_exact_results
 
         self._file_repo = file_repo
+        self._persisted_index: _PersistedIndex | None = None
 
         self._blocks_by_class_name = blocks_by_class_name or {}
         self._blocks_by_function_name = blocks_by_function_name or {}
+        self._code_graph = code_graph or CodeGraph()
 
         from moatless.index.embed_model import get_embed_model
         from llama_index.core.storage.docstore import SimpleDocumentStore
 
+        from moatless.index.embedding_cache import get_default_embedding_cache
+
         self._embed_model = embed_model or get_embed_model(self._settings.embed_model)
+        self._embedding_cache = embedding_cache if embedding_cache is not None else get_default_embedding_cache()
+        self._embedding_cache_stats: "EmbeddingCacheStats | None" = None
         self._vector_store = vector_store or default_vector_store(self._settings)
         self._docstore = docstore or SimpleDocumentStore()
 
@@ -85,44 +98,48 @@ class CodeIndex:
             f"Initiated CodeIndex {self._index_name} with:\n"
             f" * {len(self._blocks_by_class_name)} classes\n"
             f" * {len(self._blocks_by_function_name)} functions\n"
+            f" * {len(self._code_graph.file_paths)} files in code graph\n"
             f" * {len(self._docstore.docs)} vectors\n"
             f"Using file repository at {self._file_repo.repo_dir if self._file_repo else 'None'}\n"
         )
 
     @classmethod
-    def from_persist_dir(cls, persist_dir: str, file_repo: Repository | None = None, **kwargs):
-        from moatless.index.simple_faiss import SimpleFaissVectorStore
-        from llama_index.core.storage.docstore import SimpleDocumentStore
-
-        vector_store = SimpleFaissVectorStore.from_persist_dir(persist_dir)
-        docstore = SimpleDocumentStore.from_persist_dir(persist_dir)
-
-        settings = IndexSettings.from_persist_dir(persist_dir)
-
-        if os.path.exists(os.path.join(persist_dir, "blocks_by_class_name.json")):
-            with open(os.path.join(persist_dir, "blocks_by_class_name.json")) as f:
-                blocks_by_class_name = json.load(f)
-        else:
-            blocks_by_class_name = {}
-
-        if os.path.exists(os.path.join(persist_dir, "blocks_by_function_name.json")):
-            with open(os.path.join(persist_dir, "blocks_by_function_name.json")) as f:
-                blocks_by_function_name = json.load(f)
+    def from_persist_dir(
+        cls,
+        persist_dir: str,
+        file_repo: Repository | None = None,
+        mmap: bool = False,
+        shared: bool = False,
+        **kwargs,
+    ):
+        """
+        Load a persisted index. With mmap the vectors are memory-mapped read-only, so processes on the same host
+        share them through the page cache. With shared the loaded index is reused by all CodeIndex instances in the
+        process that are loaded from the same persist dir while any of them is in use. Shared indexes must not be
+        changed, as run_ingestion() would change them for all instances.
+        """
+        if shared:
+            persisted_index = _get_shared_index(persist_dir, mmap)
         else:
-            blocks_by_function_name = {}
+            persisted_index = _PersistedIndex.load(persist_dir, mmap)
 
-        return cls(
+        code_index = cls(
             file_repo=file_repo,
-            vector_store=vector_store,
-            docstore=docstore,
-            settings=settings,
-            blocks_by_class_name=blocks_by_class_name,
-            blocks_by_function_name=blocks_by_function_name,
+            vector_store=persisted_index.vector_store,
+            docstore=persisted_index.docstore,
+            settings=persisted_index.settings,
+            blocks_by_class_name=persisted_index.blocks_by_class_name,
+            blocks_by_function_name=persisted_index.blocks_by_function_name,
+            code_graph=persisted_index.code_graph,
             **kwargs,
         )
 
+        # Keeps the shared index registered while it's in use
+        code_index._persisted_index = persisted_index
+        return code_index
+
     @classmethod
-    def from_url(cls, url: str, persist_dir: str, file_repo: FileRepository):
+    def from_url(cls, url: str, persist_dir: str, file_repo: FileRepository, **kwargs):
         try:
             response = requests.get(url, stream=True)
             response.raise_for_status()
@@ -144,7 +161,7 @@ class CodeIndex:
             raise e
 
         logger.info(f"Downloaded existing index from {url}.")
-        return cls.from_persist_dir(persist_dir, file_repo)
+        return cls.from_persist_dir(persist_dir, file_repo, **kwargs)
 
     @classmethod
     def from_index_name(
@@ -152,6 +169,8 @@ class CodeIndex:
         index_name: str,
         file_repo: Repository,
         index_store_dir: Optional[str] = None,
+        mmap: bool = False,
+        shared: bool = False,
     ):
         if not index_store_dir:
             index_store_dir = os.getenv("INDEX_STORE_DIR")
@@ -159,7 +178,7 @@ class CodeIndex:
         persist_dir = os.path.join(index_store_dir, index_name)
         if os.path.exists(persist_dir):
             logger.info(f"Loading existing index {index_name} from {persist_dir}.")
-            return cls.from_persist_dir(persist_dir, file_repo=file_repo)
+            return cls.from_persist_dir(persist_dir, file_repo=file_repo, mmap=mmap, shared=shared)
         else:
             logger.info(f"No existing index found at {persist_dir}.")
 
@@ -170,11 +189,38 @@ class CodeIndex:
 
         store_url = os.path.join(index_store_url, f"{index_name}.zip")
         logger.info(f"Downloading existing index {index_name} from {store_url}.")
-        return cls.from_url(store_url, persist_dir, file_repo)
+        return cls.from_url(store_url, persist_dir, file_repo, mmap=mmap, shared=shared)
 
     def dict(self):
         return {"index_name": self._index_name}
 
+    @property
+    def embedding_cache_stats(self) -> "EmbeddingCacheStats | None":
+        """
+        Embedding cache hits, misses and saved cost in the last run_ingestion(), if an embedding cache is used.
+        """
+        return self._embedding_cache_stats
+
+    @property
+    def code_graph(self) -> CodeGraph:
+        return self._code_graph
+
+    def find_related_spans(self, file_path: str, span_ids: list[str]) -> SearchCodeResponse:
+        """
+        Find spans in other files that are referenced from or reference the spans in the file, using the code graph.
+        """
+        hits_by_file = {}
+        for span_id in span_ids:
+            for related_file_path, related_span_id in self._code_graph.find_related_spans(file_path, span_id):
+                if related_file_path not in hits_by_file:
+                    hits_by_file[related_file_path] = SearchCodeHit(file_path=related_file_path)
+                hits_by_file[related_file_path].add_span(related_span_id)
+
+        if not hits_by_file:
+            return SearchCodeResponse(message=f"No related code found for {file_path}.")
+
+        return SearchCodeResponse(hits=list(hits_by_file.values()))
+
     def semantic_search(
         self,
         query: Optional[str] = None,
@@ -620,7 +666,13 @@ class CodeIndex:
         top_k: int = 500,
     ):
         # Import llama_index components only when needed
-        from llama_index.core.vector_stores.types import VectorStoreQuery
+        from llama_index.core.vector_stores.types import (
+            FilterOperator,
+            MetadataFilter,
+            MetadataFilters,
+            VectorStoreQuery,
+        )
+        from moatless.index.simple_faiss import SimpleFaissVectorStore
 
         if file_pattern:
             query += f" file:{file_pattern}"
@@ -633,18 +685,44 @@ class CodeIndex:
 
         logger.debug(f"vector_search() Searching for query [{query[:50]}...] and file pattern [{file_pattern}].")
 
-        query_embedding = self._embed_model.get_query_embedding(query)
+        if file_pattern:
+            include_files = set(self._file_repo.matching_files(file_pattern))
+            if len(include_files) == 0:
+                logger.info(f"vector_search() No files found for file pattern {file_pattern}, return empty result...")
+                return []
+        else:
+            include_files = set()
 
-        # FIXME: Filters can't be used ATM. Category isn't set in some instance vector stores
-        # filters = MetadataFilters(filters=[], condition=FilterCondition.AND)
-        # if category:
-        #    filters.filters.append(MetadataFilter(key="category", value=category))
+        if category and category != "test":
+            exclude_files = set(self._file_repo.find_files(["**/tests/**", "tests*", "*_test.py", "test_*.py"]))
+        else:
+            exclude_files = set()
+
+        # Category isn't set in the metadata of some instance vector stores, so the search is filtered on file paths
+        filters = None
+        if isinstance(self._vector_store, SimpleFaissVectorStore) and (
+            include_files or exclude_files or category in ("implementation", "test")
+        ):
+            file_paths = [
+                file_path
+                for file_path in self._vector_store.metadata_values("file_path")
+                if _include_file(file_path, include_files, exclude_files, category)
+            ]
+            if not file_paths:
+                logger.info("vector_search() No indexed files match the file pattern and category, return empty result...")
+                return []
+
+            filters = MetadataFilters(
+                filters=[MetadataFilter(key="file_path", operator=FilterOperator.IN, value=file_paths)]
+            )
+
+        query_embedding = self._embed_model.get_query_embedding(query)
 
         query_bundle = VectorStoreQuery(
             query_str=query,
             query_embedding=query_embedding,
-            similarity_top_k=top_k,  # TODO: Fix paging?
-            #    filters=filters,
+            similarity_top_k=top_k,
+            filters=filters,
         )
 
         result = self._vector_store.query(query_bundle)
@@ -655,19 +733,6 @@ class CodeIndex:
 
         sum_tokens_per_file = {}
 
-        if file_pattern:
-            include_files = self._file_repo.matching_files(file_pattern)
-            if len(include_files) == 0:
-                logger.info(f"vector_search() No files found for file pattern {file_pattern}, return empty result...")
-                return []
-        else:
-            include_files = []
-
-        if category and category != "test":
-            exclude_files = self._file_repo.find_files(["**/tests/**", "tests*", "*_test.py", "test_*.py"])
-        else:
-            exclude_files = set()
-
         search_results = []
 
         for node_id, distance in zip(result.ids, result.similarities, strict=False):
@@ -677,20 +742,7 @@ class CodeIndex:
                 # TODO: Retry to get top_k results
                 continue
 
-            if exclude_files and node_doc.metadata["file_path"] in exclude_files:
-                filtered_out_snippets += 1
-                continue
-
-            if include_files and node_doc.metadata["file_path"] not in include_files:
-                filtered_out_snippets += 1
-                continue
-
-            is_test_file = is_test(node_doc.metadata["file_path"])
-            if category == "implementation" and is_test_file:
-                filtered_out_snippets += 1
-                continue
-
-            if category == "test" and not is_test_file:
+            if not _include_file(node_doc.metadata["file_path"], include_files, exclude_files, category):
                 filtered_out_snippets += 1
                 continue
 
@@ -737,11 +789,145 @@ class CodeIndex:
         input_files: list[str] | None = None,
         num_workers: Optional[int] = None,
     ):
+        from llama_index.core.ingestion import DocstoreStrategy
+
+        repo_path = repo_path or self._file_repo.path
+
+        if input_files:
+            input_files = [os.path.join(repo_path, file) for file in input_files if not file.startswith(repo_path)]
+
+        blocks_by_class_name = {}
+        blocks_by_function_name = {}
+
+        # Update the code graph for the ingested files, or build a new one if the whole repository is ingested
+        code_graph = self._code_graph if input_files else CodeGraph()
+
+        embedded_nodes, embedded_tokens = self._ingest(
+            repo_path,
+            input_files,
+            DocstoreStrategy.UPSERTS_AND_DELETE,
+            blocks_by_class_name,
+            blocks_by_function_name,
+            code_graph,
+            num_workers,
+        )
+
+        self._blocks_by_class_name = blocks_by_class_name
+        self._blocks_by_function_name = blocks_by_function_name
+        self._code_graph = code_graph
+
+        return embedded_nodes, embedded_tokens
+
+    def update_to_commit(
+        self,
+        repo: FileRepository | str,
+        old_commit: str,
+        new_commit: str,
+        num_workers: Optional[int] = None,
+    ):
+        """
+        Update an index of the repository at old_commit to new_commit. Only the files changed between the commits are
+        split and embedded again, and the nodes and vectors of changed and deleted files are removed. The repository
+        must be checked out at new_commit. Shared indexes must not be updated, see from_persist_dir().
+
+        Returns the number of embedded nodes and tokens, like run_ingestion().
+        """
+        from llama_index.core.ingestion import DocstoreStrategy
+        from moatless.index.columnar_store import ColumnarDocumentStore
+
+        repo_path = repo if isinstance(repo, str) else repo.path
+
+        if _git(repo_path, "rev-parse", "HEAD") != _git(repo_path, "rev-parse", f"{new_commit}^{{commit}}"):
+            raise ValueError(f"The repository at {repo_path} must be checked out at {new_commit} to update the index.")
+
+        # Renamed files are listed as deleted and added files
+        diff = _git(repo_path, "diff", "--name-only", "--no-renames", "-z", old_commit, new_commit)
+        required_exts = self._required_exts()
+        changed_files = {
+            file_path
+            for file_path in diff.split("\0")
+            if file_path and os.path.splitext(file_path)[1] in required_exts
+        }
+
+        if not changed_files:
+            logger.info(f"No files to index changed between {old_commit} and {new_commit}.")
+            return 0, 0
+
+        if isinstance(self._docstore, ColumnarDocumentStore):
+            # Nodes loaded from index columns are read-only
+            self._docstore = self._docstore.to_document_store()
+
+        node_ids = [
+            node_id
+            for node_id, node in self._docstore.docs.items()
+            if node.metadata.get("file_path") in changed_files
+        ]
+        for node_id in node_ids:
+            self._docstore.delete_document(node_id, raise_error=False)
+        self._vector_store.delete_nodes(node_ids)
+
+        for blocks_by_name in (self._blocks_by_class_name, self._blocks_by_function_name):
+            for name in list(blocks_by_name):
+                blocks = [block for block in blocks_by_name[name] if block[0] not in changed_files]
+                if blocks:
+                    blocks_by_name[name] = blocks
+                else:
+                    del blocks_by_name[name]
+
+        for file_path in changed_files:
+            self._code_graph.remove_file(file_path)
+
+        input_files = [
+            os.path.join(repo_path, file_path)
+            for file_path in sorted(changed_files)
+            if os.path.exists(os.path.join(repo_path, file_path))
+        ]
+        logger.info(
+            f"Update index from {old_commit} to {new_commit}: removed {len(node_ids)} nodes in {len(changed_files)} "
+            f"changed files, index {len(input_files)} files."
+        )
+
+        if not input_files:
+            return 0, 0
+
+        # Only the changed files are read, the nodes of other files are kept
+        return self._ingest(
+            repo_path,
+            input_files,
+            DocstoreStrategy.UPSERTS,
+            self._blocks_by_class_name,
+            self._blocks_by_function_name,
+            self._code_graph,
+            num_workers,
+        )
+
+    def _required_exts(self) -> list[str]:
+        if self._settings and self._settings.language == "java":
+            return [".java"]
+        return [".py"]
+
+    def _ingest(
+        self,
+        repo_path: str,
+        input_files: list[str] | None,
+        docstore_strategy: "DocstoreStrategy",
+        blocks_by_class_name: dict,
+        blocks_by_function_name: dict,
+        code_graph: CodeGraph,
+        num_workers: Optional[int] = None,
+    ) -> tuple[int, int]:
+        """
+        Split and embed the files, and add their classes and functions to the blocks by name and the code graph.
+        """
         # Import llama_index components only when needed
         from llama_index.core import SimpleDirectoryReader
-        from llama_index.core.ingestion import DocstoreStrategy, IngestionPipeline
+        from llama_index.core.ingestion import IngestionPipeline
+        from moatless.index.columnar_store import ColumnarDocumentStore
+        from moatless.index.embedding_cache import CachedEmbedding
 
-        repo_path = repo_path or self._file_repo.path
+        if isinstance(self._docstore, ColumnarDocumentStore):
+            # Nodes loaded from index columns are read-only
+            self._docstore = self._docstore.to_document_store()
 
         # Only extract file name and type to not trigger unnecessary embedding jobs
         def file_metadata_func(file_path: str) -> dict:
@@ -758,13 +944,7 @@ class CodeIndex:
                 "category": category,
             }
 
-        if self._settings and self._settings.language == "java":
-            required_exts = [".java"]
-        else:
-            required_exts = [".py"]
-
-        if input_files:
-            input_files = [os.path.join(repo_path, file) for file in input_files if not file.startswith(repo_path)]
+        required_exts = self._required_exts()
 
         try:
             reader = SimpleDirectoryReader(
@@ -781,9 +961,19 @@ class CodeIndex:
             )
             raise e
 
+        if self._embedding_cache is not None:
+            embedding = CachedEmbedding(
+                self._embed_model, self._embedding_cache, self._settings.dimensions, num_workers=num_workers
+            )
+            # Embedded in parallel by the cached embedding instead of in worker processes
+            pipeline_workers = None
+        else:
+            embedding = self._embed_model
+            pipeline_workers = num_workers
+
         embed_pipeline = IngestionPipeline(
-            transformations=[self._embed_model],
-            docstore_strategy=DocstoreStrategy.UPSERTS_AND_DELETE,
+            transformations=[embedding],
+            docstore_strategy=docstore_strategy,
             docstore=self._docstore,
             vector_store=self._vector_store,
         )
@@ -791,10 +981,10 @@ class CodeIndex:
         docs = reader.load_data()
         logger.info(f"Read {len(docs)} documents")
 
-        blocks_by_class_name = {}
-        blocks_by_function_name = {}
-
         def index_callback(codeblock: CodeBlock):
+            if codeblock.type == CodeBlockType.MODULE:
+                code_graph.update_module(codeblock)
+
             if codeblock.type == CodeBlockType.CLASS:
                 if codeblock.identifier not in blocks_by_class_name:
                     blocks_by_class_name[codeblock.identifier] = []
@@ -817,6 +1007,8 @@ class CodeIndex:
             max_chunks=self._settings.max_chunks,
             comment_strategy=self._settings.comment_strategy,
             index_callback=index_callback,
+            parse_workers=num_workers,
+            enable_code_graph=True,
             repo_path=repo_path,
         )
 
@@ -824,18 +1016,34 @@ class CodeIndex:
         prepared_tokens = sum([count_tokens(node.get_content(), self._settings.embed_model) for node in prepared_nodes])
         logger.info(f"Run embed pipeline with {len(prepared_nodes)} nodes and {prepared_tokens} tokens")
 
-        embedded_nodes = embed_pipeline.run(nodes=list(prepared_nodes), show_progress=True, num_workers=num_workers)
+        embedded_nodes = embed_pipeline.run(
+            nodes=list(prepared_nodes), show_progress=True, num_workers=pipeline_workers
+        )
         embedded_tokens = sum([count_tokens(node.get_content(), self._settings.embed_model) for node in embedded_nodes])
         logger.info(f"Embedded {len(embedded_nodes)} vectors with {embedded_tokens} tokens")
 
-        self._blocks_by_class_name = blocks_by_class_name
-        self._blocks_by_function_name = blocks_by_function_name
+        if isinstance(embedding, CachedEmbedding):
+            self._embedding_cache_stats = embedding.stats
+            logger.info(f"Embedding cache: {embedding.stats}")
 
         return len(embedded_nodes), embedded_tokens
 
     def persist(self, persist_dir: str):
-        self._vector_store.persist(persist_dir)
-        self._docstore.persist(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME))
+        """
+        Persist the index. The nodes and vector ids of FAISS vector stores are written to index columns, other vector
+        stores and the document store are persisted as JSON.
+        """
+        from moatless.index.columnar_store import remove_legacy_files, write_index_columns
+        from moatless.index.simple_faiss import SimpleFaissVectorStore
+
+        if isinstance(self._vector_store, SimpleFaissVectorStore):
+            self._vector_store.persist(persist_dir, persist_data=False)
+            write_index_columns(persist_dir, self._docstore, self._vector_store.data)
+            remove_legacy_files(persist_dir)
+        else:
+            self._vector_store.persist(persist_dir)
+            self._docstore.persist(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME))
+
         self._settings.persist(persist_dir)
 
         with open(os.path.join(persist_dir, "blocks_by_class_name.json"), "w") as f:
@@ -844,6 +1052,127 @@ class CodeIndex:
         with open(os.path.join(persist_dir, "blocks_by_function_name.json"), "w") as f:
             f.write(json.dumps(self._blocks_by_function_name, indent=2))
 
+        self._code_graph.persist(persist_dir)
+
+
+class _PersistedIndex:
+    """
+    The parts of a persisted index that don't depend on the file repository, so they can be shared.
+    """
+
+    __slots__ = (
+        "vector_store",
+        "docstore",
+        "settings",
+        "blocks_by_class_name",
+        "blocks_by_function_name",
+        "code_graph",
+        "__weakref__",
+    )
+
+    def __init__(
+        self, vector_store, docstore, settings, blocks_by_class_name, blocks_by_function_name, code_graph
+    ):
+        self.vector_store = vector_store
+        self.docstore = docstore
+        self.settings = settings
+        self.blocks_by_class_name = blocks_by_class_name
+        self.blocks_by_function_name = blocks_by_function_name
+        self.code_graph = code_graph
+
+    @classmethod
+    def load(cls, persist_dir: str, mmap: bool = False) -> "_PersistedIndex":
+        from moatless.index.columnar_store import (
+            ColumnarDocumentStore,
+            ColumnarVectorStoreData,
+            IndexColumns,
+            has_index_columns,
+        )
+        from moatless.index.simple_faiss import SimpleFaissVectorStore
+        from llama_index.core.storage.docstore import SimpleDocumentStore
+
+        settings = IndexSettings.from_persist_dir(persist_dir)
+
+        if has_index_columns(persist_dir):
+            columns = IndexColumns.from_persist_dir(persist_dir, mmap=mmap)
+            vector_store = SimpleFaissVectorStore.from_persist_dir(
+                persist_dir, index_settings=settings, mmap=mmap, data=ColumnarVectorStoreData(columns)
+            )
+            docstore = ColumnarDocumentStore(columns)
+        else:
+            # Indexes persisted before index columns, see columnar_store.convert_persist_dir()
+            vector_store = SimpleFaissVectorStore.from_persist_dir(persist_dir, index_settings=settings, mmap=mmap)
+            docstore = SimpleDocumentStore.from_persist_dir(persist_dir)
+
+        if os.path.exists(os.path.join(persist_dir, "blocks_by_class_name.json")):
+            with open(os.path.join(persist_dir, "blocks_by_class_name.json")) as f:
+                blocks_by_class_name = json.load(f)
+        else:
+            blocks_by_class_name = {}
+
+        if os.path.exists(os.path.join(persist_dir, "blocks_by_function_name.json")):
+            with open(os.path.join(persist_dir, "blocks_by_function_name.json")) as f:
+                blocks_by_function_name = json.load(f)
+        else:
+            blocks_by_function_name = {}
+
+        return cls(
+            vector_store=vector_store,
+            docstore=docstore,
+            settings=settings,
+            blocks_by_class_name=blocks_by_class_name,
+            blocks_by_function_name=blocks_by_function_name,
+            code_graph=CodeGraph.from_persist_dir(persist_dir),
+        )
+
+
+# Indexes loaded with shared=True by persist dir and load mode, dropped when no CodeIndex uses them anymore
+_shared_indexes: "weakref.WeakValueDictionary[tuple[str, bool], _PersistedIndex]" = weakref.WeakValueDictionary()
+_shared_index_locks: dict[tuple[str, bool], threading.Lock] = {}
+_shared_indexes_lock = threading.Lock()
+
+
+def _get_shared_index(persist_dir: str, mmap: bool) -> _PersistedIndex:
+    key = (os.path.realpath(persist_dir), mmap)
+
+    with _shared_indexes_lock:
+        persisted_index = _shared_indexes.get(key)
+        if persisted_index is not None:
+            return persisted_index
+        load_lock = _shared_index_locks.setdefault(key, threading.Lock())
+
+    # Threads loading the same index wait for the first one, other indexes are loaded in parallel
+    with load_lock:
+        persisted_index = _shared_indexes.get(key)
+        if persisted_index is None:
+            logger.info(f"Loading shared index from {persist_dir}.")
+            persisted_index = _PersistedIndex.load(persist_dir, mmap)
+            _shared_indexes[key] = persisted_index
+
+    return persisted_index
+
+
+def _git(repo_path: str, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=repo_path, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def _include_file(file_path: str, include_files: set[str], exclude_files: set[str], category: str | None) -> bool:
+    if exclude_files and file_path in exclude_files:
+        return False
+
+    if include_files and file_path not in include_files:
+        return False
+
+    if category == "implementation" and is_test(file_path):
+        return False
+
+    if category == "test" and not is_test(file_path):
+        return False
+
+    return True
+
 
 def _rerank_files(file_paths: list[str], file_pattern: str):
     if len(file_paths) < 2:
@@ -0,0 +1,571 @@
+"""
+Binary columnar storage of the nodes in a persisted index, replacing the JSON document store and vector store data.
+
+Each node is a row in numpy arrays with the vector ids, file path ids, categories, token counts, start and end lines
+and span ids of the nodes. Strings are stored once in utf-8 blobs indexed by offset arrays, and the chunk text is
+only read from its blob when a node is returned by a search.
+"""
+
+import bisect
+import json
+import logging
+import mmap
+import os
+import shutil
+from collections.abc import Iterator, Mapping
+from typing import Any
+
+import numpy as np
+from llama_index.core.schema import BaseNode, TextNode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+from moatless.index.simple_faiss import SimpleVectorStoreData, VectorFilterColumns
+
+logger = logging.getLogger(__name__)
+
+INDEX_COLUMNS_DIR = "index_columns"
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+
+# Files replaced by the index columns
+LEGACY_FILES = ("docstore.json", "vector_index.json")
+
+_MAX_INT32 = 2**31 - 1
+
+# Metadata set by the splitter, other metadata is stored as JSON
+_COLUMN_METADATA_KEYS = {
+    "file_path",
+    "file_name",
+    "file_type",
+    "category",
+    "tokens",
+    "start_line",
+    "end_line",
+    "span_ids",
+}
+
+# Node fields that are the same for all nodes created by the splitter
+_DEFAULT_NODE = TextNode()
+_DEFAULT_NODE_FIELDS = ("metadata_template", "metadata_separator", "text_template", "mimetype")
+
+
+def has_index_columns(persist_dir: str) -> bool:
+    return os.path.exists(os.path.join(persist_dir, INDEX_COLUMNS_DIR, MANIFEST_FILE))
+
+
+class _StringColumn:
+    """
+    Strings in a utf-8 blob, indexed by an array with the start offset of each string and the end of the last one.
+    """
+
+    def __init__(self, columns_dir: str, name: str, memory_map: bool = False):
+        self._offsets = np.load(os.path.join(columns_dir, f"{name}.offsets.npy"), mmap_mode="r" if memory_map else None)
+
+        path = os.path.join(columns_dir, f"{name}.bin")
+        with open(path, "rb") as f:
+            if not memory_map:
+                self._blob = f.read()
+            elif os.path.getsize(path) == 0:
+                # Empty files can't be memory-mapped
+                self._blob = b""
+            else:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._blob[int(self._offsets[i]) : int(self._offsets[i + 1])].decode("utf-8")
+
+    def index(self, value: str) -> int | None:
+        """
+        Returns the position of the value in a sorted column, or None if it's not in the column.
+        """
+        i = bisect.bisect_left(self, value)
+        if i < len(self) and self[i] == value:
+            return i
+        return None
+
+    @staticmethod
+    def write(columns_dir: str, name: str, values: list[str]):
+        encoded = [value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(os.path.join(columns_dir, f"{name}.offsets.npy"), offsets)
+        with open(os.path.join(columns_dir, f"{name}.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+
+
+class IndexColumns:
+    """
+    Read-only nodes of a persisted index. Rows are sorted by node id, so nodes are found by binary search.
+
+    With mmap the arrays and strings are memory-mapped instead of read into memory. The chunk text is always
+    memory-mapped and read when a node is requested.
+    """
+
+    def __init__(self, columns_dir: str, mmap: bool = False):
+        self._columns_dir = columns_dir
+
+        with open(os.path.join(columns_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+
+        if manifest.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index columns version {manifest.get('version')} in {columns_dir}.")
+
+        self._categories = manifest["categories"]
+        self._file_types = manifest["file_types"]
+        self._layouts = [
+            (
+                tuple(layout["metadata_keys"]),
+                list(layout["excluded_embed_metadata_keys"]),
+                list(layout["excluded_llm_metadata_keys"]),
+            )
+            for layout in manifest["layouts"]
+        ]
+
+        mmap_mode = "r" if mmap else None
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(columns_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        self._node_ids = _StringColumn(columns_dir, "node_ids", memory_map=mmap)
+        self._texts = _StringColumn(columns_dir, "texts", memory_map=True)
+        self._file_paths = _StringColumn(columns_dir, "file_paths", memory_map=mmap)
+        self._span_ids = _StringColumn(columns_dir, "span_ids", memory_map=mmap)
+        self._extra_metadata = _StringColumn(columns_dir, "extra_metadata", memory_map=mmap)
+
+        self._layout_ids = load("layout_ids")
+        self._file_ids = load("file_ids")
+        self._category_ids = load("category_ids")
+        self._tokens = load("tokens")
+        self._start_lines = load("start_lines")
+        self._end_lines = load("end_lines")
+        self._span_id_offsets = load("span_id_offsets")
+        self._span_id_refs = load("span_id_refs")
+        self._doc_hashes = load("doc_hashes")
+
+        # Sorted vector ids and the rows of their nodes
+        self._vector_ids = load("vector_ids")
+        self._vector_rows = load("vector_rows")
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, mmap: bool = False) -> "IndexColumns":
+        return cls(os.path.join(persist_dir, INDEX_COLUMNS_DIR), mmap=mmap)
+
+    def __len__(self) -> int:
+        return len(self._node_ids)
+
+    @property
+    def vector_count(self) -> int:
+        return len(self._vector_ids)
+
+    def row(self, node_id: str) -> int | None:
+        return self._node_ids.index(node_id)
+
+    def node_id(self, row: int) -> str:
+        return self._node_ids[row]
+
+    def text(self, row: int) -> str:
+        return self._texts[row]
+
+    def doc_hash(self, row: int) -> str:
+        return bytes(self._doc_hashes[row]).hex()
+
+    def file_path(self, row: int) -> str | None:
+        file_id = int(self._file_ids[row])
+        return self._file_paths[file_id] if file_id >= 0 else None
+
+    def metadata(self, row: int) -> dict[str, Any]:
+        metadata_keys, _, _ = self._layouts[self._layout_ids[row]]
+        extra_metadata = self._extra_metadata[row]
+        extra_metadata = json.loads(extra_metadata) if extra_metadata else {}
+
+        metadata = {}
+        for key in metadata_keys:
+            if key in extra_metadata:
+                metadata[key] = extra_metadata[key]
+            elif key == "file_path":
+                metadata[key] = self.file_path(row)
+            elif key == "file_name":
+                metadata[key] = os.path.basename(self.file_path(row))
+            elif key == "file_type":
+                metadata[key] = self._file_types[self._file_ids[row]]
+            elif key == "category":
+                metadata[key] = self._categories[self._category_ids[row]]
+            elif key == "start_line":
+                metadata[key] = int(self._start_lines[row])
+            elif key == "end_line":
+                metadata[key] = int(self._end_lines[row])
+            elif key == "tokens":
+                metadata[key] = int(self._tokens[row])
+            elif key == "span_ids":
+                start, end = self._span_id_offsets[row], self._span_id_offsets[row + 1]
+                metadata[key] = [self._span_ids[ref] for ref in self._span_id_refs[start:end]]
+
+        return metadata
+
+    def node(self, row: int) -> TextNode:
+        _, excluded_embed_metadata_keys, excluded_llm_metadata_keys = self._layouts[self._layout_ids[row]]
+        return TextNode(
+            id_=self.node_id(row),
+            text=self.text(row),
+            metadata=self.metadata(row),
+            excluded_embed_metadata_keys=list(excluded_embed_metadata_keys),
+            excluded_llm_metadata_keys=list(excluded_llm_metadata_keys),
+        )
+
+    def vector_row(self, vector_id: int) -> int | None:
+        i = int(np.searchsorted(self._vector_ids, vector_id))
+        if i < len(self._vector_ids) and self._vector_ids[i] == vector_id:
+            return int(self._vector_rows[i])
+        return None
+
+    def vector_ids(self) -> Iterator[int]:
+        for vector_id in self._vector_ids:
+            yield int(vector_id)
+
+    def filter_columns(self) -> VectorFilterColumns:
+        """
+        Returns the file path and category ids by vector id, without reading the metadata of each node.
+        """
+        size = int(self._vector_ids[-1]) + 1 if len(self._vector_ids) else 0
+        ids_by_vector = {}
+        for key, ids_by_row in (("file_path", self._file_ids), ("category", self._category_ids)):
+            ids = np.full(size, -1, dtype=np.int32)
+            ids[self._vector_ids] = ids_by_row[self._vector_rows]
+            ids_by_vector[key] = ids
+
+        return VectorFilterColumns(
+            values={
+                "file_path": [self._file_paths[i] for i in range(len(self._file_paths))],
+                "category": list(self._categories),
+            },
+            ids_by_vector=ids_by_vector,
+        )
+
+
+class _NodeMapping(Mapping):
+    def __init__(self, columns: IndexColumns):
+        self._columns = columns
+
+    def __getitem__(self, node_id: str) -> TextNode:
+        row = self._columns.row(node_id)
+        if row is None:
+            raise KeyError(node_id)
+        return self._columns.node(row)
+
+    def __contains__(self, node_id: object) -> bool:
+        return isinstance(node_id, str) and self._columns.row(node_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for row in range(len(self._columns)):
+            yield self._columns.node_id(row)
+
+    def __len__(self) -> int:
+        return len(self._columns)
+
+
+class ColumnarDocumentStore:
+    """
+    Read-only document store with the nodes in index columns. Use to_document_store() to get a document store that
+    nodes can be added to.
+    """
+
+    def __init__(self, columns: IndexColumns):
+        self._columns = columns
+
+    @property
+    def docs(self) -> Mapping[str, BaseNode]:
+        return _NodeMapping(self._columns)
+
+    def document_exists(self, doc_id: str) -> bool:
+        return self._columns.row(doc_id) is not None
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> BaseNode | None:
+        row = self._columns.row(doc_id)
+        if row is None:
+            if raise_error:
+                raise ValueError(f"doc_id {doc_id} not found.")
+            return None
+        return self._columns.node(row)
+
+    def get_node(self, node_id: str, raise_error: bool = True) -> BaseNode | None:
+        return self.get_document(node_id, raise_error=raise_error)
+
+    def get_document_hash(self, doc_id: str) -> str | None:
+        row = self._columns.row(doc_id)
+        return self._columns.doc_hash(row) if row is not None else None
+
+    def get_all_document_hashes(self) -> dict[str, str]:
+        return {self._columns.doc_hash(row): self._columns.node_id(row) for row in range(len(self._columns))}
+
+    def to_document_store(self):
+        from llama_index.core.storage.docstore import SimpleDocumentStore
+
+        docstore = SimpleDocumentStore()
+        docstore.add_documents(list(self.docs.values()), store_text=True)
+        docstore.set_document_hashes(
+            {self._columns.node_id(row): self._columns.doc_hash(row) for row in range(len(self._columns))}
+        )
+        return docstore
+
+
+class _VectorIdMapping(Mapping):
+    def __init__(self, columns: IndexColumns):
+        self._columns = columns
+
+    def __getitem__(self, vector_id: int) -> str:
+        row = self._columns.vector_row(vector_id)
+        if row is None:
+            raise KeyError(vector_id)
+        return self._columns.node_id(row)
+
+    def __iter__(self) -> Iterator[int]:
+        return self._columns.vector_ids()
+
+    def __len__(self) -> int:
+        return self._columns.vector_count
+
+
+class _RefDocIdMapping(_NodeMapping):
+    # Nodes in index columns have no source documents and are their own reference documents
+    def __getitem__(self, node_id: str) -> str:
+        if node_id not in self:
+            raise KeyError(node_id)
+        return node_id
+
+
+class _VectorMetadataMapping(_NodeMapping):
+    def __getitem__(self, node_id: str) -> dict[str, Any]:
+        metadata = node_to_metadata_dict(super().__getitem__(node_id), remove_text=True, flat_metadata=False)
+        metadata.pop("_node_content", None)
+        return metadata
+
+
+class ColumnarVectorStoreData:
+    """
+    Read-only vector store data with the same mappings as SimpleVectorStoreData, read from index columns.
+    """
+
+    def __init__(self, columns: IndexColumns):
+        self._columns = columns
+        self.vector_id_to_text_id = _VectorIdMapping(columns)
+        self.text_id_to_ref_doc_id = _RefDocIdMapping(columns)
+        self.metadata_dict = _VectorMetadataMapping(columns)
+
+    def to_vector_store_data(self) -> SimpleVectorStoreData:
+        return SimpleVectorStoreData(
+            text_id_to_ref_doc_id=dict(self.text_id_to_ref_doc_id),
+            vector_id_to_text_id=dict(self.vector_id_to_text_id),
+            metadata_dict=dict(self.metadata_dict),
+        )
+
+    def to_dict(self) -> dict:
+        return self.to_vector_store_data().to_dict()
+
+    def filter_columns(self) -> VectorFilterColumns:
+        return self._columns.filter_columns()
+
+
+def write_index_columns(persist_dir: str, docstore, vector_store_data) -> None:
+    """
+    Write the nodes in the document store and their vector ids to index columns in the persist dir. Nodes with
+    relationships to other nodes, or other node types than TextNode, can't be written to index columns.
+    """
+    columns_dir = os.path.join(persist_dir, INDEX_COLUMNS_DIR)
+    tmp_dir = f"{columns_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    docs = docstore.docs
+    node_ids = sorted(docs)
+    rows_by_node_id = {node_id: row for row, node_id in enumerate(node_ids)}
+
+    texts = []
+    extra_metadata = []
+    layout_ids = []
+    file_ids = []
+    category_ids = []
+    tokens = []
+    start_lines = []
+    end_lines = []
+    span_id_offsets = [0]
+    span_id_refs = []
+    doc_hashes = np.zeros((len(node_ids), 32), dtype=np.uint8)
+
+    layouts: dict[tuple, int] = {}
+    file_paths: dict[str, int] = {}
+    file_types: dict[int, str | None] = {}
+    categories: dict[str, int] = {}
+    span_ids: dict[str, int] = {}
+
+    for row, node_id in enumerate(node_ids):
+        node = docs[node_id]
+        _check_supported(node)
+
+        texts.append(node.text)
+        doc_hashes[row] = np.frombuffer(bytes.fromhex(docstore.get_document_hash(node_id) or node.hash), np.uint8)
+
+        metadata = node.metadata
+        layout = (
+            tuple(metadata.keys()),
+            tuple(node.excluded_embed_metadata_keys),
+            tuple(node.excluded_llm_metadata_keys),
+        )
+        layout_ids.append(layouts.setdefault(layout, len(layouts)))
+
+        # Values that can't be stored in the columns are stored as JSON
+        extra = {}
+
+        file_id = -1
+        file_path = metadata.get("file_path")
+        if isinstance(file_path, str):
+            file_id = file_paths.setdefault(file_path, len(file_paths))
+        elif "file_path" in metadata:
+            extra["file_path"] = file_path
+        file_ids.append(file_id)
+
+        if "file_name" in metadata and (file_id < 0 or metadata["file_name"] != os.path.basename(file_path)):
+            extra["file_name"] = metadata["file_name"]
+
+        if "file_type" in metadata:
+            file_type = file_types.setdefault(file_id, metadata["file_type"]) if file_id >= 0 else None
+            if file_id < 0 or file_type != metadata["file_type"]:
+                extra["file_type"] = metadata["file_type"]
+
+        category = metadata.get("category")
+        if isinstance(category, str):
+            category_ids.append(categories.setdefault(category, len(categories)))
+        else:
+            category_ids.append(-1)
+            if "category" in metadata:
+                extra["category"] = category
+
+        for key, values in (("tokens", tokens), ("start_line", start_lines), ("end_line", end_lines)):
+            value = metadata.get(key)
+            if type(value) is int and -_MAX_INT32 <= value <= _MAX_INT32:
+                values.append(value)
+            else:
+                values.append(0)
+                if key in metadata:
+                    extra[key] = value
+
+        node_span_ids = metadata.get("span_ids")
+        if isinstance(node_span_ids, list) and all(isinstance(span_id, str) for span_id in node_span_ids):
+            span_id_refs.extend(span_ids.setdefault(span_id, len(span_ids)) for span_id in node_span_ids)
+        elif "span_ids" in metadata:
+            extra["span_ids"] = node_span_ids
+        span_id_offsets.append(len(span_id_refs))
+
+        for key, value in metadata.items():
+            if key not in _COLUMN_METADATA_KEYS:
+                extra[key] = value
+
+        extra_metadata.append(json.dumps(extra) if extra else "")
+
+    vector_ids = []
+    vector_rows = []
+    missing_nodes = 0
+    for vector_id, text_id in vector_store_data.vector_id_to_text_id.items():
+        row = rows_by_node_id.get(text_id)
+        if row is None:
+            missing_nodes += 1
+            continue
+
+        ref_doc_id = vector_store_data.text_id_to_ref_doc_id.get(text_id, text_id)
+        if ref_doc_id != text_id:
+            raise ValueError(f"Node {text_id} with reference document {ref_doc_id} can't be written to index columns.")
+
+        vector_ids.append(int(vector_id))
+        vector_rows.append(row)
+
+    if missing_nodes:
+        logger.info(f"Skipped {missing_nodes} vectors without nodes in the document store.")
+
+    vector_order = np.argsort(np.array(vector_ids, dtype=np.int64), kind="stable")
+
+    def save(name: str, values, dtype) -> None:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(values, dtype=dtype))
+
+    _StringColumn.write(tmp_dir, "node_ids", node_ids)
+    _StringColumn.write(tmp_dir, "texts", texts)
+    _StringColumn.write(tmp_dir, "file_paths", list(file_paths))
+    _StringColumn.write(tmp_dir, "span_ids", list(span_ids))
+    _StringColumn.write(tmp_dir, "extra_metadata", extra_metadata)
+
+    save("layout_ids", layout_ids, np.uint16)
+    save("file_ids", file_ids, np.int32)
+    save("category_ids", category_ids, np.int16)
+    save("tokens", tokens, np.int32)
+    save("start_lines", start_lines, np.int32)
+    save("end_lines", end_lines, np.int32)
+    save("span_id_offsets", span_id_offsets, np.int64)
+    save("span_id_refs", span_id_refs, np.int32)
+    save("doc_hashes", doc_hashes, np.uint8)
+    save("vector_ids", np.array(vector_ids, dtype=np.int64)[vector_order], np.int64)
+    save("vector_rows", np.array(vector_rows, dtype=np.int32)[vector_order], np.int32)
+
+    manifest = {
+        "version": FORMAT_VERSION,
+        "categories": list(categories),
+        "file_types": [file_types.get(file_id) for file_id in range(len(file_paths))],
+        "layouts": [
+            {
+                "metadata_keys": list(metadata_keys),
+                "excluded_embed_metadata_keys": list(excluded_embed_metadata_keys),
+                "excluded_llm_metadata_keys": list(excluded_llm_metadata_keys),
+            }
+            for metadata_keys, excluded_embed_metadata_keys, excluded_llm_metadata_keys in layouts
+        ],
+    }
+
+    # Written last, so columns without a manifest are never loaded
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+
+    # Indexes loaded from the previous columns keep reading their open files
+    if os.path.exists(columns_dir):
+        old_dir = f"{columns_dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(columns_dir, old_dir)
+        os.replace(tmp_dir, columns_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(tmp_dir, columns_dir)
+
+    logger.info(f"Wrote {len(node_ids)} nodes and {len(vector_ids)} vector ids to {columns_dir}.")
+
+
+def _check_supported(node: BaseNode):
+    if (
+        type(node) is not TextNode
+        or node.relationships
+        or node.start_char_idx is not None
+        or node.end_char_idx is not None
+        or any(getattr(node, name) != getattr(_DEFAULT_NODE, name) for name in _DEFAULT_NODE_FIELDS)
+    ):
+        raise ValueError(f"Node {node.node_id} can't be written to index columns.")
+
+
+def convert_persist_dir(persist_dir: str, keep_legacy_files: bool = False) -> None:
+    """
+    Convert an index persisted with a JSON document store and vector store data to index columns.
+    """
+    from llama_index.core.storage.docstore import SimpleDocumentStore
+
+    docstore = SimpleDocumentStore.from_persist_dir(persist_dir)
+    with open(os.path.join(persist_dir, "vector_index.json")) as f:
+        vector_store_data = SimpleVectorStoreData.from_dict(json.load(f))
+
+    write_index_columns(persist_dir, docstore, vector_store_data)
+
+    if not keep_legacy_files:
+        remove_legacy_files(persist_dir)
+
+
+def remove_legacy_files(persist_dir: str) -> None:
+    for file_name in LEGACY_FILES:
+        path = os.path.join(persist_dir, file_name)
+        if os.path.exists(path):
+            os.remove(path)
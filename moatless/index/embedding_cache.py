@@ -0,0 +1,213 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+from moatless.utils.tokenizer import count_tokens
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "embeddings.sqlite"
+
+# Max number of parameters in a SQLite query
+_QUERY_BATCH_SIZE = 500
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings keyed by the embedding model, the number of dimensions and the SHA-256 hash of the
+    embedded text. Embeddings are stored as float32 in a SQLite database, which several processes can share.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._path = os.path.join(cache_dir, CACHE_FILE)
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+
+    def __getstate__(self):
+        # Connections can't be pickled, the cache is reopened when used in another process
+        return {"cache_dir": self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"])
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, "
+                "dimensions INTEGER NOT NULL, "
+                "text_hash BLOB NOT NULL, "
+                "embedding BLOB NOT NULL, "
+                "PRIMARY KEY (model, dimensions, text_hash)"
+                ") WITHOUT ROWID"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get_many(self, model: str, dimensions: int, text_hashes: Sequence[bytes]) -> list[list[float] | None]:
+        embeddings = {}
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(text_hashes), _QUERY_BATCH_SIZE):
+                batch = list(text_hashes[i : i + _QUERY_BATCH_SIZE])
+                rows = connection.execute(
+                    "SELECT text_hash, embedding FROM embeddings WHERE model = ? AND dimensions = ? "
+                    f"AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, dimensions, *batch],
+                )
+                for key, embedding in rows:
+                    embeddings[bytes(key)] = np.frombuffer(embedding, dtype=np.float32).tolist()
+
+        return [embeddings.get(key) for key in text_hashes]
+
+    def put_many(self, model: str, dimensions: int, embeddings: Sequence[tuple[bytes, list[float]]]):
+        rows = [
+            (model, dimensions, key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in embeddings
+        ]
+        with self._lock:
+            connection = self._connect()
+            connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+_default_cache: Optional[EmbeddingCache] = None
+
+
+def get_default_embedding_cache() -> EmbeddingCache | None:
+    """
+    Returns the embedding cache configured with the MOATLESS_EMBEDDING_CACHE_DIR environment variable, if set.
+    """
+    global _default_cache
+
+    cache_dir = os.getenv("MOATLESS_EMBEDDING_CACHE_DIR")
+    if not cache_dir:
+        return None
+
+    if _default_cache is None or _default_cache.cache_dir != cache_dir:
+        _default_cache = EmbeddingCache(cache_dir)
+
+    return _default_cache
+
+
+@dataclass
+class EmbeddingCacheStats:
+    hits: int = 0
+    misses: int = 0
+    hit_tokens: int = 0
+    saved_cost: float = 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} embedding cache hits and {self.misses} misses, "
+            f"saved {self.hit_tokens} tokens (${self.saved_cost:.4f})"
+        )
+
+
+class CachedEmbedding(TransformComponent):
+    """
+    Embeds nodes with the embed model, except nodes with the same embedded text as nodes embedded before with the same
+    model and dimensions, which get their embeddings from the cache. Used in the ingestion pipeline in place of the
+    embed model. Embed batches are sent in parallel with num_workers threads.
+    """
+
+    embed_model: BaseEmbedding
+    dimensions: int
+    num_workers: Optional[int] = None
+
+    _cache: EmbeddingCache = PrivateAttr()
+    _stats: EmbeddingCacheStats = PrivateAttr(default_factory=EmbeddingCacheStats)
+
+    def __init__(self, embed_model: BaseEmbedding, cache: EmbeddingCache, dimensions: int, **kwargs: Any):
+        super().__init__(embed_model=embed_model, dimensions=dimensions, **kwargs)
+        self._cache = cache
+
+    @property
+    def stats(self) -> EmbeddingCacheStats:
+        return self._stats
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> Sequence[BaseNode]:
+        model = self.embed_model.model_name
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        text_hashes = [text_hash(text) for text in texts]
+
+        embeddings = self._cache.get_many(model, self.dimensions, text_hashes)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        if missing:
+            new_embeddings = self._embed([texts[i] for i in missing])
+            self._cache.put_many(
+                model, self.dimensions, [(text_hashes[i], embedding) for i, embedding in zip(missing, new_embeddings)]
+            )
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = embedding
+
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+
+        hits = len(nodes) - len(missing)
+        self._stats.hits += hits
+        self._stats.misses += len(missing)
+
+        cost_per_token = _embedding_cost_per_token(model)
+        if hits and cost_per_token:
+            missing_set = set(missing)
+            hit_tokens = sum(count_tokens(text, model) for i, text in enumerate(texts) if i not in missing_set)
+            self._stats.hit_tokens += hit_tokens
+            self._stats.saved_cost += hit_tokens * cost_per_token
+
+        logger.info(f"Embedded {len(nodes)} nodes with {hits} embedding cache hits and {len(missing)} misses.")
+        return nodes
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        if not self.num_workers or self.num_workers <= 1:
+            return self.embed_model.get_text_embedding_batch(texts, show_progress=True)
+
+        batch_size = self.embed_model.embed_batch_size
+        batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            results = executor.map(self.embed_model.get_text_embedding_batch, batches)
+            return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+
+
+def _embedding_cost_per_token(model: str) -> float:
+    try:
+        import litellm
+    except ImportError:
+        return 0.0
+
+    for model_name in (model, f"voyage/{model}"):
+        cost = litellm.model_cost.get(model_name, {}).get("input_cost_per_token")
+        if cost:
+            return cost
+
+    return 0.0
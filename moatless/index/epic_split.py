@@ -10,7 +10,7 @@ from llama_index.core.node_parser.node_utils import logger
 from llama_index.core.schema import BaseNode, TextNode
 from llama_index.core.utils import get_tokenizer, get_tqdm_iterable
 
-from moatless.codeblocks import create_parser, CodeParser
+from moatless.codeblocks import create_parser, iter_parse_many, CodeParser
 from moatless.codeblocks.codeblocks import CodeBlock, CodeBlockType, PathTree
 from moatless.index.code_node import CodeNode
 from moatless.index.settings import CommentStrategy
@@ -56,6 +56,13 @@ class EpicSplitter(NodeParser):
     hard_token_limit: int = Field(default=6000, description="Hard token limit for a chunk.")
     repo_path: str = Field(default=None, description="Path to the repository.")
     index_callback: Optional[Callable] = Field(default=None, description="Callback to call when indexing a code block.")
+    min_lines_to_parse_block: int = Field(default=25, description="Min lines in a block to parse its children.")
+    parse_workers: Optional[int] = Field(
+        default=None, description="Number of processes to parse files in, files are parsed in the current process if not set."
+    )
+    enable_code_graph: bool = Field(
+        default=False, description="Whether to parse the relationships between code blocks, used to build a code graph."
+    )
     parser: CodeParser = Field(default=None, description="Code parser to use", exclude=True)
 
     def __init__(
@@ -73,6 +80,8 @@ class EpicSplitter(NodeParser):
         repo_path: Optional[str] = None,
         comment_strategy: CommentStrategy = CommentStrategy.ASSOCIATE,
         min_lines_to_parse_block: int = 25,
+        parse_workers: Optional[int] = None,
+        enable_code_graph: bool = False,
         include_non_code_files: bool = True,
         tokenizer: Optional[Callable] = None,
         non_code_file_extensions: list[str] | None = None,
@@ -86,7 +95,7 @@ class EpicSplitter(NodeParser):
             language=language,
             index_callback=index_callback,
             min_lines_to_parse_block=min_lines_to_parse_block,
-            enable_code_graph=False,
+            enable_code_graph=enable_code_graph,
         )
 
         super().__init__(
@@ -99,6 +108,9 @@ class EpicSplitter(NodeParser):
             hard_token_limit=hard_token_limit,
             max_chunks=max_chunks,
             index_callback=index_callback,
+            min_lines_to_parse_block=min_lines_to_parse_block,
+            parse_workers=parse_workers,
+            enable_code_graph=enable_code_graph,
             repo_path=repo_path,
             comment_strategy=comment_strategy,
             include_non_code_files=include_non_code_files,
@@ -123,15 +135,24 @@ class EpicSplitter(NodeParser):
 
         all_nodes: list[BaseNode] = []
 
-        for node in nodes_with_progress:
+        parsed_modules = None
+        if self.parse_workers and self.parse_workers > 1:
+            parsed_modules = self._parse_in_workers(nodes)
+
+        for i, node in enumerate(nodes_with_progress):
             file_path = node.metadata.get("file_path")
             content = node.get_content()
 
             try:
                 starttime = time.time_ns()
 
-                # TODO: Derive language from file extension
-                codeblock = self.parser.parse(content, file_path=file_path)
+                if parsed_modules is not None:
+                    codeblock = parsed_modules[i]
+                    if codeblock is None:
+                        raise ValueError(f"Failed to parse {file_path} in worker process")
+                else:
+                    # TODO: Derive language from file extension
+                    codeblock = self.parser.parse(content, file_path=file_path)
 
                 parse_time = time.time_ns() - starttime
                 if parse_time > 1e9:
@@ -162,6 +183,33 @@ class EpicSplitter(NodeParser):
                 logger.warning(f"Create nodes for file {file_path} took {parse_time / 1e9:.2f} seconds.")
         return all_nodes
 
+    def _parse_in_workers(self, nodes: Sequence[BaseNode]) -> list[CodeBlock | None]:
+        modules = [
+            module
+            for _, module in iter_parse_many(
+                [node.metadata.get("file_path") for node in nodes],
+                workers=self.parse_workers,
+                contents=[node.get_content() for node in nodes],
+                language=self.language,
+                min_lines_to_parse_block=self.min_lines_to_parse_block,
+                enable_code_graph=self.enable_code_graph,
+            )
+        ]
+
+        # The index callback can't be sent to the worker processes, call it in the same order as the parser does
+        if self.index_callback:
+            for module in modules:
+                if module:
+                    self._call_index_callback(module)
+
+        return modules
+
+    def _call_index_callback(self, codeblock: CodeBlock):
+        for child in codeblock.children:
+            if child.type != CodeBlockType.SPACE:
+                self._call_index_callback(child)
+        self.index_callback(codeblock)
+
     def _chunk_contents(
         self, codeblock: CodeBlock | None = None, file_path: Optional[str] = None
     ) -> list[CodeBlockChunk]:
@@ -1,6 +1,7 @@
 import json
 import os
 from enum import Enum
+from typing import Optional
 
 from pydantic import BaseModel, Field
 
@@ -16,6 +17,34 @@ class CommentStrategy(Enum):
     EXCLUDE = "exclude"
 
 
+class VectorIndexType(Enum):
+    # Exact brute-force search over all vectors
+    FLAT = "flat"
+
+    # Hierarchical navigable small world graph, no training needed
+    HNSW = "hnsw"
+
+    # Inverted file index over k-means clusters, trained on the vectors of the first ingestion
+    IVF_FLAT = "ivf_flat"
+
+    # Inverted file index with product quantized vectors, trained on the vectors of the first ingestion
+    IVF_PQ = "ivf_pq"
+
+
+class VectorEncoding(Enum):
+    # Raw float32 vectors
+    FLOAT32 = "float32"
+
+    # Scalar quantized to half precision floats, half the size
+    FLOAT16 = "float16"
+
+    # Scalar quantized to 8 bits per dimension, a quarter of the size, trained on the value range of each dimension
+    INT8 = "int8"
+
+    # Product quantized to pq_m codes of pq_nbits each, trained on the vectors of the first ingestion
+    PQ = "pq"
+
+
 class IndexSettings(BaseModel):
     embed_model: str = Field(default="text-embedding-3-small", description="The embedding model to use.")
     dimensions: int = Field(default=1536, description="The number of dimensions of the vectors.")
@@ -30,9 +59,40 @@ class IndexSettings(BaseModel):
         description="Strategy on how comments will be indexed.",
     )
 
+    index_type: VectorIndexType = Field(
+        default=VectorIndexType.FLAT,
+        description="The type of FAISS index used for the vector search.",
+    )
+    hnsw_m: int = Field(default=32, description="The number of neighbours per node in the HNSW graph.")
+    hnsw_ef_construction: int = Field(default=40, description="The HNSW search depth when vectors are added.")
+    hnsw_ef_search: int = Field(default=64, description="The HNSW search depth when querying (efSearch).")
+    ivf_nlist: Optional[int] = Field(
+        default=None,
+        description="The number of IVF clusters, derived from the number of vectors when the index is trained if not set.",
+    )
+    ivf_nprobe: int = Field(default=16, description="The number of IVF clusters visited when querying (nprobe).")
+    pq_m: int = Field(default=64, description="The number of sub-quantizers per vector in PQ encoded indexes.")
+    pq_nbits: int = Field(default=8, description="The number of bits per sub-quantizer code in PQ encoded indexes.")
+    vector_encoding: VectorEncoding = Field(
+        default=VectorEncoding.FLOAT32,
+        description="How the vectors are stored in the index, IVF-PQ indexes always use PQ.",
+    )
+    rerank_encoding: Optional[VectorEncoding] = Field(
+        default=None,
+        description="Store a second copy of the vectors with this encoding and re-rank the top candidates found with "
+        "the compressed vectors on their distances to it.",
+    )
+    rerank_k_factor: int = Field(
+        default=4, description="The number of candidates to re-rank, as a multiple of the number of results."
+    )
+
     def to_serializable_dict(self):
         data = self.dict()
         data["comment_strategy"] = data["comment_strategy"].value
+        data["index_type"] = data["index_type"].value
+        data["vector_encoding"] = data["vector_encoding"].value
+        if data["rerank_encoding"]:
+            data["rerank_encoding"] = data["rerank_encoding"].value
         return data
 
     def persist(self, persist_dir: str):
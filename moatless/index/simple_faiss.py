@@ -17,12 +17,18 @@ from llama_index.core.vector_stores.simple import _build_metadata_filter_fn
 from llama_index.core.vector_stores.types import (
     DEFAULT_PERSIST_DIR,
     BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
     VectorStoreQuery,
     VectorStoreQueryMode,
     VectorStoreQueryResult,
 )
 from llama_index.core.vector_stores.utils import node_to_metadata_dict
 
+from moatless.index.settings import IndexSettings, VectorEncoding, VectorIndexType
+
 logger = logging.getLogger(__name__)
 
 LEARNER_MODES = {
@@ -37,6 +43,152 @@ NAMESPACE_SEP = "__"
 DEFAULT_VECTOR_STORE = "default"
 
 
+def create_faiss_index(d: int, settings: IndexSettings | None = None, training_vectors: np.ndarray | None = None):
+    """
+    Create an empty FAISS index with the index type and vector encodings in the settings. Indexes that need training,
+    IVF indexes and int8 or PQ encoded vectors, are trained on the training vectors. If there are too few of them to
+    train on, an exact flat index is created instead.
+    """
+    if settings is None:
+        return faiss.IndexIDMap(faiss.IndexFlatL2(d))
+
+    index_type = settings.index_type
+    encoding = VectorEncoding.PQ if index_type == VectorIndexType.IVF_PQ else settings.vector_encoding
+    vector_count = len(training_vectors) if training_vectors is not None else 0
+
+    if settings.rerank_encoding == VectorEncoding.PQ:
+        raise ValueError("Vectors can't be re-ranked on PQ encoded vectors.")
+
+    min_training_vectors = 0
+    if encoding == VectorEncoding.PQ:
+        if d % settings.pq_m != 0:
+            raise ValueError(f"The dimensions {d} must be a multiple of pq_m {settings.pq_m}.")
+        min_training_vectors = 2**settings.pq_nbits
+    elif VectorEncoding.INT8 in (encoding, settings.rerank_encoding):
+        min_training_vectors = 1
+
+    description = _encoding_description(encoding, settings)
+    if index_type in (VectorIndexType.IVF_FLAT, VectorIndexType.IVF_PQ):
+        nlist = settings.ivf_nlist or _default_nlist(vector_count)
+        min_training_vectors = max(min_training_vectors, nlist)
+        description = f"IVF{nlist},{description}"
+    elif index_type == VectorIndexType.HNSW:
+        description = f"HNSW{settings.hnsw_m},{description}"
+
+    if settings.rerank_encoding:
+        description += f",Refine({_encoding_description(settings.rerank_encoding, settings)})"
+
+    # IVF indexes map vector ids themselves, other indexes and the re-ranking wrapper don't support ids
+    if index_type not in (VectorIndexType.IVF_FLAT, VectorIndexType.IVF_PQ) or settings.rerank_encoding:
+        description = f"IDMap,{description}"
+
+    if vector_count < min_training_vectors:
+        logger.info(
+            f"Too few vectors ({vector_count}) to train a {description} index, use a flat index instead."
+        )
+        return faiss.IndexIDMap(faiss.IndexFlatL2(d))
+
+    faiss_index = faiss.index_factory(d, description)
+
+    refine_index, base_index = _unwrap_index(faiss_index)
+    pq_index = base_index
+    if isinstance(base_index, faiss.IndexHNSW):
+        base_index.hnsw.efConstruction = settings.hnsw_ef_construction
+        pq_index = faiss.downcast_index(base_index.storage)
+    if isinstance(pq_index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        # Polysemous codes are only used by Hamming distance searches and are slow to train
+        pq_index.do_polysemous_training = False
+    if refine_index is not None:
+        refine_index.k_factor = settings.rerank_k_factor
+
+    if not faiss_index.is_trained:
+        logger.info(f"Training {description} index on {vector_count} vectors.")
+        faiss_index.train(np.ascontiguousarray(training_vectors, dtype="float32"))
+
+    return faiss_index
+
+
+def read_faiss_index(path: str, mmap: bool = False):
+    if not mmap:
+        return faiss.read_index(path)
+
+    try:
+        # Maps the vector codes of flat, scalar quantized, PQ and HNSW indexes
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # The inverted lists of IVF indexes can only be mapped on their own
+        logger.debug(f"Memory-map the inverted lists of {path}.")
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def remove_faiss_ids(faiss_index: Any, vector_ids: np.ndarray) -> int:
+    """
+    Remove the vectors with the given ids from the index and return how many were removed. HNSW indexes and indexes
+    re-ranking vectors don't support removing vectors, they're compacted by re-adding the vectors that are kept.
+    """
+    try:
+        return faiss_index.remove_ids(vector_ids)
+    except RuntimeError:
+        if not isinstance(faiss_index, faiss.IndexIDMap):
+            raise
+
+    index_ids = faiss.vector_to_array(faiss_index.id_map)
+    keep = ~np.isin(index_ids, vector_ids)
+    removed = len(index_ids) - int(np.count_nonzero(keep))
+    if not removed:
+        return 0
+
+    # Reconstructed from the re-ranking vectors of indexes with re-ranking
+    vectors = faiss_index.index.reconstruct_n(0, faiss_index.ntotal)
+    logger.info(f"Rebuild index with {len(index_ids) - removed} vectors to remove {removed} vectors.")
+    faiss_index.reset()
+    faiss_index.add_with_ids(vectors[keep], index_ids[keep])
+    return removed
+
+
+def requires_training(settings: IndexSettings | None) -> bool:
+    if settings is None:
+        return False
+
+    return (
+        settings.index_type in (VectorIndexType.IVF_FLAT, VectorIndexType.IVF_PQ)
+        or settings.vector_encoding in (VectorEncoding.INT8, VectorEncoding.PQ)
+        or settings.rerank_encoding == VectorEncoding.INT8
+    )
+
+
+def _encoding_description(encoding: VectorEncoding, settings: IndexSettings) -> str:
+    if encoding == VectorEncoding.FLOAT16:
+        return "SQfp16"
+    if encoding == VectorEncoding.INT8:
+        return "SQ8"
+    if encoding == VectorEncoding.PQ:
+        return f"PQ{settings.pq_m}x{settings.pq_nbits}"
+    return "Flat"
+
+
+def _unwrap_index(faiss_index: Any) -> tuple[Any, Any]:
+    """
+    Returns the re-ranking index, if there is one, and the index searching the vectors. They're owned by the given
+    index, which has to be kept referenced while they're used.
+    """
+    index = faiss_index
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+
+    refine_index = None
+    if isinstance(index, faiss.IndexRefine):
+        refine_index = index
+        index = faiss.downcast_index(index.base_index)
+
+    return refine_index, index
+
+
+def _default_nlist(vector_count: int) -> int:
+    # About 4 * sqrt(n) clusters, with at least 39 training vectors per cluster as recommended by FAISS
+    return max(1, min(int(4 * np.sqrt(vector_count)), vector_count // 39))
+
+
 @dataclass
 class SimpleVectorStoreData(DataClassJsonMixin):
     text_id_to_ref_doc_id: dict[str, str] = field(default_factory=dict)
@@ -44,6 +196,92 @@ class SimpleVectorStoreData(DataClassJsonMixin):
     metadata_dict: dict[str, Any] = field(default_factory=dict)
 
 
+# Metadata that searches can be filtered on inside the FAISS search
+FILTER_COLUMN_KEYS = ("file_path", "category")
+
+
+class VectorFilterColumns:
+    """
+    The file path and category of each vector, as ids into tables of the distinct values in arrays indexed by vector
+    id, to filter searches on without reading the metadata of each vector.
+    """
+
+    def __init__(self, values: dict[str, list[str]] | None = None, ids_by_vector: dict[str, np.ndarray] | None = None):
+        values = values or {}
+        ids_by_vector = ids_by_vector or {}
+        self._ids_by_value = {
+            key: {value: i for i, value in enumerate(values.get(key, []))} for key in FILTER_COLUMN_KEYS
+        }
+        self._ids_by_vector = {
+            key: ids_by_vector.get(key, np.full(0, -1, dtype=np.int32)) for key in FILTER_COLUMN_KEYS
+        }
+
+    @classmethod
+    def from_data(cls, data: SimpleVectorStoreData) -> "VectorFilterColumns":
+        filter_columns = cls()
+        vector_ids = np.fromiter((int(vector_id) for vector_id in data.vector_id_to_text_id), dtype=np.int64)
+        metadata = [data.metadata_dict.get(text_id, {}) for text_id in data.vector_id_to_text_id.values()]
+        filter_columns.add(vector_ids, {key: [values.get(key) for values in metadata] for key in FILTER_COLUMN_KEYS})
+        return filter_columns
+
+    def values(self, key: str) -> list[str]:
+        return list(self._ids_by_value[key])
+
+    def add(self, vector_ids: np.ndarray, values: dict[str, list[Any]]):
+        if not len(vector_ids):
+            return
+
+        size = int(vector_ids.max()) + 1
+        for key in FILTER_COLUMN_KEYS:
+            ids_by_value = self._ids_by_value[key]
+            ids = self._ids_by_vector[key]
+            if len(ids) < size:
+                ids = np.concatenate([ids, np.full(size - len(ids), -1, dtype=np.int32)])
+                self._ids_by_vector[key] = ids
+
+            ids[vector_ids] = [
+                ids_by_value.setdefault(value, len(ids_by_value)) if isinstance(value, str) else -1
+                for value in values[key]
+            ]
+
+    def mask(self, filters: MetadataFilters) -> np.ndarray | None:
+        """
+        Returns which vector ids match the filters, or None if the filters aren't on the filter columns.
+        """
+        if filters.condition not in (FilterCondition.AND, FilterCondition.OR):
+            return None
+
+        masks = []
+        for metadata_filter in filters.filters:
+            if (
+                not isinstance(metadata_filter, MetadataFilter)
+                or metadata_filter.key not in FILTER_COLUMN_KEYS
+                or metadata_filter.operator
+                not in (FilterOperator.EQ, FilterOperator.NE, FilterOperator.IN, FilterOperator.NIN)
+            ):
+                return None
+
+            ids_by_value = self._ids_by_value[metadata_filter.key]
+            if metadata_filter.operator in (FilterOperator.IN, FilterOperator.NIN):
+                values = metadata_filter.value or []
+            else:
+                values = [metadata_filter.value]
+
+            # The last value is for vectors without a value, at id -1
+            value_mask = np.zeros(len(ids_by_value) + 1, dtype=bool)
+            value_mask[[ids_by_value[value] for value in values if value in ids_by_value]] = True
+            if metadata_filter.operator in (FilterOperator.NE, FilterOperator.NIN):
+                value_mask = ~value_mask
+
+            masks.append(value_mask[self._ids_by_vector[metadata_filter.key]])
+
+        if not masks:
+            return None
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+
 class SimpleFaissVectorStore(BasePydanticVectorStore):
     """Simple Vector Store using Faiss."""
 
@@ -53,6 +291,11 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
     _data: SimpleVectorStoreData = PrivateAttr()
     _fs: fsspec.AbstractFileSystem = PrivateAttr()
     _faiss_index: Any = PrivateAttr()
+    _index_settings: IndexSettings | None = PrivateAttr(None)
+    # The index file of indexes that are memory-mapped read-only
+    _mmap_path: str | None = PrivateAttr(None)
+
+    _filter_columns: VectorFilterColumns | None = PrivateAttr(None)
 
     _vector_ids_to_delete: list[int] = PrivateAttr(default_factory=list)
     _text_ids_to_delete: set[str] = PrivateAttr(default_factory=set)
@@ -63,9 +306,13 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
         d: int = 1536,
         data: SimpleVectorStoreData | None = None,
         fs: fsspec.AbstractFileSystem | None = None,
+        index_settings: IndexSettings | None = None,
         **kwargs: Any,
     ) -> None:
-        """Initialize params."""
+        """
+        Initialize params. If faiss_index is None, an index of the type in index_settings is created when the first
+        vectors are added, so that IVF indexes can be trained on them.
+        """
         super().__init__(d=d, **kwargs)  # Pass d to parent constructor
 
         import_err_msg = """
@@ -81,17 +328,54 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
         self._faiss_index = cast(faiss.Index, faiss_index)
         self._data = data or SimpleVectorStoreData()
         self._fs = fs or fsspec.filesystem("file")
+        self._index_settings = index_settings
 
     @classmethod
-    def from_defaults(cls, d: int = 1536):
-        faiss_index = faiss.IndexIDMap(faiss.IndexFlatL2(1536))
-        return cls(faiss_index, d)
+    def from_defaults(cls, d: int = 1536, index_settings: IndexSettings | None = None):
+        if requires_training(index_settings):
+            # Trained on the first vectors added
+            faiss_index = None
+        else:
+            faiss_index = create_faiss_index(d, index_settings)
+        return cls(faiss_index, d, index_settings=index_settings)
 
     @property
     def client(self) -> Any:
         """Return the faiss index."""
         return self._faiss_index
 
+    @property
+    def data(self) -> SimpleVectorStoreData:
+        return self._data
+
+    def metadata_values(self, key: str) -> list[str]:
+        """
+        Returns the distinct values of the file_path or category metadata of the vectors in the store.
+        """
+        return self._get_filter_columns().values(key)
+
+    def _get_filter_columns(self) -> VectorFilterColumns:
+        if self._filter_columns is None:
+            if isinstance(self._data, SimpleVectorStoreData):
+                self._filter_columns = VectorFilterColumns.from_data(self._data)
+            else:
+                self._filter_columns = self._data.filter_columns()
+        return self._filter_columns
+
+    def _writable_data(self) -> SimpleVectorStoreData:
+        if not isinstance(self._data, SimpleVectorStoreData):
+            # Data loaded from index columns is read-only
+            self._data = self._data.to_vector_store_data()
+        return self._data
+
+    def _writable_index(self) -> Any:
+        if self._mmap_path is not None:
+            # Memory-mapped indexes are read-only, the index is read into memory before it's changed
+            logger.info(f"Read memory-mapped index {self._mmap_path} into memory to change it.")
+            self._faiss_index = faiss.read_index(self._mmap_path)
+            self._mmap_path = None
+        return self._faiss_index
+
     def add(
         self,
         nodes: list[BaseNode],
@@ -102,48 +386,111 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
         if not nodes:
             return []
 
-        vector_id = max([int(k) for k in self._data.vector_id_to_text_id]) if self._data.vector_id_to_text_id else 0
+        self._remove_deleted_vectors()
+
+        data = self._writable_data()
+        vector_id = max([int(k) for k in data.vector_id_to_text_id]) + 1 if data.vector_id_to_text_id else 0
 
         logger.info(f"Adding {len(nodes)} nodes to index, start at id {vector_id}.")
 
         embeddings = []
         ids = []
+        filter_values = {key: [] for key in FILTER_COLUMN_KEYS}
         for node in nodes:
             embeddings.append(node.get_embedding())
             ids.append(int(vector_id))
-            self._data.vector_id_to_text_id[vector_id] = node.id_
-            self._data.text_id_to_ref_doc_id[node.id_] = node.ref_doc_id or node.id_
+            for key in FILTER_COLUMN_KEYS:
+                filter_values[key].append(node.metadata.get(key))
+            data.vector_id_to_text_id[vector_id] = node.id_
+            data.text_id_to_ref_doc_id[node.id_] = node.ref_doc_id or node.id_
             vector_id += 1
 
             metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
             metadata.pop("_node_content", None)
-            self._data.metadata_dict[node.node_id] = metadata
+            data.metadata_dict[node.node_id] = metadata
 
-        vectors_ndarray = np.array(embeddings)
-        ids_ndarray = np.array(ids)
+        vectors_ndarray = np.array(embeddings, dtype="float32")
+        ids_ndarray = np.array(ids, dtype=np.int64)
 
-        self._faiss_index.add_with_ids(vectors_ndarray, ids_ndarray)
+        if self._faiss_index is None:
+            self._faiss_index = create_faiss_index(self.d, self._index_settings, vectors_ndarray)
+
+        self._writable_index().add_with_ids(vectors_ndarray, ids_ndarray)
+
+        if self._filter_columns is not None:
+            self._filter_columns.add(ids_ndarray, filter_values)
 
         return [node.node_id for node in nodes]
 
     def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
         """
-        Delete nodes using with ref_doc_id.
+        Delete nodes using with ref_doc_id. The vectors are removed from the FAISS index in one batch before the next
+        add, query or persist.
 
         Args:
             ref_doc_id (str): The doc_id of the document to delete.
 
         """
 
-        self._text_ids_to_delete = set()
-        for text_id, ref_doc_id_ in self._data.text_id_to_ref_doc_id.items():
+        data = self._writable_data()
+
+        text_ids = set()
+        for text_id, ref_doc_id_ in data.text_id_to_ref_doc_id.items():
             if ref_doc_id == ref_doc_id_:
-                self._text_ids_to_delete.add(text_id)
+                text_ids.add(text_id)
+
+        self._mark_deleted(text_ids)
 
+    def delete_nodes(
+        self,
+        node_ids: list[str] | None = None,
+        filters: MetadataFilters | None = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        """
+        Delete the nodes with the given node ids and remove their vectors from the FAISS index.
+        """
+        if filters is not None:
+            raise NotImplementedError("Deleting nodes by metadata filters is not supported.")
+
+        self._writable_data()
+        self._mark_deleted(set(node_ids or []))
+        self._remove_deleted_vectors()
+
+    def _mark_deleted(self, text_ids: set[str]):
+        if not text_ids:
+            return
+
+        self._text_ids_to_delete.update(text_ids)
         for vector_id, text_id in self._data.vector_id_to_text_id.items():
-            if text_id in self._text_ids_to_delete:
+            if text_id in text_ids:
                 self._vector_ids_to_delete.append(vector_id)
 
+    def _remove_deleted_vectors(self):
+        if not self._vector_ids_to_delete and not self._text_ids_to_delete:
+            return
+
+        data = self._writable_data()
+
+        if self._vector_ids_to_delete and self._faiss_index is not None:
+            ids_to_remove_array = np.array(self._vector_ids_to_delete, dtype=np.int64)
+            removed = remove_faiss_ids(self._writable_index(), ids_to_remove_array)
+            logger.info(f"Removed {removed} vectors from index.")
+
+        for vector_id in self._vector_ids_to_delete:
+            text_id = data.vector_id_to_text_id.pop(vector_id, None)
+            if text_id:
+                data.text_id_to_ref_doc_id.pop(text_id, None)
+
+        for text_id in self._text_ids_to_delete:
+            data.metadata_dict.pop(text_id, None)
+
+        self._vector_ids_to_delete = []
+        self._text_ids_to_delete = set()
+
+        # Rebuilt without the removed vectors when needed
+        self._filter_columns = None
+
     def query(
         self,
         query: VectorStoreQuery,
@@ -154,13 +501,55 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
         Args:
             query_embedding (List[float]): query embedding
             similarity_top_k (int): top k most similar nodes
+            nprobe (int): number of clusters to visit in IVF indexes, overrides the index settings
+            ef_search (int): search depth in HNSW indexes, overrides the index settings
+            rerank_k_factor (int): number of candidates to re-rank as a multiple of top k, overrides the index settings
 
         """
-        query_filter_fn = _build_metadata_filter_fn(lambda node_id: self._data.metadata_dict[node_id], query.filters)
+        self._remove_deleted_vectors()
+
+        if self._faiss_index is None:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        query_filters = query.filters
+        selector_mask = None
+        if query.filters:
+            selector_mask = self._get_filter_columns().mask(query.filters)
+            if selector_mask is not None:
+                if not selector_mask.any():
+                    return VectorStoreQueryResult(similarities=[], ids=[])
+                # Applied in the FAISS search instead
+                query_filters = None
+
+        query_filter_fn = _build_metadata_filter_fn(lambda node_id: self._data.metadata_dict[node_id], query_filters)
 
         query_embedding = cast(list[float], query.query_embedding)
         query_embedding_np = np.array(query_embedding, dtype="float32")[np.newaxis, :]
-        dists, indices = self._faiss_index.search(query_embedding_np, query.similarity_top_k)
+
+        nprobe = kwargs.get("nprobe")
+        ef_search = kwargs.get("ef_search")
+        while True:
+            search_params = self._search_parameters(
+                nprobe=nprobe,
+                ef_search=ef_search,
+                rerank_k_factor=kwargs.get("rerank_k_factor"),
+                selector_mask=selector_mask,
+            )
+            dists, indices = self._faiss_index.search(query_embedding_np, query.similarity_top_k, params=search_params)
+            if selector_mask is None:
+                break
+
+            # Filtered IVF and HNSW searches only find the matching vectors in the part of the index they visit
+            expected_hits = min(query.similarity_top_k, int(np.count_nonzero(selector_mask)))
+            if np.count_nonzero(indices[0] >= 0) >= expected_hits:
+                break
+
+            wider_search = self._wider_search(nprobe, ef_search)
+            if wider_search is None:
+                break
+            nprobe, ef_search = wider_search
+            logger.debug(f"Search again with nprobe {nprobe} and ef_search {ef_search} to fill the page.")
+
         dists = list(dists[0])
 
         if len(indices) == 0:
@@ -196,12 +585,82 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
 
         return VectorStoreQueryResult(similarities=filtered_dists, ids=filtered_node_ids)
 
+    def _search_parameters(
+        self,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        rerank_k_factor: int | None = None,
+        selector_mask: np.ndarray | None = None,
+    ):
+        refine_index, base_index = _unwrap_index(self._faiss_index)
+
+        params = None
+        if isinstance(base_index, faiss.IndexHNSW):
+            ef_search = ef_search or (self._index_settings.hnsw_ef_search if self._index_settings else None)
+            if ef_search:
+                params = faiss.SearchParametersHNSW(efSearch=ef_search)
+        elif faiss.try_extract_index_ivf(base_index) is not None:
+            nprobe = nprobe or (self._index_settings.ivf_nprobe if self._index_settings else None)
+            if nprobe:
+                params = faiss.SearchParametersIVF(nprobe=nprobe)
+
+        if selector_mask is not None:
+            bitmap = np.packbits(selector_mask, bitorder="little")
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            selector.referenced_objects = [bitmap]
+            if refine_index is not None:
+                # The base index is searched by its position ids, mapped to vector ids by the IDMap around it
+                translated_selector = faiss.IDSelectorTranslated(self._faiss_index.id_map, selector)
+                translated_selector.referenced_objects = [selector]
+                selector = translated_selector
+
+            if params is None:
+                params = faiss.SearchParameters()
+            params.sel = selector
+            params.referenced_objects = [selector]
+
+        if refine_index is not None:
+            refine_params = faiss.IndexRefineSearchParameters(k_factor=rerank_k_factor or refine_index.k_factor)
+            if params is not None:
+                refine_params.base_index_params = params
+                # Only referenced from C++ by the refine parameters, which would let it be garbage collected
+                refine_params.referenced_objects = [params]
+            return refine_params
+
+        return params
+
+    def _wider_search(self, nprobe: int | None, ef_search: int | None) -> tuple[int | None, int | None] | None:
+        """
+        Returns a doubled nprobe or ef_search for IVF and HNSW indexes, or None if the whole index is already searched.
+        """
+        _, base_index = _unwrap_index(self._faiss_index)
+
+        if isinstance(base_index, faiss.IndexHNSW):
+            ef_search = ef_search or (self._index_settings.hnsw_ef_search if self._index_settings else None)
+            ef_search = ef_search or base_index.hnsw.efSearch
+            if ef_search >= base_index.ntotal:
+                return None
+            return nprobe, ef_search * 2
+
+        ivf_index = faiss.try_extract_index_ivf(base_index)
+        if ivf_index is not None:
+            nprobe = nprobe or (self._index_settings.ivf_nprobe if self._index_settings else None) or ivf_index.nprobe
+            if nprobe >= ivf_index.nlist:
+                return None
+            return min(nprobe * 2, ivf_index.nlist), ef_search
+
+        return None
+
     def persist(
         self,
         persist_dir: str = DEFAULT_PERSIST_DIR,
         fs: fsspec.AbstractFileSystem | None = None,
+        persist_data: bool = True,
     ) -> None:
-        """Persist the SimpleVectorStore to a directory."""
+        """
+        Persist the SimpleVectorStore to a directory. Without persist_data only the FAISS index is written, and the
+        vector store data is persisted by the caller, as in the index columns written by CodeIndex.
+        """
         fs = fs or self._fs
 
         # I don't think FAISS supports fsspec, it requires a path in the SWIG interface
@@ -213,35 +672,33 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
         if not os.path.exists(persist_dir):
             os.makedirs(persist_dir)
 
-        logger.info(f"Deleting {len(self._vector_ids_to_delete)} vectors from index.")
+        self._remove_deleted_vectors()
 
-        if self._vector_ids_to_delete:
-            ids_to_remove_array = np.array(self._vector_ids_to_delete, dtype=np.int64)
-            removed = self._faiss_index.remove_ids(ids_to_remove_array)
-            logger.info(f"Removed {removed} vectors from index.")
+        index_path = f"{persist_dir}/vector_index.faiss"
+        # An unchanged memory-mapped index is already persisted, and can't be written over while it's mapped
+        if self._faiss_index is not None and not (
+            self._mmap_path and os.path.realpath(self._mmap_path) == os.path.realpath(index_path)
+        ):
+            faiss.write_index(self._faiss_index, index_path)
 
-        if self._text_ids_to_delete:
-            for text_id in self._text_ids_to_delete:
-                if self._data.metadata_dict is not None:
-                    self._data.metadata_dict.pop(text_id, None)
-
-        faiss.write_index(self._faiss_index, f"{persist_dir}/vector_index.faiss")
-
-        for vector_id in self._vector_ids_to_delete:
-            text_id = self._data.vector_id_to_text_id.pop(vector_id, None)
-            if text_id:
-                self._data.text_id_to_ref_doc_id.pop(text_id, None)
-
-        self._vector_ids_to_delete = []
-
-        with fs.open(f"{persist_dir}/vector_index.json", "w") as f:
-            json.dump(self._data.to_dict(), f)
+        if persist_data:
+            with fs.open(f"{persist_dir}/vector_index.json", "w") as f:
+                json.dump(self._data.to_dict(), f)
 
     @classmethod
     def from_persist_dir(
-        cls, persist_dir: str, fs: fsspec.AbstractFileSystem | None = None
+        cls,
+        persist_dir: str,
+        fs: fsspec.AbstractFileSystem | None = None,
+        index_settings: IndexSettings | None = None,
+        mmap: bool = False,
+        data: Any = None,
     ) -> "SimpleFaissVectorStore":
-        """Create a SimpleKVStore from a persist directory."""
+        """
+        Create a SimpleKVStore from a persist directory. With mmap the vectors are memory-mapped read-only from the index
+        file instead of being read into memory, so processes loading the same index share the pages in the page cache.
+        The vector store data is read from vector_index.json, unless it's provided, e.g. from index columns.
+        """
 
         fs = fs or fsspec.filesystem("file")
         if not fs.exists(persist_dir):
@@ -252,16 +709,26 @@ class SimpleFaissVectorStore(BasePydanticVectorStore):
         if fs and not isinstance(fs, LocalFileSystem):
             raise NotImplementedError("FAISS only supports local storage for now.")
 
-        faiss_index = faiss.read_index(f"{persist_dir}/vector_index.faiss")
+        # No index file is written before any vectors are added to untrained indexes
+        if os.path.exists(f"{persist_dir}/vector_index.faiss"):
+            faiss_index = read_faiss_index(f"{persist_dir}/vector_index.faiss", mmap=mmap)
+            d = faiss_index.d
+        else:
+            faiss_index = None
+            d = index_settings.dimensions if index_settings else 1536
 
-        logger.debug(f"Loading {__name__} from {persist_dir}.")
-        with fs.open(f"{persist_dir}/vector_index.json", "rb") as f:
-            data_dict = json.load(f)
-            data = SimpleVectorStoreData.from_dict(data_dict)
+        if data is None:
+            logger.debug(f"Loading {__name__} from {persist_dir}.")
+            with fs.open(f"{persist_dir}/vector_index.json", "rb") as f:
+                data_dict = json.load(f)
+                data = SimpleVectorStoreData.from_dict(data_dict)
 
         logger.info(f"Loading {__name__} from {persist_dir}.")
 
-        return cls(faiss_index=faiss_index, data=data)
+        vector_store = cls(faiss_index=faiss_index, d=d, data=data, index_settings=index_settings)
+        if mmap and faiss_index is not None:
+            vector_store._mmap_path = f"{persist_dir}/vector_index.faiss"
+        return vector_store
 
     @classmethod
     def from_index(cls, faiss_index: Any):
@@ -11,6 +11,7 @@ from pydantic import BaseModel, Field, PrivateAttr
 
 from moatless.codeblocks import get_parser_by_path
 from moatless.codeblocks.module import Module
+from moatless.codeblocks.parser.parser import OUTLINE_MIN_LINES
 from moatless.repository.repository import Repository
 
 logger = logging.getLogger(__name__)
@@ -87,7 +88,9 @@ class CodeFile(BaseModel):
         if self._module is None or self.has_been_modified() and self.content.strip():
             parser = get_parser_by_path(self.file_path)
             if parser:
-                self._module = parser.parse(self.content)
+                # Function bodies in large files are parsed when spans, paths or lines in them are looked up
+                outline = self.content.count("\n") >= OUTLINE_MIN_LINES
+                self._module = parser.parse(self.content, outline=outline)
             else:
                 return None
 
@@ -0,0 +1,486 @@
+"""
+Benchmark the codeblocks parser on a corpus of the test fixtures and synthetic large Python and Java files.
+
+Reports files, lines, tree-sitter nodes and code blocks parsed per second, peak and retained memory, and a breakdown of
+the parse time into tree-sitter parsing, query matching, reference extraction, token counting, post processing and
+building the module graph. Results can be saved as a JSON baseline and compared with later runs:
+
+    python scripts/benchmark_parser.py --save baseline.json
+    python scripts/benchmark_parser.py --compare baseline.json
+"""
+
+import argparse
+import gc
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib.metadata import version
+
+import moatless.codeblocks.parser.parser as parser_module
+from moatless.codeblocks.parser.java import JavaParser
+from moatless.codeblocks.parser.parser import CodeParser
+from moatless.codeblocks.parser.python import PythonParser
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "..", "tests", "codeblocks", "data")
+
+BASELINE_FORMAT_VERSION = 1
+
+# Metrics compared with the baseline, and if higher values are better
+COMPARED_METRICS = {
+    "files_per_sec": True,
+    "nodes_per_sec": True,
+    "blocks_per_sec": True,
+    "peak_memory_mb": False,
+    "retained_memory_mb": False,
+}
+
+BREAKDOWN_STAGES = ["tree_sitter", "queries", "references", "tokens", "post_process", "graph", "other"]
+
+
+def load_fixtures(fixtures_dir: str) -> dict[str, str]:
+    fixtures = {}
+    for file_path in sorted(glob.glob(os.path.join(fixtures_dir, "*"))):
+        with open(file_path) as f:
+            fixtures[os.path.basename(file_path)] = f.read()
+    return fixtures
+
+
+def load_corpus_dir(corpus_dir: str) -> dict[str, str]:
+    files = {}
+    for pattern in ["**/*.py", "**/*.java"]:
+        for file_path in sorted(glob.glob(os.path.join(corpus_dir, pattern), recursive=True)):
+            with open(file_path, errors="replace") as f:
+                files[os.path.relpath(file_path, corpus_dir)] = f.read()
+    return files
+
+
+def language_of(file_name: str) -> str:
+    if file_name.endswith(".java") or file_name.endswith(".java_"):
+        return "java"
+    return "python"
+
+
+def create_parser(file_name: str, **kwargs):
+    if language_of(file_name) == "java":
+        return JavaParser(**kwargs)
+    return PythonParser(**kwargs)
+
+
+def generate_python_file(lines: int, seed: int = 0) -> str:
+    """
+    Generate a Python file with at least the given number of lines, with classes, methods, module level functions,
+    comments and the usual compound statements. The same seed gives the same file.
+    """
+    rng = random.Random(seed)
+    out = ["import os", "import re", "from typing import Optional", "", "from package.module import Base, helper", ""]
+
+    def function_body(indent: str, i: int) -> list[str]:
+        body = [f'{indent}    """Compute value {i}."""', f"{indent}    result = []"]
+        for j in range(rng.randint(2, 6)):
+            kind = rng.choice(["if", "for", "try", "call", "comment"])
+            if kind == "if":
+                body += [
+                    f"{indent}    if value > {j}:",
+                    f"{indent}        result.append(helper(value, {j}))",
+                    f"{indent}    elif value < -{j}:",
+                    f"{indent}        result.append(-{j})",
+                    f"{indent}    else:",
+                    f"{indent}        result.append(None)",
+                ]
+            elif kind == "for":
+                body += [f"{indent}    for item in range({j + 2}):", f"{indent}        result.append(item * value)"]
+            elif kind == "try":
+                body += [
+                    f"{indent}    try:",
+                    f'{indent}        result.append(int(os.environ.get("VALUE_{j}", "{j}")))',
+                    f"{indent}    except ValueError as e:",
+                    f"{indent}        raise RuntimeError(f\"Invalid value {{e}}\")",
+                ]
+            elif kind == "call":
+                body.append(f'{indent}    result.append(re.sub(r"\\s+", " ", str(value)))')
+            else:
+                body.append(f"{indent}    # Keep the result ordered for step {j}")
+        body.append(f"{indent}    return result")
+        return body
+
+    i = 0
+    while len(out) < lines:
+        if rng.random() < 0.7:
+            out += ["", f"class Generated{i}(Base):", f'    """Generated class {i}."""', ""]
+            out += ["    def __init__(self, value: int, name: Optional[str] = None):", "        super().__init__()"]
+            out += ["        self.value = value", "        self.name = name or 'generated'", ""]
+            for m in range(rng.randint(2, 8)):
+                out.append(f"    def method_{m}(self, value: int) -> list:")
+                out += function_body("    ", m)
+                out.append("")
+        else:
+            out += ["", f"def function_{i}(value: int) -> list:"]
+            out += function_body("", i)
+        out.append("")
+        i += 1
+
+    return "\n".join(out) + "\n"
+
+
+def generate_java_file(lines: int, seed: int = 0) -> str:
+    """
+    Generate a Java file with at least the given number of lines, with classes, fields, constructors and methods.
+    """
+    rng = random.Random(seed)
+    out = ["package com.example.generated;", "", "import java.util.ArrayList;", "import java.util.List;", ""]
+
+    i = 0
+    while len(out) < lines:
+        out += [f"/**", f" * Generated class {i}.", f" */", f"public class Generated{i} extends Base {{"]
+        out += ["    private int value;", "    private String name;", ""]
+        out += [f"    public Generated{i}(int value, String name) {{", "        this.value = value;"]
+        out += ["        this.name = name;", "    }", ""]
+        for m in range(rng.randint(2, 8)):
+            out += [f"    public List<Integer> method{m}(int input) {{", "        List<Integer> result = new ArrayList<>();"]
+            for j in range(rng.randint(2, 5)):
+                if rng.random() < 0.5:
+                    out += [f"        if (input > {j}) {{", f"            result.add(input * {j});", "        } else {"]
+                    out += [f"            result.add(-{j});", "        }"]
+                else:
+                    out += [f"        for (int k = 0; k < {j + 2}; k++) {{", "            result.add(k + value);"]
+                    out += ["        }", f"        // Keep the result ordered for step {j}"]
+            out += ["        return result;", "    }", ""]
+        out += ["}", ""]
+        i += 1
+
+    return "\n".join(out) + "\n"
+
+
+def synthetic_files(line_counts: list[int]) -> dict[str, str]:
+    files = {}
+    for lines in line_counts:
+        files[f"synthetic_{lines}.py"] = generate_python_file(lines, seed=lines)
+        files[f"synthetic_{lines}.java"] = generate_java_file(lines, seed=lines)
+    return files
+
+
+class _TimedTreeParser:
+    def __init__(self, tree_parser, timings: dict[str, float]):
+        self._tree_parser = tree_parser
+        self._timings = timings
+
+    def parse(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._tree_parser.parse(*args, **kwargs)
+        finally:
+            self._timings["tree_sitter"] += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self._tree_parser, name)
+
+
+def _timed(func, timings: dict[str, float], stage: str):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[stage] += time.perf_counter() - start
+
+    return wrapper
+
+
+@contextmanager
+def instrument(parser: CodeParser, timings: dict[str, float]):
+    """
+    Time the stages of the parses done with the parser by wrapping the methods of each stage. The wrappers add
+    overhead, so the timings are only used for the breakdown and not for the throughput.
+    """
+    originals = {
+        name: parser.__dict__.get(name)
+        for name in ["tree_parser", "tokenizer", "find_in_tree", "create_references", "create_parameters", "post_process"]
+    }
+    capture_index = parser_module.CaptureIndex
+
+    parser.tree_parser = _TimedTreeParser(parser.tree_parser, timings)
+    parser.tokenizer = _timed(parser.tokenizer, timings, "tokens")
+    parser.find_in_tree = _timed(parser.find_in_tree, timings, "queries")
+    parser.create_references = _timed(parser.create_references, timings, "references")
+    parser.create_parameters = _timed(parser.create_parameters, timings, "references")
+    parser.post_process = _timed(parser.post_process, timings, "post_process")
+    parser_module.CaptureIndex = _timed(capture_index, timings, "queries")
+    try:
+        yield
+    finally:
+        parser_module.CaptureIndex = capture_index
+        for name, value in originals.items():
+            if value is None:
+                delattr(parser, name)
+            else:
+                setattr(parser, name, value)
+
+
+def _build_graph(module):
+    return module._get_graph()
+
+
+def benchmark_files(
+    files: dict[str, str], parsers: dict[str, CodeParser], iterations: int, enable_code_graph: bool
+) -> dict[str, dict]:
+    """
+    Parse each file iterations times and return the lines, nodes, blocks and best parse time of each file.
+    """
+    results = {}
+    for file_name, content in files.items():
+        parser = parsers[language_of(file_name)]
+        module = parser.parse(content)  # Warm up
+
+        timings = []
+        graph_timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            module = parser.parse(content)
+            timings.append(time.perf_counter() - start)
+
+            if enable_code_graph:
+                start = time.perf_counter()
+                _build_graph(module)
+                graph_timings.append(time.perf_counter() - start)
+
+        results[file_name] = {
+            "language": language_of(file_name),
+            "lines": content.count("\n"),
+            "nodes": parser.tree_parser.parse(bytes(content, parser.encoding)).root_node.descendant_count,
+            "blocks": 1 + len(module.get_all_child_blocks()),
+            "seconds": min(timings),
+            "graph_seconds": min(graph_timings) if graph_timings else 0.0,
+        }
+    return results
+
+
+def benchmark_breakdown(files: dict[str, str], parsers: dict[str, CodeParser], enable_code_graph: bool) -> dict:
+    """
+    Parse each file once with instrumented parsers and return the seconds spent in each stage by language.
+    """
+    breakdowns = {}
+    for language, parser in parsers.items():
+        timings = {stage: 0.0 for stage in BREAKDOWN_STAGES}
+        language_files = [content for file_name, content in files.items() if language_of(file_name) == language]
+        total = 0.0
+        with instrument(parser, timings):
+            for content in language_files:
+                start = time.perf_counter()
+                module = parser.parse(content)
+                if enable_code_graph:
+                    graph_start = time.perf_counter()
+                    _build_graph(module)
+                    timings["graph"] += time.perf_counter() - graph_start
+                total += time.perf_counter() - start
+
+        timings["other"] = max(0.0, total - sum(timings.values()))
+        breakdowns[language] = timings
+    return breakdowns
+
+
+def benchmark_memory(files: dict[str, str], parsers: dict[str, CodeParser]) -> dict[str, dict]:
+    """
+    Measure the peak memory while parsing each file, and the memory retained by the modules of all files of a
+    language, with tracemalloc.
+    """
+    results = {}
+    for language, parser in parsers.items():
+        language_files = [content for file_name, content in files.items() if language_of(file_name) == language]
+        if not language_files:
+            continue
+
+        gc.collect()
+        tracemalloc.start()
+        peak = 0
+        modules = []
+        for content in language_files:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            modules.append(parser.parse(content))
+            _, file_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, file_peak - before)
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[language] = {"peak_memory_mb": peak / 1024**2, "retained_memory_mb": retained / 1024**2}
+        del modules
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_suite(files: dict[str, str], iterations: int, measure_memory: bool = True, **parser_kwargs) -> dict:
+    parsers = {}
+    for file_name in files:
+        language = language_of(file_name)
+        if language not in parsers:
+            parsers[language] = create_parser(file_name, **parser_kwargs)
+
+    enable_code_graph = parser_kwargs.get("enable_code_graph", True)
+    file_results = benchmark_files(files, parsers, iterations, enable_code_graph)
+    breakdowns = benchmark_breakdown(files, parsers, enable_code_graph)
+    memory = benchmark_memory(files, parsers) if measure_memory else {}
+
+    results = {}
+    for language in parsers:
+        language_results = [result for result in file_results.values() if result["language"] == language]
+        seconds = sum(result["seconds"] for result in language_results)
+        totals = {key: sum(result[key] for result in language_results) for key in ["lines", "nodes", "blocks"]}
+        results[language] = {
+            "files": len(language_results),
+            **totals,
+            "seconds": seconds,
+            "files_per_sec": len(language_results) / seconds,
+            "lines_per_sec": totals["lines"] / seconds,
+            "nodes_per_sec": totals["nodes"] / seconds,
+            "blocks_per_sec": totals["blocks"] / seconds,
+            **memory.get(language, {}),
+            "breakdown": breakdowns[language],
+        }
+
+    return {
+        "format_version": BASELINE_FORMAT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "tree_sitter": version("tree-sitter"),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+        },
+        "settings": {"iterations": iterations, **parser_kwargs},
+        "results": results,
+        "files": file_results,
+    }
+
+
+def print_suite(suite: dict):
+    print(f"{'file':<40} {'lines':>8} {'nodes':>9} {'blocks':>8} {'ms':>10} {'graph ms':>10}")
+    for file_name, result in suite["files"].items():
+        print(
+            f"{file_name[-40:]:<40} {result['lines']:>8} {result['nodes']:>9} {result['blocks']:>8} "
+            f"{result['seconds'] * 1000:>10.2f} {result['graph_seconds'] * 1000:>10.2f}"
+        )
+
+    for language, result in suite["results"].items():
+        print(f"\n{language}: {result['files']} files, {result['lines']} lines in {result['seconds']:.3f}s")
+        for metric in ["files_per_sec", "lines_per_sec", "nodes_per_sec", "blocks_per_sec"]:
+            print(f"  {metric:<24} {result[metric]:>12.1f}")
+        for metric in ["peak_memory_mb", "retained_memory_mb"]:
+            if metric in result:
+                print(f"  {metric:<24} {result[metric]:>12.2f}")
+
+        breakdown = result["breakdown"]
+        total = sum(breakdown.values()) or 1.0
+        print("  breakdown (instrumented)")
+        for stage in BREAKDOWN_STAGES:
+            print(f"    {stage:<22} {breakdown[stage] * 1000:>10.1f} ms {breakdown[stage] / total:>7.1%}")
+
+
+def compare_suites(baseline: dict, suite: dict, max_regression: float) -> list[str]:
+    """
+    Print the change of each compared metric from the baseline, and return the metrics that regressed by more than
+    max_regression.
+    """
+    if baseline.get("settings") != suite.get("settings"):
+        print(f"Warning: settings differ from the baseline {baseline.get('settings')}")
+
+    regressions = []
+    print(f"\n{'metric':<32} {'baseline':>12} {'current':>12} {'change':>8}")
+    for language, result in suite["results"].items():
+        baseline_result = baseline["results"].get(language)
+        if not baseline_result:
+            continue
+
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in result or not baseline_result.get(metric):
+                continue
+
+            change = result[metric] / baseline_result[metric] - 1
+            regressed = -change > max_regression if higher_is_better else change > max_regression
+            name = f"{language}.{metric}"
+            print(
+                f"{name:<32} {baseline_result[metric]:>12.1f} {result[metric]:>12.1f} {change:>+8.1%}"
+                f"{'  REGRESSION' if regressed else ''}"
+            )
+            if regressed:
+                regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the codeblocks parser")
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    parser.add_argument("--corpus-dir", action="append", default=[], help="Also parse the .py and .java files here")
+    parser.add_argument(
+        "--synthetic-lines",
+        type=int,
+        nargs="*",
+        default=[1000, 10000],
+        help="Number of lines of the generated Python and Java files",
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--apply-gpt-tweaks", action="store_true")
+    parser.add_argument("--disable-code-graph", action="store_true")
+    parser.add_argument("--no-memory", action="store_true", help="Skip measuring memory with tracemalloc")
+    parser.add_argument("--save", help="Write the results as a JSON baseline to this file")
+    parser.add_argument("--compare", help="Compare the results with a JSON baseline")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="Exit with status 1 if a compared metric is this much worse than the baseline",
+    )
+    args = parser.parse_args()
+
+    files = load_fixtures(args.fixtures_dir)
+    for corpus_dir in args.corpus_dir:
+        files.update(load_corpus_dir(corpus_dir))
+    files.update(synthetic_files(args.synthetic_lines))
+
+    suite = run_suite(
+        files,
+        args.iterations,
+        measure_memory=not args.no_memory,
+        apply_gpt_tweaks=args.apply_gpt_tweaks,
+        enable_code_graph=not args.disable_code_graph,
+    )
+    print_suite(suite)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(suite, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_suites(baseline, suite, args.max_regression)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
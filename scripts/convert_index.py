@@ -0,0 +1,51 @@
+import argparse
+import logging
+import os
+
+from moatless.index.columnar_store import convert_persist_dir
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def find_persist_dirs(index_store_dir: str) -> list[str]:
+    """Find the persisted indexes in the directory and its subdirectories, e.g. one per SWE-bench instance."""
+    persist_dirs = []
+    for dir_path, _, file_names in os.walk(index_store_dir):
+        if "docstore.json" in file_names and "vector_index.json" in file_names:
+            persist_dirs.append(dir_path)
+    return sorted(persist_dirs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert persisted indexes with JSON document stores to index columns"
+    )
+    parser.add_argument("index_store_dir", help="Persisted index, or a directory with persisted indexes")
+    parser.add_argument(
+        "--keep-legacy-files",
+        action="store_true",
+        help="Keep docstore.json and vector_index.json after converting",
+    )
+    args = parser.parse_args()
+
+    persist_dirs = find_persist_dirs(args.index_store_dir)
+    logger.info(f"Found {len(persist_dirs)} indexes to convert in {args.index_store_dir}")
+
+    failed = 0
+    for persist_dir in persist_dirs:
+        try:
+            convert_persist_dir(persist_dir, keep_legacy_files=args.keep_legacy_files)
+            logger.info(f"Converted {persist_dir}")
+        except Exception:
+            logger.exception(f"Failed to convert {persist_dir}")
+            failed += 1
+
+    logger.info(f"Converted {len(persist_dirs) - failed} of {len(persist_dirs)} indexes")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,12 @@ import mimetypes
 import os
 import pstats
 import difflib
+import time
 import traceback
 
+import faiss
+import numpy as np
+
 from llama_index.core import SimpleDirectoryReader
 from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.core.vector_stores import VectorStoreQuery
@@ -17,7 +21,8 @@ from moatless.benchmark.swebench import setup_swebench_repo, get_repo_dir_name
 from moatless.benchmark.swebench.utils import create_repository
 from moatless.benchmark.utils import calculate_estimated_context_window, get_moatless_instance, get_moatless_instances
 from moatless.index import IndexSettings, CodeIndex
-from moatless.index.simple_faiss import SimpleFaissVectorStore
+from moatless.index.settings import VectorEncoding, VectorIndexType
+from moatless.index.simple_faiss import SimpleFaissVectorStore, create_faiss_index
 from moatless.index.epic_split import EpicSplitter
 
 # Add args as a module-level variable
@@ -118,6 +123,136 @@ def evaluate_instances(instance_ids: list[str]) -> list[dict]:
     return results
 
 
+# Index settings and the search parameters to try for each of them in the recall vs latency report
+_EF_SEARCH = [{"ef_search": ef_search} for ef_search in (16, 32, 64, 128, 256)]
+_NPROBE = [{"nprobe": nprobe} for nprobe in (1, 4, 16, 64)]
+ANN_CONFIGURATIONS = [
+    ({"index_type": VectorIndexType.FLAT}, [{}]),
+    ({"vector_encoding": VectorEncoding.FLOAT16}, [{}]),
+    ({"vector_encoding": VectorEncoding.INT8}, [{}]),
+    ({"vector_encoding": VectorEncoding.PQ}, [{}]),
+    (
+        {"vector_encoding": VectorEncoding.PQ, "rerank_encoding": VectorEncoding.FLOAT16},
+        [{"rerank_k_factor": k_factor} for k_factor in (2, 4, 8, 16)],
+    ),
+    ({"index_type": VectorIndexType.HNSW}, _EF_SEARCH),
+    ({"index_type": VectorIndexType.HNSW, "vector_encoding": VectorEncoding.INT8}, _EF_SEARCH),
+    ({"index_type": VectorIndexType.IVF_FLAT}, _NPROBE),
+    ({"index_type": VectorIndexType.IVF_PQ}, _NPROBE),
+    ({"index_type": VectorIndexType.IVF_PQ, "rerank_encoding": VectorEncoding.FLOAT16}, _NPROBE),
+]
+
+
+def load_index_vectors(persist_dir: str) -> np.ndarray:
+    faiss_index = faiss.read_index(os.path.join(persist_dir, "vector_index.faiss"))
+
+    # The wrapped index is owned by the ID map, which has to be kept referenced while it's used
+    vector_index = faiss_index
+    if isinstance(faiss_index, faiss.IndexIDMap):
+        vector_index = faiss.downcast_index(faiss_index.index)
+
+    ivf_index = faiss.try_extract_index_ivf(vector_index)
+    if ivf_index is not None:
+        ivf_index.make_direct_map()
+
+    return vector_index.reconstruct_n(0, vector_index.ntotal)
+
+
+def evaluate_ann_settings(instance_id: str, query_count: int, top_k: int) -> list[dict]:
+    """
+    Compare the recall, latency and size of each ANN index type and vector encoding against an exact search over the
+    vectors in the persisted index of the instance. A sample of the indexed vectors is used as queries.
+    """
+    instance = get_moatless_instance(instance_id)
+    vectors = load_index_vectors(get_persist_dir(instance))
+    vector_count, dimensions = vectors.shape
+
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(vector_count, size=min(query_count, vector_count), replace=False)]
+    top_k = min(top_k, vector_count)
+
+    exact_index = faiss.IndexFlatL2(dimensions)
+    exact_index.add(vectors)
+    _, expected_ids = exact_index.search(queries, top_k)
+
+    results = []
+    for index_settings, search_parameters in ANN_CONFIGURATIONS:
+        settings = IndexSettings(dimensions=dimensions, **index_settings)
+        encoding = settings.vector_encoding.value
+        if settings.index_type == VectorIndexType.IVF_PQ:
+            encoding = VectorEncoding.PQ.value
+        if settings.rerank_encoding:
+            encoding += f"+{settings.rerank_encoding.value}"
+
+        start = time.perf_counter()
+        faiss_index = create_faiss_index(dimensions, settings, vectors)
+        faiss_index.add_with_ids(vectors, np.arange(vector_count, dtype=np.int64))
+        build_time = time.perf_counter() - start
+
+        index_size = len(faiss.serialize_index(faiss_index))
+        vector_store = SimpleFaissVectorStore(faiss_index, d=dimensions, index_settings=settings)
+
+        for parameters in search_parameters:
+            params = vector_store._search_parameters(**parameters)
+
+            latencies = []
+            recall_at_10 = []
+            recall_at_k = []
+            for query, expected in zip(queries, expected_ids):
+                start = time.perf_counter()
+                _, ids = faiss_index.search(query[np.newaxis, :], top_k, params=params)
+                latencies.append(time.perf_counter() - start)
+
+                recall_at_10.append(len(set(ids[0][:10]) & set(expected[:10])) / min(10, top_k))
+                recall_at_k.append(len(set(ids[0]) & set(expected)) / top_k)
+
+            result = {
+                "instance_id": instance_id,
+                "vectors": vector_count,
+                "index_type": settings.index_type.value,
+                "encoding": encoding,
+                "parameters": " ".join(f"{key}={value}" for key, value in parameters.items()),
+                "build_seconds": round(build_time, 3),
+                "index_mb": round(index_size / 1024 / 1024, 2),
+                "latency_ms": round(float(np.mean(latencies)) * 1000, 3),
+                "p95_latency_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+                "recall_at_10": round(float(np.mean(recall_at_10)), 4),
+                f"recall_at_{top_k}": round(float(np.mean(recall_at_k)), 4),
+            }
+            print(
+                f"{instance_id} {result['index_type']:>8} {result['encoding']:<12} {result['parameters']:<18} "
+                f"build {result['build_seconds']:>7.3f}s  size {result['index_mb']:>7.2f}MB  "
+                f"latency {result['latency_ms']:>7.3f}ms (p95 {result['p95_latency_ms']:.3f}ms)  "
+                f"recall@10 {result['recall_at_10']:.4f}  recall@{top_k} {result[f'recall_at_{top_k}']:.4f}"
+            )
+            results.append(result)
+
+    return results
+
+
+def evaluate_ann_instances(instance_ids: list[str]) -> list[dict]:
+    store_dir_name = os.path.basename(os.path.normpath(args.vector_store_dir))
+    output_file = f"ann_eval_{store_dir_name}.csv"
+
+    results = []
+    for instance_id in instance_ids:
+        try:
+            results.extend(evaluate_ann_settings(instance_id, args.ann_queries, args.ann_top_k))
+        except Exception as e:
+            print(f"Error evaluating ANN settings for instance {instance_id}: {e}")
+            print(traceback.format_exc())
+
+    if results:
+        columns = list(results[0].keys())
+        with open(output_file, "w") as f:
+            f.write(",".join(columns) + "\n")
+            for result in results:
+                f.write(",".join(str(result[column]) for column in columns) + "\n")
+        print(f"Wrote recall vs latency report to {output_file}")
+
+    return results
+
+
 def split_and_store(instance_id):
     instance = get_moatless_instance(instance_id, split="verified")
     repo_path = setup_swebench_repo(instance)
@@ -288,10 +423,12 @@ def main():
     parser.add_argument("--instance-ids", nargs="*", help="Specific instance IDs to evaluate")
     parser.add_argument("--prefix", help="Process all instances with this prefix")
     parser.add_argument("--dataset", help="Dataset name to load instance IDs from")
-    parser.add_argument("--mode", choices=["create", "evaluate", "split", "read"], required=True, 
-                       help="Operation mode: create index, evaluate index, split documents, or read store")
+    parser.add_argument("--mode", choices=["create", "evaluate", "ann", "split", "read"], required=True,
+                       help="Operation mode: create index, evaluate index, report ANN recall vs latency, split documents, or read store")
     parser.add_argument("--output", default="index_eval.csv", help="Output CSV file for evaluation results")
     parser.add_argument("--num-workers", type=int, default=4, help="Number of workers for parallel processing")
+    parser.add_argument("--ann-queries", type=int, default=200, help="Number of sampled query vectors in ann mode")
+    parser.add_argument("--ann-top-k", type=int, default=100, help="Number of results to compare recall on in ann mode")
     
     # Update the global args variable
     global args
@@ -353,6 +490,12 @@ def main():
             for result in results:
                 f.write(f"{result['instance_id']},{result['resolved_by']},{result['all_matching_context_window']},{result['any_matching_context_window']}\n")
     
+    elif args.mode == "ann":
+        if not instance_ids:
+            print("Error: Must provide instance IDs or dataset for ann mode")
+            return
+        evaluate_ann_instances(instance_ids)
+
     elif args.mode == "split":
         if not instance_ids:
             print("Error: Must provide instance IDs or dataset for split mode")
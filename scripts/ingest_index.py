@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import shutil
+import subprocess
 from typing import Optional, Dict, List
 
 from dotenv import load_dotenv
@@ -13,6 +14,7 @@ from moatless.benchmark.swebench.utils import create_repository
 from moatless.benchmark.utils import get_moatless_instances
 from moatless.index.settings import IndexSettings
 from moatless.index.code_index import CodeIndex
+from moatless.index.embedding_cache import EmbeddingCache
 
 logging.basicConfig(
     level=logging.INFO,
@@ -55,7 +57,8 @@ def create_index(
     instance: Dict,
     instance_by_id: Dict,
     index_settings: IndexSettings,
-    index_store_dir: str
+    index_store_dir: str,
+    embedding_cache: Optional[EmbeddingCache] = None
 ) -> CodeIndex:
     repository = create_repository(instance)
     previous_instance = get_previous_instance(instance["instance_id"], instance_by_id)
@@ -70,18 +73,34 @@ def create_index(
                 f"Cannot load index for instance {instance['instance_id']}"
             )
             
-        return CodeIndex.from_persist_dir(persist_dir, file_repo=repository)
-    return CodeIndex(file_repo=repository, settings=index_settings)
+        return CodeIndex.from_persist_dir(persist_dir, file_repo=repository, embedding_cache=embedding_cache)
+    return CodeIndex(file_repo=repository, settings=index_settings, embedding_cache=embedding_cache)
 
 def ingest_instance(
     instance: Dict,
     code_index: CodeIndex,
     index_store_dir: str,
-    num_workers: int
+    num_workers: int,
+    previous_instance: Optional[Dict] = None
 ) -> tuple[int, int]:
     logger.info(f"Processing instance: {instance['instance_id']}")
 
-    vectors, indexed_tokens = code_index.run_ingestion(num_workers=num_workers)
+    if previous_instance:
+        # Only index the files changed since the commit of the previous instance
+        try:
+            vectors, indexed_tokens = code_index.update_to_commit(
+                code_index._file_repo,
+                previous_instance["base_commit"],
+                instance["base_commit"],
+                num_workers=num_workers
+            )
+        except subprocess.CalledProcessError:
+            logger.exception(
+                f"Failed to diff {previous_instance['base_commit']} and {instance['base_commit']}, index all files"
+            )
+            vectors, indexed_tokens = code_index.run_ingestion(num_workers=num_workers)
+    else:
+        vectors, indexed_tokens = code_index.run_ingestion(num_workers=num_workers)
     logger.info(f"Indexed {vectors} vectors and {indexed_tokens} tokens")
     
     persist_dir = get_persist_dir(instance["instance_id"], index_store_dir)
@@ -94,7 +113,8 @@ def write_report(
     report_path: str,
     instance: Dict,
     vectors: int,
-    indexed_tokens: int
+    indexed_tokens: int,
+    code_index: Optional[CodeIndex] = None
 ) -> None:
     with open(report_path, "a") as f:
         report = {
@@ -102,6 +122,11 @@ def write_report(
             "vectors": vectors,
             "indexed_tokens": indexed_tokens,
         }
+        cache_stats = code_index.embedding_cache_stats if code_index else None
+        if cache_stats:
+            report["embedding_cache_hits"] = cache_stats.hits
+            report["embedding_cache_misses"] = cache_stats.misses
+            report["embedding_cache_saved_cost"] = cache_stats.saved_cost
         f.write(json.dumps(report) + "\n")
 
 def process_instances(
@@ -110,7 +135,8 @@ def process_instances(
     index_settings: IndexSettings,
     index_store_dir: str,
     report_path: str,
-    num_workers: int
+    num_workers: int,
+    embedding_cache: Optional[EmbeddingCache] = None
 ) -> None:
     for instance in instances:
         persist_dir = get_persist_dir(instance["instance_id"], index_store_dir)
@@ -126,17 +152,19 @@ def process_instances(
             instance,
             instance_by_id,
             index_settings,
-            index_store_dir
+            index_store_dir,
+            embedding_cache
         )
         
         vectors, indexed_tokens = ingest_instance(
             instance,
             code_index,
             index_store_dir,
-            num_workers
+            num_workers,
+            get_previous_instance(instance["instance_id"], instance_by_id)
         )
         
-        write_report(report_path, instance, vectors, indexed_tokens)
+        write_report(report_path, instance, vectors, indexed_tokens, code_index)
 
         shutil.rmtree(code_index._file_repo.path)
 
@@ -187,6 +215,10 @@ def main():
         "--prefix",
         help="Process all instances with this prefix"
     )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        help="Directory with embeddings cached by chunk content, shared by all instances"
+    )
     
     args = parser.parse_args()
     
@@ -225,6 +257,8 @@ def main():
         )
         logger.info(f"Processing {len(instances)} instances")
     
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir) if args.embedding_cache_dir else None
+
     # Process all instances
     process_instances(
         instances,
@@ -232,7 +266,8 @@ def main():
         index_settings,
         args.index_store_dir,
         args.report_path,
-        args.num_workers
+        args.num_workers,
+        embedding_cache
     )
 
 if __name__ == "__main__":
@@ -53,3 +53,11 @@ def test_interface():
         )
 
     _verify_parsing(content, assertion)
+
+
+def test_query_dispatch_table_keeps_wildcard_order():
+    parser = JavaParser()
+
+    # The wildcard query in java.scm is defined before the line_comment query and must be tried first
+    labels = [label for label, _, _ in parser._queries_by_type["line_comment"]]
+    assert labels == ["java.scm:9", "java.scm:10"]
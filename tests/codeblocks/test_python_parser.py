@@ -1,12 +1,21 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
 from moatless.benchmark.swebench import setup_swebench_repo
 from moatless.benchmark.utils import get_moatless_instances, get_moatless_instance
-from moatless.codeblocks import CodeBlockType
+from moatless.codeblocks import CodeBlockType, ModuleCache, get_parser_by_path, parse_many
 from moatless.codeblocks.codeblocks import (
+    CodeBlock,
     Relationship,
     RelationshipType,
     ReferenceScope,
     SpanType,
 )
+from moatless.codeblocks.module import Module
+from moatless.codeblocks.parser.parser import OUTLINE_BLOCK_TYPES, ParseContext
 from moatless.codeblocks.parser.python import PythonParser
 
 
@@ -798,3 +807,484 @@ class Signal:
         print(codeblock.to_prompt(include_block_types=[CodeBlockType.ERROR]))
 
     _verify_parsing(content, assertion, debug=False)
+
+
+def test_query_dispatch_table():
+    parser = PythonParser(apply_gpt_tweaks=True)
+
+    for node_type in ["module", "class_definition", "function_definition", "comment", "identifier"]:
+        expected = [
+            label
+            for label, query_node_type, _ in parser.queries
+            if not query_node_type or query_node_type in (node_type, "_")
+        ]
+        dispatched = [
+            label for label, _, _ in parser._queries_by_type.get(node_type, parser._wildcard_queries)
+        ]
+        assert dispatched == expected
+
+    assert [label for label, _, _ in parser._wildcard_queries] == ["python.scm:25", "python.scm:26"]
+
+
+def _module_signature(module):
+    blocks = [
+        (
+            block.type,
+            block.identifier,
+            block.start_line,
+            block.end_line,
+            block.pre_code,
+            block.content,
+            block.tokens,
+            block.belongs_to_span.span_id if block.belongs_to_span else None,
+            sorted(block.span_ids),
+            [str(relationship) for relationship in block.relationships],
+            [(parameter.identifier, parameter.type) for parameter in block.parameters],
+            block.properties,
+        )
+        for block in [module] + module.get_all_child_blocks()
+    ]
+    spans = [
+        (
+            span.span_id,
+            span.span_type,
+            span.start_line,
+            span.end_line,
+            span.block_paths,
+            span.tokens,
+            span.parent_block_path,
+            span.is_partial,
+            span.index,
+        )
+        for span in module.spans_by_id.values()
+    ]
+    return blocks, spans, sorted(module._get_graph().edges())
+
+
+@pytest.mark.parametrize("fixture", ["makemigrations.py_", "test_ridge.py_"])
+@pytest.mark.parametrize("apply_gpt_tweaks", [False, True])
+def test_single_pass_captures_gives_identical_module(fixture, apply_gpt_tweaks):
+    with open(os.path.join(os.path.dirname(__file__), "data", fixture)) as f:
+        content = f.read()
+
+    single_pass_module = PythonParser(apply_gpt_tweaks=apply_gpt_tweaks, single_pass_captures=True).parse(content)
+    per_node_module = PythonParser(apply_gpt_tweaks=apply_gpt_tweaks, single_pass_captures=False).parse(content)
+
+    assert single_pass_module.to_string() == content
+    assert _module_signature(single_pass_module) == _module_signature(per_node_module)
+
+
+def test_shared_parser_is_thread_safe():
+    fixtures = []
+    for fixture in ["makemigrations.py_", "test_ridge.py_"]:
+        with open(os.path.join(os.path.dirname(__file__), "data", fixture)) as f:
+            fixtures.append(f.read())
+
+    parser = get_parser_by_path("foo.py")
+    assert parser is get_parser_by_path("bar.py")
+
+    expected = [_module_signature(parser.parse(content)) for content in fixtures]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        modules = list(executor.map(parser.parse, fixtures * 4))
+
+    assert [_module_signature(module) for module in modules] == expected * 4
+
+
+def test_parse_many():
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+    file_paths = [os.path.join(data_dir, fixture) for fixture in ["makemigrations.py_", "test_ridge.py_"]]
+
+    modules = parse_many(file_paths, workers=2, language="python")
+
+    assert list(modules.keys()) == file_paths
+    for file_path in file_paths:
+        with open(file_path) as f:
+            expected = PythonParser().parse(f.read(), file_path=file_path)
+
+        assert modules[file_path].file_path == file_path
+        assert _module_signature(modules[file_path]) == _module_signature(expected)
+
+
+def test_pickle_module():
+    with open(os.path.join(os.path.dirname(__file__), "data", "test_ridge.py_")) as f:
+        content = f.read()
+
+    module = PythonParser().parse(content, file_path="test_ridge.py")
+    unpickled = pickle.loads(pickle.dumps(module))
+
+    assert unpickled.to_string() == content
+    assert unpickled.file_path == "test_ridge.py"
+    assert _module_signature(unpickled) == _module_signature(module)
+    assert unpickled.find_by_path(["test_ridge"]).module is unpickled
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_module_to_bytes(compress):
+    with open(os.path.join(os.path.dirname(__file__), "data", "test_ridge.py_")) as f:
+        content = f.read()
+
+    module = PythonParser().parse(content, file_path="test_ridge.py")
+    module.find_by_path(["test_ridge"]).children[0].content = "# Changed"
+
+    loaded = Module.from_bytes(module.to_bytes(compress=compress))
+
+    assert loaded.to_string() == module.to_string()
+    assert loaded.file_path == "test_ridge.py"
+    assert _module_signature(loaded) == _module_signature(module)
+    assert loaded.find_related_span_ids("test_ridge") == module.find_related_span_ids("test_ridge")
+
+    # Contents from the source are loaded as byte ranges in it
+    assert loaded.find_by_path(["test_ridge"])._source is loaded._source
+    assert loaded.find_by_path(["test_ridge"]).children[0].content == "# Changed"
+
+    with pytest.raises(ValueError):
+        Module.from_bytes(b"not a module")
+
+
+def test_module_cache(tmp_path):
+    with open(os.path.join(os.path.dirname(__file__), "data", "test_ridge.py_")) as f:
+        content = f.read()
+
+    cache = ModuleCache(str(tmp_path / "cache"))
+    module = PythonParser(module_cache=cache).parse(content, file_path="test_ridge.py")
+
+    cached = PythonParser(module_cache=cache).parse(content, file_path="other/test_ridge.py")
+    assert cached is not module
+    assert cached.file_path == "other/test_ridge.py"
+    assert _module_signature(cached) == _module_signature(module)
+
+    # Parser settings are part of the cache key
+    parser = PythonParser(module_cache=cache, max_tokens_in_span=100)
+    assert parser.cache_key(content.encode()) != PythonParser().cache_key(content.encode())
+
+
+def test_module_cache_evicts_least_recently_used(tmp_path):
+    parser = PythonParser(module_cache=ModuleCache(str(tmp_path / "cache")))
+    contents = [f"def foo_{i}():\n    return {i}\n" for i in range(3)]
+    for content in contents:
+        parser.parse(content)
+
+    # Compressed entries differ slightly in size
+    entry_sizes = [
+        os.path.getsize(parser.module_cache._entry_path(parser.cache_key(content.encode()))) for content in contents
+    ]
+    cache = ModuleCache(str(tmp_path / "cache"), max_size=int(max(entry_sizes) * 2.5))
+
+    # Reading the first entry makes the second the least recently used
+    os.utime(parser.module_cache._entry_path(parser.cache_key(contents[1].encode())), (0, 0))
+    assert cache.get(parser.cache_key(contents[0].encode())) is not None
+
+    cache.evict(target_size=entry_sizes[0] + entry_sizes[2])
+    assert cache.get(parser.cache_key(contents[1].encode())) is None
+    assert cache.get(parser.cache_key(contents[0].encode())) is not None
+    assert cache.get(parser.cache_key(contents[2].encode())) is not None
+
+
+def test_reparse_rebuilds_changed_function():
+    content = """import os
+
+
+class Foo:
+
+    def bar(self):
+        return 1
+
+    def baz(self):
+        return 2
+
+
+def qux():
+    return 3
+"""
+    parser = PythonParser()
+    module = parser.parse(content, keep_tree=True)
+    baz = module.find_by_path(["Foo", "baz"])
+    qux = module.find_by_path(["qux"])
+
+    updated_content = content.replace("        return 1\n", "        x = 1\n        return x\n")
+    updated_module = parser.reparse(module, content, updated_content)
+
+    # Only the changed function is rebuilt, the other blocks are shifted to the new lines
+    assert updated_module is module
+    assert updated_module.find_by_path(["Foo", "baz"]) is baz
+    assert updated_module.find_by_path(["qux"]) is qux
+    assert _module_signature(updated_module) == _module_signature(parser.parse(updated_content))
+    assert updated_module.to_string() == updated_content
+
+    # Renaming the function changes its span id, so the class is rebuilt instead
+    renamed_content = updated_content.replace("def bar", "def bar2")
+    renamed_module = parser.reparse(updated_module, updated_content, renamed_content)
+    assert renamed_module is module
+    assert renamed_module.find_by_path(["qux"]) is qux
+    assert _module_signature(renamed_module) == _module_signature(parser.parse(renamed_content))
+
+    # No class or function contains the change, so the whole module is parsed again
+    import_content = renamed_content.replace("import os", "import sys")
+    import_module = parser.reparse(renamed_module, renamed_content, import_content)
+    assert import_module is not module
+    assert _module_signature(import_module) == _module_signature(parser.parse(import_content))
+
+
+def test_lazy_tokens():
+    with open(os.path.join(os.path.dirname(__file__), "data", "test_ridge.py_")) as f:
+        content = f.read()
+
+    module = PythonParser().parse(content)
+    lazy_module = PythonParser(lazy_tokens=True).parse(content)
+
+    # Blocks on module level are counted when parsing as they are used to split spans
+    block = lazy_module.find_by_path(["test_ridge"]).children[0]
+    assert block._tokens is None
+    assert block.belongs_to_span._tokens is None
+
+    # Reading one token count counts all blocks in the module
+    assert block.tokens == module.find_by_path(["test_ridge"]).children[0].tokens
+    assert all(block._tokens is not None for block in lazy_module.get_all_child_blocks())
+    assert _module_signature(lazy_module) == _module_signature(module)
+    assert lazy_module.sum_tokens(set(lazy_module.spans_by_id.keys())) == module.sum_tokens(
+        set(module.spans_by_id.keys())
+    )
+
+
+def test_block_contents_are_decoded_from_module_source():
+    content = 'def foo():\n    """Grüße"""\n    return "ü"\n\n\ndef bar():\n    return 1\n'
+    parser = PythonParser()
+    module = parser.parse(content, keep_tree=True)
+
+    # Blocks keep byte offsets into the source of the module instead of decoded contents
+    comment_block = module.find_by_path(["foo"]).children[0]
+    assert comment_block._source is module._source
+    assert comment_block._content is None
+    assert comment_block.content == '"""Grüße"""'
+    assert comment_block.identifier == "_Grüße_"
+    assert module.to_string() == content
+
+    comment_block.content = '"""Hallo"""'
+    assert comment_block._source is None
+    assert comment_block.content_lines == ['"""Hallo"""']
+
+    # Blocks after a rebuilt function are moved to the new source at shifted offsets
+    updated_content = content.replace('return "ü"', 'x = "ö"\n    return x')
+    updated_module = parser.reparse(parser.parse(content, keep_tree=True), content, updated_content)
+    bar_block = updated_module.find_by_path(["bar"])
+    assert bar_block._source is updated_module._source
+    assert bar_block.content == "def bar():"
+    assert updated_module.to_string() == updated_content
+
+
+def test_sum_tokens_is_updated_on_changes():
+    module = PythonParser().parse("def foo():\n    a = 1\n    return a\n")
+    function = module.find_by_path(["foo"])
+    sum_tokens = module.sum_tokens()
+
+    function.children[0].tokens += 5
+    assert module.sum_tokens() == sum_tokens + 5
+
+    function.remove_child(0)
+    assert function.sum_tokens() == function.tokens + function.children[0].sum_tokens()
+
+
+def test_compact_blocks():
+    content = """def foo():
+    a = 1
+    b = 2
+    return a + b
+"""
+    parser = PythonParser()
+    module = parser.parse(content)
+    assert module._tree is None
+    assert parser.parse(content, keep_tree=True)._tree is not None
+
+    # Blocks in the same span share the span id set and properties
+    function = module.find_by_path(["foo"])
+    assert function.children[0].span_ids is function.children[1].span_ids
+    assert function.children[0].properties is function.children[1].properties
+    assert function.span_ids == {"foo"}
+
+
+def test_module_indexes_match_tree_walks():
+    with open(os.path.join(os.path.dirname(__file__), "data", "test_ridge.py_")) as f:
+        content = f.read()
+
+    parser = PythonParser()
+    module = parser.parse(content, file_path="test_ridge.py", keep_tree=True)
+
+    def assert_same_as_walk(module):
+        for span_id in module.spans_by_id:
+            assert module.find_blocks_by_span_id(span_id) == CodeBlock.find_blocks_by_span_id(module, span_id)
+            assert module.find_first_by_span_id(span_id) is CodeBlock.find_first_by_span_id(module, span_id)
+
+        for block in module.get_all_child_blocks():
+            assert module.find_blocks_with_identifier(block.identifier) == CodeBlock.find_blocks_with_identifier(
+                module, block.identifier
+            )
+
+        for line in range(module.end_line + 2):
+            assert module.find_first_by_start_line(line) is CodeBlock.find_first_by_start_line(module, line)
+            assert module.find_last_by_end_line(line) is CodeBlock.find_last_by_end_line(module, line)
+            assert module.find_spans_by_line_numbers(line, line + 10) == CodeBlock.find_spans_by_line_numbers(
+                module, line, line + 10
+            )
+
+    assert_same_as_walk(module)
+
+    # The indexes are rebuilt when the module is updated
+    updated_content = content.replace("    return ret\n", "    ret = ret.copy()\n    return ret\n", 1)
+    assert updated_content != content
+    updated_module = parser.reparse(module, content, updated_content)
+    assert updated_module is module
+    assert_same_as_walk(updated_module)
+
+
+def test_block_paths_are_cached():
+    content = """class Foo:
+
+    def bar(self):
+        return 1
+
+
+class Baz:
+    pass
+"""
+    module = PythonParser().parse(content)
+    bar = module.find_by_path(["Foo", "bar"])
+    assert bar.full_path() == ["Foo", "bar"]
+    assert bar.path_string() == "Foo.bar"
+    assert bar.children[0].full_path()[:2] == ["Foo", "bar"]
+    assert module.find_by_path(["Foo", "missing"]) is None
+
+    # Moving a block to another parent updates the paths of the block and its children
+    foo = module.find_by_path(["Foo"])
+    baz = module.find_by_path(["Baz"])
+    foo.remove_child(foo.children.index(bar))
+    baz.append_child(bar)
+    assert bar.full_path() == ["Baz", "bar"]
+    assert bar.children[0].full_path()[:2] == ["Baz", "bar"]
+    assert module.find_by_path(["Baz", "bar"]) is bar
+    assert module.find_by_path(["Foo", "bar"]) is None
+
+
+@pytest.mark.parametrize("fixture", ["makemigrations.py_", "test_ridge.py_"])
+def test_unique_identifiers_match_sibling_scan(fixture):
+    with open(os.path.join(os.path.dirname(__file__), "data", fixture)) as f:
+        module = PythonParser().parse(f.read())
+
+    for parent in [module] + module.get_all_child_blocks():
+        # Add the children to a new parent one by one and compare with scanning the siblings added so far
+        context = ParseContext()
+        new_parent = CodeBlock(type=parent.type, content="")
+        for child in parent.children:
+            for identifier in [child.identifier, child.identifier and child.identifier.rsplit("_", 1)[0]]:
+                existing_identifiers = [b.identifier for b in new_parent.children if b.type == child.type]
+                expected = (
+                    f"{identifier}_{len(existing_identifiers)}" if identifier in existing_identifiers else identifier
+                )
+                assert context.unique_identifier(new_parent, child.type, identifier) == expected
+
+            new_parent.children.append(CodeBlock(type=child.type, content="", identifier=child.identifier))
+
+
+def test_unique_identifiers_in_large_module():
+    content = "".join(["x = 1\n", "print(x)\n"] * 1000)
+    module = PythonParser().parse(content)
+
+    assert [child.identifier for child in module.children[:4]] == ["x", "print_x_", "x_1", "print_x__1"]
+    assert module.children[-2].identifier == "print_x__999"
+    assert len({child.identifier for child in module.children}) == len(module.children)
+
+
+def test_code_graph_is_built_on_first_use():
+    content = """class Foo:
+
+    def bar(self):
+        return 1
+
+
+class Baz(Foo):
+
+    def qux(self):
+        return 2
+"""
+    module = PythonParser().parse(content)
+    assert module._graph is None
+
+    assert module.find_related_span_ids("Baz") == {"Foo"}
+    assert module.find_related_span_ids("Foo") == {"Baz"}
+    assert module._get_graph().edges() == [("Baz", "Foo")]
+    assert module._get_graph().block("Foo") is module.find_by_path(["Foo"])
+
+    unpickled = pickle.loads(pickle.dumps(module))
+    assert unpickled.find_related_span_ids("Baz") == {"Foo"}
+
+    assert PythonParser(enable_code_graph=False).parse(content).find_related_span_ids("Baz") == set()
+
+
+@pytest.mark.parametrize("fixture", ["makemigrations.py_", "test_ridge.py_"])
+def test_outline_parse_matches_full_parse_when_expanded(fixture):
+    with open(os.path.join(os.path.dirname(__file__), "data", fixture)) as f:
+        content = f.read()
+
+    parser = PythonParser()
+    module = parser.parse(content, outline=True)
+    assert module.is_outline
+    assert module.to_string() == content
+
+    # Function blocks are kept with their bodies as content
+    for block in module._outline_blocks.values():
+        assert not block.children
+        assert block.type in OUTLINE_BLOCK_TYPES
+
+    module.expand()
+    assert not module.is_outline
+    assert _module_signature(module) == _module_signature(parser.parse(content))
+
+
+def test_outline_parse_expands_function_on_lookup():
+    content = """import os
+
+
+class Foo:
+
+    def bar(self):
+        class Inner:
+            pass
+        return Inner()
+
+    def baz(self):
+        return 2
+
+
+def qux():
+    return 3
+"""
+    parser = PythonParser()
+    module = parser.parse(content, keep_tree=True, outline=True)
+    assert set(module._outline_blocks.keys()) == {"Foo.bar", "Foo.baz", "qux"}
+    assert module.spans_by_id["Foo.baz"].end_line == 12
+
+    qux = module.find_by_path(["qux"])
+    assert qux.children
+    assert set(module._outline_blocks.keys()) == {"Foo.bar", "Foo.baz"}
+
+    # Blocks in function bodies are found by parsing the body of the function
+    assert module.find_by_path(["Foo", "bar", "Inner"])
+    assert set(module._outline_blocks.keys()) == {"Foo.baz"}
+    assert module.find_by_path(["qux"]) is qux
+
+    assert "Foo.baz" in [span.span_id for span in module.find_spans_by_line_numbers(12, 12)]
+    assert not module.is_outline
+    assert _module_signature(module) == _module_signature(parser.parse(content))
+
+    # The changed function is parsed in full
+    module = parser.parse(content, keep_tree=True, outline=True)
+    updated_content = content.replace("return 3", "x = 3\n    return x")
+    updated_module = parser.reparse(module, content, updated_content)
+    assert updated_module is module
+    assert set(updated_module._outline_blocks.keys()) == {"Foo.bar", "Foo.baz"}
+
+    # Changes outside of functions are parsed as an outline
+    import_content = updated_content.replace("import os", "import sys")
+    import_module = parser.reparse(updated_module, updated_content, import_content)
+    assert import_module is not module
+    assert set(import_module._outline_blocks.keys()) == {"Foo.bar", "Foo.baz", "qux"}
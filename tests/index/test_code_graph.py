@@ -0,0 +1,96 @@
+from moatless.codeblocks import get_parser_by_language
+from moatless.index.code_graph import CodeGraph, module_name_from_path
+
+FILES = {
+    "pkg/__init__.py": """from .models import Model
+""",
+    "pkg/models.py": """class Model:
+    def save(self):
+        pass
+
+
+class OtherModel:
+    pass
+""",
+    "pkg/views.py": """from pkg import Model
+
+
+def render():
+    model = Model()
+    return model
+
+
+class View:
+    def save(self):
+        Model.save(self)
+""",
+}
+
+
+def _parse(file_path: str, content: str):
+    parser = get_parser_by_language("python")
+    return parser.parse(content, file_path=file_path)
+
+
+def _create_graph() -> CodeGraph:
+    graph = CodeGraph()
+    for file_path, content in FILES.items():
+        graph.update_module(_parse(file_path, content))
+    return graph
+
+
+def test_module_name_from_path():
+    assert module_name_from_path("pkg/views.py") == "pkg.views"
+    assert module_name_from_path("pkg/__init__.py") == "pkg"
+
+
+def test_resolve_follows_reexports():
+    graph = _create_graph()
+
+    assert graph.resolve("pkg/views.py", ["Model"]) == ("pkg/models.py", "Model")
+    assert graph.resolve("pkg/views.py", ["Model", "save"]) == ("pkg/models.py", "Model.save")
+    assert graph.resolve("pkg/views.py", ["unknown"]) is None
+
+
+def test_find_references_and_referrers():
+    graph = _create_graph()
+
+    assert graph.find_references("pkg/views.py", "render") == [("pkg/models.py", "Model")]
+    assert graph.find_references("pkg/views.py", "View.save") == [("pkg/models.py", "Model.save")]
+    assert graph.find_referrers("pkg/models.py", "Model") == [("pkg/views.py", "render")]
+    assert graph.find_referrers("pkg/models.py", "OtherModel") == []
+
+
+def test_update_file_resolves_dependents():
+    graph = _create_graph()
+    assert graph.find_referrers("pkg/models.py", "Model") == [("pkg/views.py", "render")]
+
+    graph.update_module(
+        _parse(
+            "pkg/models.py",
+            """class Base:
+    pass
+
+
+Model = Base
+""",
+        )
+    )
+
+    # Module level assignments belong to the impl span
+    assert graph.find_referrers("pkg/models.py", "impl") == [("pkg/views.py", "View.save"), ("pkg/views.py", "render")]
+    assert graph.find_referrers("pkg/models.py", "Model") == []
+
+    graph.remove_file("pkg/models.py")
+    assert graph.find_references("pkg/views.py", "render") == []
+
+
+def test_persist_and_load(tmp_path):
+    graph = _create_graph()
+    graph.persist(str(tmp_path))
+
+    loaded = CodeGraph.from_persist_dir(str(tmp_path))
+    assert sorted(loaded.file_paths) == sorted(FILES.keys())
+    assert loaded.find_referrers("pkg/models.py", "Model") == graph.find_referrers("pkg/models.py", "Model")
+
+    assert CodeGraph.from_persist_dir(str(tmp_path / "missing")) is None
@@ -1,4 +1,8 @@
+import gc
+import subprocess
+
 import pytest
+from llama_index.core.embeddings import MockEmbedding
 
 from moatless.benchmark.swebench import (
     setup_swebench_repo,
@@ -6,6 +10,7 @@ from moatless.benchmark.swebench import (
 )
 from moatless.benchmark.utils import get_moatless_instance, get_moatless_instances
 from moatless.index import IndexSettings, CodeIndex
+from moatless.index import code_index as code_index_module
 from moatless.index.code_index import is_test
 from moatless.index.settings import CommentStrategy
 from moatless.repository import FileRepository
@@ -111,3 +116,111 @@ def test_find_test_files_by_span():
     assert len(files) == 3
     assert "tests/model_forms/tests.py" in [file.file_path for file in files]
 
+
+def test_load_shared_memory_mapped_index(tmp_path):
+    repo_dir = tmp_path / "repo"
+    repo_dir.mkdir()
+    (repo_dir / "models.py").write_text("class Model:\n    def save(self):\n        return 1\n")
+    persist_dir = str(tmp_path / "index")
+
+    settings = IndexSettings(dimensions=32)
+    code_index = CodeIndex(
+        file_repo=FileRepository(repo_path=str(repo_dir)), embed_model=MockEmbedding(embed_dim=32), settings=settings
+    )
+    code_index.run_ingestion()
+    code_index.persist(persist_dir)
+
+    code_indexes = [
+        CodeIndex.from_persist_dir(
+            persist_dir,
+            file_repo=FileRepository(repo_path=str(repo_dir)),
+            mmap=True,
+            shared=True,
+            embed_model=MockEmbedding(embed_dim=32),
+        )
+        for _ in range(2)
+    ]
+
+    # The loaded index is shared, the file repository isn't
+    assert code_indexes[0]._vector_store is code_indexes[1]._vector_store
+    assert code_indexes[0]._file_repo is not code_indexes[1]._file_repo
+    assert code_indexes[0]._vector_search("save")[0].file_path == "models.py"
+
+    del code_indexes
+    gc.collect()
+    assert len(code_index_module._shared_indexes) == 0
+
+
+def test_update_to_commit(tmp_path):
+    repo_dir = tmp_path / "repo"
+    repo_dir.mkdir()
+
+    def commit(files: dict[str, str | None]) -> str:
+        for file_path, content in files.items():
+            if content is None:
+                (repo_dir / file_path).unlink()
+            else:
+                (repo_dir / file_path).write_text(content)
+        subprocess.run(["git", "add", "-A"], cwd=repo_dir, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@test", "commit", "-q", "-m", "commit"],
+            cwd=repo_dir,
+            check=True,
+        )
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=repo_dir, check=True, capture_output=True, text=True
+        ).stdout.strip()
+
+    subprocess.run(["git", "init", "-q"], cwd=repo_dir, check=True)
+    old_commit = commit(
+        {
+            "models.py": "class Model:\n    def save(self):\n        return 1\n",
+            "views.py": "def index():\n    return Model()\n",
+            "legacy.py": "class LegacyModel:\n    pass\n",
+            "README.md": "Models\n",
+        }
+    )
+
+    file_repo = FileRepository(repo_path=str(repo_dir))
+    code_index = CodeIndex(
+        file_repo=file_repo, embed_model=MockEmbedding(embed_dim=32), settings=IndexSettings(dimensions=32)
+    )
+    code_index.run_ingestion()
+    persist_dir = str(tmp_path / "index")
+    code_index.persist(persist_dir)
+
+    new_commit = commit(
+        {
+            "views.py": "def detail():\n    return Model()\n",
+            "legacy.py": None,
+            "api.py": "class Resource:\n    def get(self):\n        return Model()\n",
+            "README.md": "Models and views\n",
+        }
+    )
+
+    loaded = CodeIndex.from_persist_dir(
+        persist_dir, file_repo=file_repo, mmap=True, embed_model=MockEmbedding(embed_dim=32)
+    )
+    models_node = loaded._docstore.get_document("models.py__")
+
+    # Only the nodes of changed and added files are embedded again
+    embedded_nodes, _ = loaded.update_to_commit(file_repo, old_commit, new_commit)
+    assert embedded_nodes == 2
+
+    file_paths = {node.metadata["file_path"] for node in loaded._docstore.docs.values()}
+    assert file_paths == {"models.py", "views.py", "api.py"}
+    assert loaded._docstore.get_document("models.py__").to_dict() == models_node.to_dict()
+    assert loaded._vector_store.client.ntotal == len(loaded._docstore.docs) == 3
+
+    assert set(loaded._blocks_by_class_name) == {"Model", "Resource"}
+    assert set(loaded._blocks_by_function_name) == {"save", "get", "detail"}
+    assert "legacy.py" not in loaded.code_graph.file_paths
+    assert loaded._vector_search("detail", file_pattern="views.py")[0].file_path == "views.py"
+
+    loaded.persist(str(tmp_path / "updated_index"))
+    updated = CodeIndex.from_persist_dir(str(tmp_path / "updated_index"), embed_model=MockEmbedding(embed_dim=32))
+    assert updated._vector_store.client.ntotal == len(updated._docstore.docs) == 3
+
+    # The repository must be checked out at the commit the index is updated to
+    with pytest.raises(ValueError):
+        loaded.update_to_commit(file_repo, new_commit, old_commit)
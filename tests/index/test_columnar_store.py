@@ -0,0 +1,104 @@
+import os
+
+import pytest
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+from moatless.index import CodeIndex, IndexSettings
+from moatless.index.columnar_store import (
+    INDEX_COLUMNS_DIR,
+    ColumnarDocumentStore,
+    IndexColumns,
+    convert_persist_dir,
+    has_index_columns,
+    write_index_columns,
+)
+from moatless.index.simple_faiss import SimpleVectorStoreData
+from moatless.repository import FileRepository
+
+
+def _ingest(tmp_path) -> CodeIndex:
+    repo_dir = tmp_path / "repo"
+    repo_dir.mkdir()
+    (repo_dir / "models.py").write_text("class Model:\n    def save(self):\n        return 1\n")
+    (repo_dir / "test_models.py").write_text("def test_save():\n    assert Model().save() == 1\n")
+
+    code_index = CodeIndex(
+        file_repo=FileRepository(repo_path=str(repo_dir)),
+        embed_model=MockEmbedding(embed_dim=32),
+        settings=IndexSettings(dimensions=32),
+    )
+    code_index.run_ingestion()
+    return code_index
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_persist_index_columns(tmp_path, mmap):
+    code_index = _ingest(tmp_path)
+    docs = {node_id: node.to_dict() for node_id, node in code_index._docstore.docs.items()}
+    doc_hashes = {node_id: code_index._docstore.get_document_hash(node_id) for node_id in docs}
+    vector_store_data = code_index._vector_store.data.to_dict()
+
+    persist_dir = str(tmp_path / "index")
+    code_index.persist(persist_dir)
+
+    assert has_index_columns(persist_dir)
+    assert not os.path.exists(os.path.join(persist_dir, "docstore.json"))
+    assert not os.path.exists(os.path.join(persist_dir, "vector_index.json"))
+
+    loaded = CodeIndex.from_persist_dir(
+        persist_dir, file_repo=code_index._file_repo, mmap=mmap, embed_model=MockEmbedding(embed_dim=32)
+    )
+    assert isinstance(loaded._docstore, ColumnarDocumentStore)
+    assert {node_id: node.to_dict() for node_id, node in loaded._docstore.docs.items()} == docs
+    assert {node_id: loaded._docstore.get_document_hash(node_id) for node_id in docs} == doc_hashes
+    assert loaded._vector_store.data.to_dict() == vector_store_data
+    assert loaded._docstore.get_document("missing", raise_error=False) is None
+
+    assert loaded._vector_search("save", category="implementation")[0].file_path == "models.py"
+    assert [hit.file_path for hit in loaded._vector_search("save", file_pattern="test_*.py")] == ["test_models.py"]
+
+    # Unchanged nodes aren't embedded again when a loaded index is updated
+    assert loaded.run_ingestion() == (0, 0)
+
+
+def test_convert_json_persist_dir(tmp_path):
+    code_index = _ingest(tmp_path)
+
+    persist_dir = str(tmp_path / "index")
+    code_index._vector_store.persist(persist_dir)
+    code_index._docstore.persist(os.path.join(persist_dir, "docstore.json"))
+    code_index._settings.persist(persist_dir)
+
+    json_index = CodeIndex.from_persist_dir(persist_dir, embed_model=MockEmbedding(embed_dim=32))
+    expected_docs = {node_id: node.to_dict() for node_id, node in json_index._docstore.docs.items()}
+
+    convert_persist_dir(persist_dir)
+
+    assert sorted(os.listdir(persist_dir)) == [INDEX_COLUMNS_DIR, "settings.json", "vector_index.faiss"]
+    loaded = CodeIndex.from_persist_dir(persist_dir, embed_model=MockEmbedding(embed_dim=32))
+    assert {node_id: node.to_dict() for node_id, node in loaded._docstore.docs.items()} == expected_docs
+
+
+def test_index_columns_store_other_metadata(tmp_path):
+    class DocumentStore:
+        def __init__(self, nodes):
+            self.docs = {node.node_id: node for node in nodes}
+
+        def get_document_hash(self, node_id):
+            return None
+
+    nodes = [
+        TextNode(id_="b", text="", metadata={"tokens": 2**40, "span_ids": ("a",), "custom": {"key": [1, 2]}}),
+        TextNode(id_="a", text="ä", metadata={"file_name": "other.py", "file_path": "a.py", "category": None}),
+    ]
+    data = SimpleVectorStoreData(vector_id_to_text_id={3: "a", 1: "b", 2: "removed"})
+
+    write_index_columns(str(tmp_path), DocumentStore(nodes), data)
+    columns = IndexColumns.from_persist_dir(str(tmp_path))
+
+    assert [columns.node_id(row) for row in range(len(columns))] == ["a", "b"]
+    assert columns.node(0).to_dict() == nodes[1].to_dict()
+    assert columns.metadata(1) == {"tokens": 2**40, "span_ids": ["a"], "custom": {"key": [1, 2]}}
+    assert columns.doc_hash(0) == nodes[1].hash
+    assert [columns.vector_row(vector_id) for vector_id in range(5)] == [None, 1, None, 0, None]
@@ -0,0 +1,58 @@
+from typing import List
+
+from llama_index.core.embeddings import MockEmbedding
+
+from moatless.index import CodeIndex, IndexSettings
+from moatless.index.embedding_cache import EmbeddingCache, text_hash
+from moatless.repository import FileRepository
+
+
+class CountingEmbedding(MockEmbedding):
+    embedded_texts: int = 0
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.embedded_texts += len(texts)
+        return [[float(len(text))] * self.embed_dim for text in texts]
+
+
+def _create_repo(repo_dir, files: dict[str, str]) -> FileRepository:
+    repo_dir.mkdir()
+    for file_path, content in files.items():
+        (repo_dir / file_path).write_text(content)
+    return FileRepository(repo_path=str(repo_dir))
+
+
+def test_embeddings_are_cached_across_indexes(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache"))
+    models = "class Model:\n    def save(self):\n        return 1\n"
+    views = "def index():\n    return Model()\n"
+
+    embed_model = CountingEmbedding(embed_dim=8)
+    code_index = CodeIndex(
+        file_repo=_create_repo(tmp_path / "repo_1", {"models.py": models, "views.py": views}),
+        embed_model=embed_model,
+        settings=IndexSettings(dimensions=8),
+        embedding_cache=cache,
+    )
+    code_index.run_ingestion()
+    assert code_index.embedding_cache_stats.hits == 0
+    assert code_index.embedding_cache_stats.misses == embed_model.embedded_texts == 2
+
+    # Only the changed file is embedded when indexing the next commit
+    embed_model = CountingEmbedding(embed_dim=8)
+    next_index = CodeIndex(
+        file_repo=_create_repo(tmp_path / "repo_2", {"models.py": models, "views.py": views + "\n# Changed\n"}),
+        embed_model=embed_model,
+        settings=IndexSettings(dimensions=8),
+        embedding_cache=EmbeddingCache(str(tmp_path / "cache")),
+    )
+    next_index.run_ingestion()
+    assert next_index.embedding_cache_stats.hits == 1
+    assert next_index.embedding_cache_stats.misses == embed_model.embedded_texts == 1
+
+    text = next_index._docstore.get_document("models.py__").get_content("embed")
+    assert cache.get_many(embed_model.model_name, 8, [text_hash(text)]) == [[float(len(text))] * 8]
+
+    # Embeddings are cached per number of dimensions
+    assert cache.get_many(embed_model.model_name, 16, [b"\0" * 32]) == [None]
+    assert len(cache) == 3
@@ -0,0 +1,174 @@
+import faiss
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import FilterOperator, MetadataFilter, MetadataFilters, VectorStoreQuery
+
+from moatless.index.settings import IndexSettings, VectorEncoding, VectorIndexType
+from moatless.index.simple_faiss import SimpleFaissVectorStore, create_faiss_index
+
+DIMENSIONS = 32
+
+
+def _create_nodes(count: int, dimensions: int = DIMENSIONS) -> list[TextNode]:
+    rng = np.random.default_rng(42)
+    vectors = rng.random((count, dimensions), dtype=np.float32)
+    return [TextNode(id_=f"node_{i}", text=f"chunk {i}", embedding=vector.tolist()) for i, vector in enumerate(vectors)]
+
+
+@pytest.mark.parametrize(
+    "index_type",
+    [VectorIndexType.FLAT, VectorIndexType.HNSW, VectorIndexType.IVF_FLAT, VectorIndexType.IVF_PQ],
+)
+def test_vector_store_index_types(index_type, tmp_path):
+    settings = IndexSettings(dimensions=DIMENSIONS, index_type=index_type, ivf_nprobe=4, pq_m=8)
+    vector_store = SimpleFaissVectorStore.from_defaults(d=DIMENSIONS, index_settings=settings)
+
+    nodes = _create_nodes(2000)
+    vector_store.add(nodes)
+
+    if index_type in (VectorIndexType.IVF_FLAT, VectorIndexType.IVF_PQ):
+        assert faiss.extract_index_ivf(vector_store.client).nlist == 2000 // 39
+
+    query = VectorStoreQuery(query_embedding=nodes[7].embedding, similarity_top_k=5)
+    assert vector_store.query(query).ids[0] == "node_7"
+
+    vector_store.persist(str(tmp_path))
+    loaded = SimpleFaissVectorStore.from_persist_dir(str(tmp_path), index_settings=settings)
+    assert loaded.d == DIMENSIONS
+    assert loaded.query(query).ids == vector_store.query(query).ids
+
+    mmap_loaded = SimpleFaissVectorStore.from_persist_dir(str(tmp_path), index_settings=settings, mmap=True)
+    assert mmap_loaded.query(query).ids == vector_store.query(query).ids
+
+    # Search parameters can be overridden per query
+    assert loaded.query(query, nprobe=1, ef_search=8).ids[0] == "node_7"
+
+
+def test_create_faiss_index_falls_back_to_flat():
+    settings = IndexSettings(dimensions=DIMENSIONS, index_type=VectorIndexType.IVF_PQ, pq_m=8)
+    vectors = np.array([node.embedding for node in _create_nodes(100)], dtype=np.float32)
+
+    index = create_faiss_index(DIMENSIONS, settings, vectors)
+    assert isinstance(index, faiss.IndexIDMap)
+    assert isinstance(faiss.downcast_index(index.index), faiss.IndexFlatL2)
+
+    with pytest.raises(ValueError):
+        create_faiss_index(DIMENSIONS, IndexSettings(index_type=VectorIndexType.IVF_PQ, pq_m=7), vectors)
+
+
+@pytest.mark.parametrize(
+    "vector_encoding, rerank_encoding, min_compression",
+    [
+        (VectorEncoding.FLOAT16, None, 1.9),
+        (VectorEncoding.INT8, None, 3.5),
+        # The PQ codebooks take up most of the space for this few vectors
+        (VectorEncoding.PQ, VectorEncoding.INT8, 1.8),
+    ],
+)
+def test_vector_store_compressed_encodings(vector_encoding, rerank_encoding, min_compression):
+    # Enough dimensions for the vector ids to not count in the index size
+    dimensions = 256
+    nodes = _create_nodes(1000, dimensions)
+
+    flat_store = SimpleFaissVectorStore.from_defaults(d=dimensions, index_settings=IndexSettings(dimensions=dimensions))
+    flat_store.add(nodes)
+
+    settings = IndexSettings(
+        dimensions=dimensions,
+        vector_encoding=vector_encoding,
+        rerank_encoding=rerank_encoding,
+        rerank_k_factor=10,
+        pq_m=32,
+    )
+    vector_store = SimpleFaissVectorStore.from_defaults(d=dimensions, index_settings=settings)
+    vector_store.add(nodes)
+
+    flat_size = len(faiss.serialize_index(flat_store.client))
+    assert flat_size / len(faiss.serialize_index(vector_store.client)) >= min_compression
+
+    matches = 0
+    for node in nodes[:50]:
+        query = VectorStoreQuery(query_embedding=node.embedding, similarity_top_k=10)
+        matches += len(set(vector_store.query(query).ids) & set(flat_store.query(query).ids))
+    assert matches / 500 >= 0.9
+
+
+@pytest.mark.parametrize(
+    "index_type, rerank_encoding",
+    [
+        (VectorIndexType.FLAT, None),
+        (VectorIndexType.HNSW, None),
+        (VectorIndexType.IVF_FLAT, None),
+        (VectorIndexType.IVF_PQ, VectorEncoding.FLOAT32),
+    ],
+)
+def test_vector_store_filters_in_search(index_type, rerank_encoding):
+    settings = IndexSettings(
+        dimensions=DIMENSIONS, index_type=index_type, rerank_encoding=rerank_encoding, ivf_nprobe=1, pq_m=8
+    )
+    vector_store = SimpleFaissVectorStore.from_defaults(d=DIMENSIONS, index_settings=settings)
+
+    nodes = _create_nodes(2000)
+    for i, node in enumerate(nodes):
+        node.metadata = {"file_path": f"file_{i % 100}.py", "category": "test" if i % 2 else "implementation"}
+    vector_store.add(nodes)
+
+    # Only 20 vectors match, spread over the IVF lists
+    filters = MetadataFilters(
+        filters=[
+            MetadataFilter(key="file_path", operator=FilterOperator.IN, value=["file_3.py", "file_4.py"]),
+            MetadataFilter(key="category", value="test"),
+        ]
+    )
+    query = VectorStoreQuery(query_embedding=nodes[7].embedding, similarity_top_k=10, filters=filters)
+    result = vector_store.query(query)
+
+    assert len(result.ids) == 10
+    assert all(int(node_id.split("_")[1]) % 100 == 3 for node_id in result.ids)
+    assert sorted(vector_store.metadata_values("category")) == ["implementation", "test"]
+
+    query = VectorStoreQuery(
+        query_embedding=nodes[7].embedding,
+        similarity_top_k=10,
+        filters=MetadataFilters(filters=[MetadataFilter(key="file_path", value="missing.py")]),
+    )
+    assert vector_store.query(query).ids == []
+
+
+@pytest.mark.parametrize(
+    "index_type, rerank_encoding",
+    [
+        (VectorIndexType.FLAT, None),
+        (VectorIndexType.HNSW, None),
+        (VectorIndexType.IVF_FLAT, None),
+        (VectorIndexType.FLAT, VectorEncoding.FLOAT32),
+    ],
+)
+def test_vector_store_delete_nodes(index_type, rerank_encoding, tmp_path):
+    settings = IndexSettings(
+        dimensions=DIMENSIONS,
+        index_type=index_type,
+        vector_encoding=VectorEncoding.FLOAT16 if rerank_encoding else VectorEncoding.FLOAT32,
+        rerank_encoding=rerank_encoding,
+    )
+    vector_store = SimpleFaissVectorStore.from_defaults(d=DIMENSIONS, index_settings=settings)
+    nodes = _create_nodes(2000)
+    vector_store.add(nodes)
+    vector_store.persist(str(tmp_path))
+
+    loaded = SimpleFaissVectorStore.from_persist_dir(str(tmp_path), index_settings=settings, mmap=True)
+    # Vectors of deleted documents are removed together with the deleted nodes
+    loaded.delete("node_1")
+    loaded.delete_nodes([f"node_{i}" for i in range(0, 2000, 2)])
+
+    query = VectorStoreQuery(query_embedding=nodes[7].embedding, similarity_top_k=5)
+    assert loaded.client.ntotal == 999
+    assert "node_1" not in loaded.data.metadata_dict
+    assert loaded.query(query).ids[0] == "node_7"
+    assert not {"node_0", "node_1", "node_6", "node_8"} & set(loaded.query(query).ids)
+
+    # New vectors get ids after the ids of the kept vectors
+    loaded.add([TextNode(id_="new", text="new", embedding=nodes[0].embedding)])
+    assert loaded.client.ntotal == 1000
+    assert loaded.query(VectorStoreQuery(query_embedding=nodes[0].embedding, similarity_top_k=1)).ids == ["new"]
@@ -472,3 +472,67 @@ def test_context_file_status_indicators():
     dump = context_file.model_dump()
     assert "was_edited" not in dump
     assert "was_viewed" not in dump
+
+
+def test_context_file_reparses_module_after_changes():
+    base_content = "def foo():\n    return 1\n\n\ndef bar():\n    return 2\n"
+    repo = InMemRepository({"test_file.py": base_content})
+    context_file = ContextFile(file_path="test_file.py", repo=repo)
+
+    module = context_file.module
+    bar = module.find_by_path(["bar"])
+
+    context_file.apply_changes(base_content.replace("return 1", "x = 1\n    return x"))
+
+    assert context_file.module is module
+    assert context_file.module.find_by_path(["bar"]) is bar
+    assert bar.start_line == 6
+    assert context_file.module.to_string() == context_file.content
+
+
+def test_context_file_parses_large_files_as_outline(monkeypatch):
+    monkeypatch.setattr("moatless.file_context.OUTLINE_MIN_LINES", 5)
+
+    content = "def foo():\n    return 1\n\n\ndef bar():\n    x = 2\n    return x\n"
+    repo = InMemRepository({"test_file.py": content})
+    context_file = ContextFile(file_path="test_file.py", repo=repo)
+
+    assert context_file.module.is_outline
+
+    # Viewing a span parses the body of the function
+    context_file.add_span("bar")
+    assert context_file.module._outline_blocks.keys() == {"foo"}
+    assert "    x = 2" in context_file.to_prompt()
+
+    # The changed function is parsed in full
+    context_file.apply_changes(content.replace("return 1", "y = 1\n    return y"))
+    assert context_file.module.find_by_path(["foo"]).children
+    assert context_file.module.to_string() == context_file.content
+
+
+def test_context_file_caches_rendered_prompts(monkeypatch):
+    content = "def foo():\n    return 1\n\n\ndef bar():\n    return 2\n"
+    repo = InMemRepository({"test_file.py": content})
+    file_context = FileContext(repo=repo)
+    context_file = file_context.add_file("test_file.py")
+    context_file.add_span("foo")
+
+    counted = []
+    monkeypatch.setattr("moatless.file_context.count_tokens", lambda text: counted.append(text) or len(text))
+
+    prompt = context_file.to_prompt(show_line_numbers=True, show_outcommented_code=True, max_tokens=1000)
+    assert "return 1" in prompt and "return 2" not in prompt
+    assert file_context.context_size() == len(prompt)
+
+    # Rendering the same spans again doesn't count any tokens
+    counted.clear()
+    assert context_file.to_prompt(show_line_numbers=True, show_outcommented_code=True, max_tokens=1000) == prompt
+    assert file_context.context_size() == len(prompt)
+    assert counted == []
+
+    # Changed spans and content are rendered again
+    context_file.add_span("bar")
+    assert "return 2" in context_file.to_prompt(show_line_numbers=True)
+
+    context_file.apply_changes(content.replace("return 2", "return 3"))
+    assert "return 3" in context_file.to_prompt(show_line_numbers=True)